@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 from modules.globals import upload_path, download_path, instance_path, get_current_modules_dir
@@ -18,11 +19,113 @@ CONVERTER_URL_WIN = 'https://github.com/tappi287/usdzconvert_windows/releases/'
 CONVERTER_URL_UNIX = 'https://github.com/tappi287/usdzconvert_windows/releases/' \
                      'download/1.3/pxr_usd_abc1710_py27_ubuntu1804.tar.gz'
 ABC_POST_PROCESSOR_SCRIPT_PATH = Path(get_current_modules_dir()) / 'proc' / 'post_process_abc.py'
+CONVERTER_WORKER_SCRIPT_PATH = Path(get_current_modules_dir()) / 'proc' / 'converter_worker.py'
 USDZ_CONVERTER_PATH = instance_path() / 'converter'               # will be updated at runtime
 USDZ_CONVERTER_SCRIPT_PATH = Path('usdzconvert') / 'usdzconvert'  # relative to converter path
 USDZ_CONVERTER_USD_PATH = Path('USD')                             # relative to converter path
 USDZ_CONVERTER_INTERPRETER = Path('USD') / 'deps' / 'python' / 'python.exe'  # Windows only
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Conversion results of identical input files and options are served from this cache
+# Least recently used results are evicted above the size limit, set the limit to 0 to disable the cache
+RESULT_CACHE_FOLDER = instance_path() / 'result_cache'
+RESULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Seconds a convert, post_process or preview stage may run before it's process tree is killed and
+# the job fails with a timeout. 0 runs the stage without limit.
+STAGE_TIMEOUTS = {'convert': 3600, 'post_process': 1800, 'preview': 600}
+# Linux process controls of the convert, post_process and preview stages. nice 0-19, ionice class 'idle',
+# 'best-effort' or None and memory_mb caps the address space (RLIMIT_AS) of a process, 0 for no cap.
+# Processes exceeding the cap fail instead of triggering the OOM killer on the web server.
+STAGE_PROCESS_LIMITS = {'convert': {'nice': 10, 'ionice': 'best-effort', 'memory_mb': 0},
+                        'post_process': {'nice': 10, 'ionice': 'best-effort', 'memory_mb': 0},
+                        'preview': {'nice': 15, 'ionice': 'idle', 'memory_mb': 0}}
+# Pin the processes of each worker slot to CPUs. None disables pinning, 'auto' splits the CPUs not reserved
+# for the web server across the slots, or a list of CPU lists per slot eg. [[2, 3], [4, 5]]
+CONVERSION_CPU_AFFINITY = None
+WEB_SERVER_CPUS = 1
+# Delegated cgroup v2 directory eg. /sys/fs/cgroup/usdz_webui. If set, every worker slot gets a sub group and
+# memory_mb caps the memory of the whole process tree of a stage instead of RLIMIT_AS.
+CONVERSION_CGROUP = None
+# Number of usdzconvert jobs running concurrently, defaults to half of the available cores
+CONVERSION_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+# Keep one converter interpreter per worker slot alive with pxr and usdzconvert loaded between jobs
+CONVERTER_WARM_WORKERS = True
+# Replace a warm converter interpreter after it processed this number of jobs
+CONVERTER_WORKER_MAX_JOBS = 25
+# Seconds a warm converter interpreter may take to start up and to answer the health check before each job.
+# Workers exceeding them are killed and replaced.
+CONVERTER_WORKER_START_TIMEOUT = 120
+CONVERTER_WORKER_PING_TIMEOUT = 10
+# Preview images are rendered by up to PREVIEW_WORKERS usdrecord processes besides the conversion slots.
+# Previews wait while PREVIEW_DEFER_QUEUED_JOBS or more jobs are queued and are skipped once PREVIEW_QUEUE_SIZE
+# previews are waiting. With PREVIEW_BACKFILL, missing previews of downloads are rendered while the server is idle.
+PREVIEW_WORKERS = 1
+PREVIEW_QUEUE_SIZE = 50
+PREVIEW_DEFER_QUEUED_JOBS = 2
+PREVIEW_BACKFILL = True
+# Process output is written to the job messages in batches after this interval in seconds or number of lines
+MESSAGE_FLUSH_INTERVAL = 2.0
+MESSAGE_FLUSH_LINES = 200
+# Complete process output of every job is written to a log file per job. Only lines with progress, warning
+# or error markers become job messages, the last JOB_OUTPUT_TAIL_KB of output are kept in memory while a job runs
+# and the last JOB_FAILURE_OUTPUT_BYTES are added to the messages of failed jobs.
+JOB_LOG_FOLDER = instance_path() / 'job_logs'
+JOB_OUTPUT_TAIL_KB = 64
+JOB_FAILURE_OUTPUT_BYTES = 4096
+# Job status streams are closed after this number of seconds to free the server thread, browsers re-connect
+JOB_STREAM_SECONDS = 30
+# Every open job status stream occupies one of the SERVE_THREADS. Further job pages are answered with status 503
+# and poll for updates every JOB_STREAM_RETRY_AFTER seconds instead.
+JOB_STREAM_MAX_CLIENTS = 4
+JOB_STREAM_RETRY_AFTER = 10
+# Waitress request threads
+SERVE_THREADS = 8
+# Incomplete chunked uploads are kept for resuming until they were inactive for this number of seconds
+CHUNKED_UPLOAD_EXPIRY = 24 * 3600
+# Uploads are rejected with status 503, or 429 for a single submitter, and a Retry-After header of
+# ADMISSION_RETRY_AFTER seconds while this number of jobs is queued, the submitter has this number of queued jobs,
+# this number of upload bytes is being received or less than this free disk space in MB is left on UPLOAD_FOLDER.
+# A limit of 0 disables the check.
+ADMISSION_MAX_QUEUED_JOBS = 200
+ADMISSION_MAX_QUEUED_JOBS_PER_SUBMITTER = 50
+ADMISSION_MAX_UPLOAD_BYTES_IN_FLIGHT = 2 * 1024 ** 3
+ADMISSION_MIN_FREE_DISK_MB = 1024
+ADMISSION_RETRY_AFTER = 30
+# Jobs per job page and default job api page size
+JOBS_PER_PAGE = 20
+# Entries per downloads page and interval in seconds to reconcile the download index with the download folder
+DOWNLOADS_PER_PAGE = 50
+DOWNLOAD_INDEX_RECONCILE_SECONDS = 300
+# Running jobs are leased to the server process and renewed by a heartbeat. Unfinished jobs with an expired
+# lease are re-queued, jobs interrupted JOB_MAX_ATTEMPTS times are failed.
+JOB_LEASE_SECONDS = 60
+JOB_HEARTBEAT_SECONDS = 15
+JOB_MAX_ATTEMPTS = 3
+# Lowest and highest job priority uploads identified by an X-Api-Token header may request with the priority
+# form field. Anonymous uploads always get priority 0 and the automatic lane.
+JOB_PRIORITY_RANGE = (-5, 5)
+# Uploads of submitters with this number of queued jobs go to the bulk lane unless a lane was requested
+BULK_LANE_QUEUED_JOBS = 3
+# While interactive and bulk jobs are waiting every n-th started job is taken from the bulk lane
+BULK_LANE_SHARE = 4
+# Queued jobs run shortest expected conversion time first, every second a job waits lowers its expected cost
+# by this number of seconds. Expected costs are fitted on this number of recent finished jobs per scene type.
+JOB_AGING_FACTOR = 1.0
+JOB_COST_HISTORY = 200
+# Metrics count job states in memory, the job lease heartbeat re-counts them from the database after this
+# number of seconds
+METRICS_RESYNC_SECONDS = 300
+# SQLite database shared by the waitress and process callback threads. Connections are pooled, write-ahead
+# logging keeps readers from blocking the writer and writers wait up to SQLITE_BUSY_TIMEOUT seconds for the lock.
+DB_POOL_SIZE = 12
+DB_POOL_OVERFLOW = 8
+DB_POOL_TIMEOUT = 30
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_BUSY_TIMEOUT = 30
+# Commits taking longer than this number of seconds are logged
+DB_SLOW_COMMIT_SECONDS = 1.0
+
 # Will be overwritten by instance config
 SQLALCHEMY_DATABASE_URI = 'sqlite:////tmp/app.sqlite3'
@@ -0,0 +1,93 @@
+import shutil
+import threading
+from typing import Union
+
+from flask import current_app
+
+from modules.job import ConversionJob
+from modules.log import setup_logger
+from modules.metrics import admission_rejected
+
+_logger = setup_logger(__name__)
+
+
+class Rejection:
+    def __init__(self, status: int, reason: str, message: str, retry_after: int):
+        self.status = status
+        self.reason = reason
+        self.message = message
+        self.retry_after = retry_after
+
+
+class AdmissionControl:
+    """ Decides from the request headers if an upload is accepted before its body is read. Submissions are
+        rejected while the job queue is full, the submitter has too many queued jobs, too many upload bytes
+        are being received or the upload folder is running out of disk space. A limit of 0 disables a check.
+    """
+    _in_flight_bytes = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def in_flight_bytes(cls) -> int:
+        with cls._lock:
+            return cls._in_flight_bytes
+
+    @classmethod
+    def check_queue(cls, submitter: str) -> Union[None, Rejection]:
+        """ Queue limits of uploads that create a job """
+        config = current_app.config
+        queued = ConversionJob.query.filter(ConversionJob.state == ConversionJob.States.queued,
+                                            ConversionJob.completed.isnot(True))
+        max_queued = int(config.get('ADMISSION_MAX_QUEUED_JOBS') or 0)
+        if max_queued and queued.count() >= max_queued:
+            return cls._reject(503, 'queue', f'The conversion queue is full with {max_queued} waiting jobs. '
+                                             f'Please try again later.')
+
+        max_submitter = int(config.get('ADMISSION_MAX_QUEUED_JOBS_PER_SUBMITTER') or 0)
+        if max_submitter and queued.filter(ConversionJob.submitter == submitter).count() >= max_submitter:
+            return cls._reject(429, 'submitter', f'You already have {max_submitter} jobs waiting for conversion. '
+                                                 f'Please wait for them to finish.')
+
+    @classmethod
+    def check_disk(cls, content_length: int) -> Union[None, Rejection]:
+        min_free = int(current_app.config.get('ADMISSION_MIN_FREE_DISK_MB') or 0) * 1048576
+        if not min_free:
+            return
+
+        try:
+            free = shutil.disk_usage(current_app.config.get('UPLOAD_FOLDER')).free
+        except OSError as e:
+            _logger.error('Could not read free disk space of the upload folder: %s', e)
+            return
+
+        if free - content_length < min_free:
+            return cls._reject(503, 'disk', 'The server is running out of disk space for uploads. '
+                                            'Please try again later.')
+
+    @classmethod
+    def reserve(cls, content_length: int) -> Union[None, Rejection]:
+        """ Account the body of an admitted upload until release is called. An upload is always admitted
+            if no other upload is in flight.
+        """
+        max_bytes = int(current_app.config.get('ADMISSION_MAX_UPLOAD_BYTES_IN_FLIGHT') or 0)
+
+        with cls._lock:
+            if max_bytes and cls._in_flight_bytes and cls._in_flight_bytes + content_length > max_bytes:
+                in_flight = cls._in_flight_bytes
+            else:
+                cls._in_flight_bytes += content_length
+                return
+
+        _logger.info('Upload of %s bytes exceeds the upload limit with %s bytes in flight', content_length, in_flight)
+        return cls._reject(503, 'upload_bytes', 'The server is busy receiving other uploads. Please try again later.')
+
+    @classmethod
+    def release(cls, content_length: int):
+        with cls._lock:
+            cls._in_flight_bytes = max(0, cls._in_flight_bytes - content_length)
+
+    @staticmethod
+    def _reject(status: int, reason: str, message: str) -> Rejection:
+        admission_rejected.inc(1, reason)
+        _logger.info('Rejected upload with status %s: %s', status, message)
+        return Rejection(status, reason, message, int(current_app.config.get('ADMISSION_RETRY_AFTER') or 30))
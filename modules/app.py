@@ -6,6 +6,7 @@ from pathlib import Path
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
+from modules.db_engine import engine_options, instrument_database
 from modules.globals import APP_NAME, instance_path
 from modules.log import setup_logging
 from modules.install import instance_setup
@@ -37,12 +38,17 @@ App = Flask(APP_NAME, instance_path=instance_dir.resolve().as_posix())
 App.config.from_object('config')  # Loads the default config.py from root dir
 App.config.from_pyfile(Path(instance_dir / 'config.py').as_posix())  # Loads config.py from instance dir
 App.config['USDZ_CONVERTER_PATH'] = converter_dir
+App.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(App.config)
 
 db = SQLAlchemy(App)
+instrument_database(db, App.config)
 
 from modules import views
+from modules.db_migrate import migrate_pickled_jobs, upgrade_schema
 views.import_dummy()  # Keep the IDE from deleting the import
 db.create_all()
+upgrade_schema(db)
+migrate_pickled_jobs(db)
 
 log_listener = setup_logging(app=App)
 log_listener.start()
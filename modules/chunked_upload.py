@@ -0,0 +1,316 @@
+import hashlib
+import hmac
+import json
+import secrets
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Tuple, Union
+
+from flask import current_app
+from werkzeug.datastructures import FileStorage, MultiDict
+from werkzeug.utils import secure_filename
+
+from modules.file_mgr import FileManager
+from modules.log import setup_logger
+from modules.metrics import upload_bytes, upload_seconds
+from modules.site import Urls
+
+_logger = setup_logger(__name__)
+
+
+class ChunkedUpload:
+    """ Resumable upload of a single file written in chunks directly into a job directory.
+
+        Clients create an upload, ask for the current offset and append chunks at that offset (tus-style).
+        Upload sessions are stored next to the files in the job directory and survive server restarts.
+        A batch is bound to the key returned when it was created, every further request of the batch has
+        to provide it. Batches without activity for CHUNKED_UPLOAD_EXPIRY seconds are removed.
+    """
+    read_size = 1024 * 1024
+    batch_key_file = 'batch.key'
+    # Running hashes of uploads without a chunk for this number of seconds are dropped, a resumed upload
+    # re-hashes its file
+    hash_state_seconds = 600
+    # Seconds between removing expired batches
+    expire_interval = 60
+
+    # Running sha256 and time of the last chunk per upload, re-created from the file on disk if missing
+    _hashes: Dict[str, Tuple[int, 'hashlib._Hash', float]] = dict()
+    _locks: Dict[str, threading.Lock] = dict()
+    _lock = threading.Lock()
+    _expired = 0.0
+
+    def __init__(self, job_dir: Path, token: str, filename: str, field: str, size: int, sha256: str = ''):
+        self.job_dir = job_dir
+        self.token = token
+        self.filename = filename
+        self.field = field
+        self.size = size
+        self.sha256 = sha256
+        # Only known to the request that created the batch
+        self.batch_key = str()
+
+    @property
+    def batch(self) -> str:
+        return self.job_dir.name
+
+    @property
+    def file_path(self) -> Path:
+        return self.job_dir / secure_filename(self.filename)
+
+    @property
+    def url(self) -> str:
+        return f'{Urls.upload}/{self.batch}/{self.token}'
+
+    @classmethod
+    def _session_file(cls, job_dir: Path, token: str) -> Path:
+        return job_dir / FileManager.upload_sessions_dir / f'{token}.json'
+
+    @staticmethod
+    def get_batch_dir(batch: str) -> Union[None, Path]:
+        if not batch or batch != secure_filename(batch):
+            return None
+
+        batch_dir = Path(current_app.config.get('UPLOAD_FOLDER')) / batch
+        if batch_dir.is_dir():
+            return batch_dir
+
+    @staticmethod
+    def _hash_key(batch_key: str) -> str:
+        return hashlib.sha256(batch_key.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _create_batch(cls) -> Tuple[Union[None, Path], str]:
+        """ Create a job directory for a new batch and the key that grants access to it """
+        job_dir = FileManager.create_job_dir()
+        if job_dir is None:
+            return None, str()
+
+        batch_key = secrets.token_urlsafe(24)
+        try:
+            (job_dir / FileManager.upload_sessions_dir).mkdir(exist_ok=True)
+            (job_dir / FileManager.upload_sessions_dir / cls.batch_key_file).write_text(cls._hash_key(batch_key))
+        except OSError as e:
+            _logger.error('Could not store upload batch key: %s', e)
+            shutil.rmtree(job_dir.as_posix(), ignore_errors=True)
+            return None, str()
+
+        return job_dir, batch_key
+
+    @classmethod
+    def get_batch(cls, batch: str, batch_key: str) -> Union[None, Path]:
+        """ Job directory of a batch if the key matches the key the batch was created with """
+        job_dir = cls.get_batch_dir(batch)
+        if job_dir is None or not batch_key:
+            return None
+
+        try:
+            stored = (job_dir / FileManager.upload_sessions_dir / cls.batch_key_file).read_text().strip()
+        except OSError:
+            # Job directories of form uploads and submitted batches do not accept chunked uploads
+            return None
+
+        if hmac.compare_digest(stored, cls._hash_key(batch_key)):
+            return job_dir
+
+    @classmethod
+    def create(cls, batch: str, batch_key: str, filename: str, field: str,
+               size) -> Tuple[Union[None, 'ChunkedUpload'], str]:
+        """ Create an upload in the batch job directory or in a new job directory if no batch is provided.
+            An existing upload of the same file in the batch will be resumed.
+        """
+        if not filename or not FileManager._allowed_file(filename):
+            return None, 'File extension not allowed.'
+        if not isinstance(size, int) or size < 0:
+            return None, 'Upload size is missing.'
+
+        cls.expire()
+
+        new_key = str()
+        if batch:
+            job_dir = cls.get_batch(batch, batch_key)
+            if job_dir is None:
+                return None, f'Upload batch {batch} does not exist.'
+        else:
+            job_dir, new_key = cls._create_batch()
+            if job_dir is None:
+                return None, 'Could not create upload directory.'
+
+        for upload in cls.list_uploads(job_dir):
+            if upload.filename == filename and upload.size == size:
+                _logger.info('Resuming upload of %s at offset %s', filename, upload.offset())
+                return upload, 'Resuming upload.'
+
+        upload = cls(job_dir, uuid.uuid4().hex, filename, field, size)
+        upload.batch_key = new_key
+        if upload.file_path.exists():
+            return None, f'File {filename} already exists in upload batch.'
+
+        upload.file_path.touch()
+        if not upload.save():
+            return None, 'Could not store upload session.'
+
+        _logger.info('Created upload of %s with %s bytes in %s', filename, size, job_dir.name)
+        return upload, 'Upload created.'
+
+    @classmethod
+    def load(cls, batch: str, batch_key: str, token: str) -> Union[None, 'ChunkedUpload']:
+        job_dir = cls.get_batch(batch, batch_key)
+        if job_dir is None or token != secure_filename(token):
+            return None
+
+        return cls._load_session_file(job_dir, cls._session_file(job_dir, token))
+
+    @classmethod
+    def _load_session_file(cls, job_dir: Path, session_file: Path) -> Union[None, 'ChunkedUpload']:
+        try:
+            with open(session_file.as_posix(), 'r') as f:
+                data = json.load(f)
+            return cls(job_dir, session_file.stem, data['filename'], data['field'], data['size'],
+                       data.get('sha256', ''))
+        except Exception as e:
+            _logger.debug('Could not load upload session %s: %s', session_file, e)
+
+    @classmethod
+    def list_uploads(cls, job_dir: Path):
+        for session_file in (job_dir / FileManager.upload_sessions_dir).glob('*.json'):
+            upload = cls._load_session_file(job_dir, session_file)
+            if upload is not None:
+                yield upload
+
+    def save(self) -> bool:
+        session_file = self._session_file(self.job_dir, self.token)
+        try:
+            session_file.parent.mkdir(exist_ok=True)
+            with open(session_file.as_posix(), 'w') as f:
+                json.dump({'filename': self.filename, 'field': self.field, 'size': self.size,
+                           'sha256': self.sha256}, f)
+        except Exception as e:
+            _logger.error('Could not save upload session: %s', e)
+            return False
+
+        return True
+
+    def offset(self) -> int:
+        try:
+            return self.file_path.stat().st_size
+        except OSError:
+            return 0
+
+    def is_complete(self) -> bool:
+        return bool(self.sha256) and self.offset() == self.size
+
+    def _get_hash(self, offset: int) -> 'hashlib._Hash':
+        key = self.file_path.as_posix()
+        hashed_bytes, sha, _ = self._hashes.get(key, (-1, None, 0.0))
+
+        if sha is None or hashed_bytes != offset:
+            # Server restarted or chunk was rejected, re-hash what we have on disk
+            sha = hashlib.sha256()
+            with open(key, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.read_size), b''):
+                    sha.update(chunk)
+
+        return sha
+
+    def write(self, stream, offset: int) -> Tuple[bool, int]:
+        """ Append the request stream at offset. Returns result and the current offset. """
+        key = self.file_path.as_posix()
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        with lock:
+            current_offset = self.offset()
+            if offset != current_offset or self.is_complete():
+                return False, current_offset
+
+            sha = self._get_hash(current_offset)
+            written, started = 0, time.monotonic()
+
+            with open(key, 'ab') as f:
+                for chunk in iter(lambda: stream.read(self.read_size), b''):
+                    # Never write beyond the announced size
+                    chunk = chunk[:max(0, self.size - current_offset - written)]
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    sha.update(chunk)
+                    written += len(chunk)
+
+            current_offset += written
+            with self._lock:
+                self._hashes[key] = (current_offset, sha, time.monotonic())
+            upload_bytes.inc(written, 'chunked')
+            upload_seconds.inc(time.monotonic() - started, 'chunked')
+
+            if current_offset == self.size:
+                self.sha256 = sha.hexdigest()
+                self.save()
+                with self._lock:
+                    self._hashes.pop(key, None)
+                    self._locks.pop(key, None)
+                _logger.info('Upload of %s completed with sha256 %s', self.filename, self.sha256)
+
+        return True, current_offset
+
+    def as_dict(self) -> dict:
+        result = {'upload_id': self.token, 'batch': self.batch, 'url': self.url, 'filename': self.filename,
+                  'size': self.size, 'offset': self.offset(), 'complete': self.is_complete()}
+        if self.batch_key:
+            result['batch_key'] = self.batch_key
+        return result
+
+    @classmethod
+    def expire(cls):
+        """ Drop running hashes of inactive uploads and remove batches that were abandoned """
+        now = time.monotonic()
+        with cls._lock:
+            if now - cls._expired < cls.expire_interval:
+                return
+            cls._expired = now
+
+            for key in [k for k, (_, _, used) in cls._hashes.items() if now - used > cls.hash_state_seconds]:
+                cls._hashes.pop(key)
+                lock = cls._locks.get(key)
+                if lock is not None and not lock.locked():
+                    cls._locks.pop(key)
+
+        expiry = current_app.config.get('CHUNKED_UPLOAD_EXPIRY', 0)
+        upload_dir = Path(current_app.config.get('UPLOAD_FOLDER'))
+        for key_file in upload_dir.glob(f'*/{FileManager.upload_sessions_dir}/{cls.batch_key_file}'):
+            job_dir = key_file.parent.parent
+            if expiry and not FileManager._has_pending_uploads(job_dir, expiry):
+                _logger.info('Removing expired upload batch %s', job_dir.name)
+                shutil.rmtree(job_dir.as_posix(), ignore_errors=True)
+
+    @classmethod
+    def completed_files(cls, batch: str, batch_key: str) -> Tuple[Union[None, Path], MultiDict]:
+        """ Return the job directory and files of a batch as request files, None if an upload is incomplete """
+        files = MultiDict()
+        job_dir = cls.get_batch(batch, batch_key)
+        if job_dir is None:
+            return None, files
+
+        for upload in cls.list_uploads(job_dir):
+            if not upload.is_complete():
+                _logger.error('Upload of %s is incomplete: %s/%s', upload.filename, upload.offset(), upload.size)
+                return None, files
+
+            # File content is already in place, FileManager will only pick up the file path
+            files.add(upload.field, FileStorage(filename=upload.filename, name=upload.field))
+
+        return job_dir, files
+
+    @classmethod
+    def completed_digests(cls, job_dir: Path) -> Dict[Path, Tuple[int, str]]:
+        """ Size and sha256 of the completed uploads of a job directory, hashed while the chunks were written """
+        return {upload.file_path: (upload.size, upload.sha256) for upload in cls.list_uploads(job_dir)
+                if upload.is_complete()}
+
+    @classmethod
+    def finish(cls, job_dir: Path):
+        """ Remove upload sessions after a job was created from the batch """
+        shutil.rmtree((job_dir / FileManager.upload_sessions_dir).as_posix(), ignore_errors=True)
@@ -0,0 +1,349 @@
+import atexit
+import concurrent.futures
+import json
+import subprocess as sp
+import threading
+import uuid
+from pathlib import Path
+from typing import List, Union
+
+from modules.create_process import RunProcess, create_piped_process, decode_output_line, kill_process_tree
+from modules.log import setup_logger
+from modules.job_output import JobOutput
+from modules.process_limits import ProcessLimits
+from modules.process_supervisor import ProcessSupervisor, connect_reader, read_chunk
+from modules.process_usage import ProcessUsage, read_peak_rss, read_proc_cpu, read_proc_io, reset_peak_rss
+
+_logger = setup_logger(__name__)
+
+# Must match the marker of proc/converter_worker.py
+WORKER_MARKER = '@@usdz_webui_worker@@'
+_marker = WORKER_MARKER.encode('utf-8')
+
+
+class ConverterWorker:
+    """ A Python 2.7 converter interpreter that keeps pxr and usdzconvert loaded between jobs.
+        Worker output is read on the ProcessSupervisor loop, the blocking methods wrap their coroutines.
+    """
+    def __init__(self, arguments: list, cwd: Path, env: dict = None):
+        self.arguments = arguments
+        self.cwd = cwd
+        self.env = env or dict()
+
+        self.process = None
+        self.jobs_done = 0
+        # Error reported with the last result eg. memory
+        self.last_error = None
+        self._reader = None
+        # Output read after the last result
+        self._pending = b''
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid if self.process else 0
+
+    def start(self, timeout: float = 0) -> bool:
+        """ Start the interpreter and wait up to timeout seconds until pxr and usdzconvert were imported """
+        try:
+            self.process = create_piped_process(self.arguments, self.cwd, self.env, stdin=sp.PIPE)
+        except Exception as e:
+            _logger.error('Could not start converter worker: %s', e)
+            return False
+
+        result = self._call(self._connect(), timeout)
+        if not result or not result.get('ready'):
+            _logger.error('Converter worker did not report ready state.')
+            self.kill()
+            return False
+
+        _logger.info('Started warm converter worker with pid: %s', self.pid)
+        return True
+
+    async def _connect(self) -> Union[None, dict]:
+        self._reader = await connect_reader(self.process.stdout)
+        return await self._read_result(None)
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def exitcode(self, timeout: float) -> Union[None, int]:
+        """ Wait up to timeout seconds for the exit code of a worker that closed it's output """
+        try:
+            return self.process.wait(timeout) if self.process else None
+        except sp.TimeoutExpired:
+            return None
+
+    def ping(self, timeout: float = 0) -> bool:
+        """ Health check, the worker must answer a request without output within timeout seconds """
+        return self.is_alive() and self._call(self._run('ping', list(), self.cwd), timeout) == 0
+
+    def _call(self, coroutine, timeout: float):
+        """ Wait for a worker coroutine, a worker that does not answer in time is killed """
+        try:
+            return ProcessSupervisor.call(coroutine, timeout or None)
+        except concurrent.futures.TimeoutError:
+            _logger.error('Converter worker %s did not answer within %ss. Killing worker.', self.pid, timeout)
+            # The pending read ends once the worker output closed
+            self.kill()
+            return None
+
+    def run(self, command: str, args: list, cwd: Path, output: JobOutput = None,
+            usage: ProcessUsage = None) -> int:
+        return ProcessSupervisor.call(self.run_async(command, args, cwd, output, usage))
+
+    async def run_async(self, command: str, args: list, cwd: Path, output: JobOutput = None,
+                        usage: ProcessUsage = None) -> int:
+        """ Run a worker command and return it's exit code. Returns -1 if the worker did not answer.
+            The resource usage of the request is measured as difference of the worker process counters.
+        """
+        if usage is not None:
+            cpu_start, io_start = read_proc_cpu(self.pid), read_proc_io(self.pid)
+            reset_peak_rss(self.pid)
+
+        exitcode = await self._run(command, args, cwd, output)
+
+        if usage is not None:
+            cpu_end = read_proc_cpu(self.pid)
+            if cpu_start and cpu_end:
+                usage.cpu_user = round(cpu_end[0] - cpu_start[0], 3)
+                usage.cpu_system = round(cpu_end[1] - cpu_start[1], 3)
+            usage.max_rss_kb = read_peak_rss(self.pid)
+            usage.set_io(io_start, read_proc_io(self.pid))
+            usage.stop(exitcode)
+
+        return exitcode
+
+    async def _run(self, command: str, args: list, cwd: Path, output: JobOutput = None) -> int:
+        request = {'id': uuid.uuid4().hex, 'cmd': command, 'args': [str(a) for a in args],
+                   'cwd': Path(cwd).as_posix()}
+
+        try:
+            self.process.stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+        except (OSError, ValueError) as e:
+            _logger.error('Could not send request to converter worker: %s', e)
+            return -1
+
+        self.last_error = None
+        result = await self._read_result(output)
+        if not result or result.get('id') != request['id']:
+            _logger.error('Converter worker %s did not answer request: %s', self.pid, command)
+            return -1
+
+        if command != 'ping':
+            self.jobs_done += 1
+
+        self.last_error = result.get('error')
+        return int(result.get('exitcode', -1))
+
+    async def _read_result(self, output: Union[None, JobOutput]) -> Union[None, dict]:
+        """ Forward worker output until the worker reports a result """
+        buffer, self._pending = self._pending, b''
+
+        while True:
+            start = buffer.find(_marker)
+            end = buffer.find(b'\n', start) if start >= 0 else -1
+
+            if end >= 0:
+                self._forward(buffer[:start], output)
+                self._pending = buffer[end + 1:]
+                try:
+                    return json.loads(buffer[start + len(_marker):end].decode('utf-8'))
+                except ValueError:
+                    return None
+
+            if start < 0:
+                # Forward complete lines, a partial line may be the start of the result marker
+                line_end = buffer.rfind(b'\n')
+                if line_end >= 0:
+                    self._forward(buffer[:line_end + 1], output)
+                    buffer = buffer[line_end + 1:]
+
+            chunk = await read_chunk(self._reader, self.process.stdout)
+            if not chunk:
+                break
+            buffer += chunk
+
+        # Stdout closed, the worker died
+        self._forward(buffer, output)
+        return None
+
+    @staticmethod
+    def _forward(data: bytes, output: Union[None, JobOutput]):
+        if not data:
+            return
+        if output is not None:
+            output.write(data)
+        else:
+            # Output outside of jobs eg. import warnings during start up
+            for line in data.splitlines():
+                _logger.info('%s', decode_output_line(line))
+
+    def stop(self):
+        """ Close the request pipe and let the worker exit """
+        if not self.is_alive():
+            return
+
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception as e:
+            _logger.debug('Converter worker did not exit: %s', e)
+            self.kill()
+
+    def kill(self):
+        if self.process:
+            try:
+                kill_process_tree(self.process)
+                self.process.wait(timeout=5)
+            except Exception as e:
+                _logger.error(e)
+
+
+class ConverterWorkerPool:
+    """ Hands out warm converter workers and replaces them after max_jobs or when unhealthy """
+    arguments: list = list()
+    cwd: Path = Path('.')
+    env: dict = dict()
+    max_workers = 0
+    max_jobs = 25
+    # Seconds a worker may take to import pxr and usdzconvert and to answer a health check
+    start_timeout = 120.0
+    ping_timeout = 10.0
+
+    # Give up on warm workers after this number of consecutive start failures
+    max_start_failures = 3
+
+    _idle: List[ConverterWorker] = list()
+    _worker_count = 0
+    _start_failures = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, arguments: list, cwd: Path, env: dict, max_workers: int, max_jobs: int,
+                  start_timeout: float = 120.0, ping_timeout: float = 10.0):
+        with cls._lock:
+            cls.arguments, cls.cwd, cls.env = arguments, cwd, env
+            cls.max_workers, cls.max_jobs = max_workers, max(1, max_jobs)
+            cls.start_timeout, cls.ping_timeout = start_timeout, ping_timeout
+            cls._start_failures = 0
+
+        _logger.info('Configured warm converter pool with %s workers, recycling after %s jobs.',
+                     max_workers, cls.max_jobs)
+
+    @classmethod
+    def acquire(cls) -> Union[None, ConverterWorker]:
+        """ Return a healthy worker or None if no worker is available """
+        while True:
+            with cls._lock:
+                if cls._start_failures >= cls.max_start_failures:
+                    return None
+
+                worker = cls._idle.pop() if cls._idle else None
+
+                if worker is None:
+                    if cls._worker_count >= cls.max_workers:
+                        return None
+                    cls._worker_count += 1
+
+            if worker is not None:
+                if worker.ping(cls.ping_timeout):
+                    return worker
+
+                _logger.info('Discarding unhealthy converter worker %s', worker.pid)
+                cls._discard(worker)
+                continue
+
+            return cls._start_worker()
+
+    @classmethod
+    def _start_worker(cls) -> Union[None, ConverterWorker]:
+        worker = ConverterWorker(cls.arguments, cls.cwd, cls.env)
+        if worker.start(cls.start_timeout):
+            cls._start_failures = 0
+            return worker
+
+        with cls._lock:
+            cls._worker_count -= 1
+            cls._start_failures += 1
+            if cls._start_failures >= cls.max_start_failures:
+                _logger.error('Warm converter workers failed to start %s times. Falling back to a new '
+                              'interpreter per job.', cls._start_failures)
+
+    @classmethod
+    def release(cls, worker: ConverterWorker, healthy: bool = True):
+        if not healthy or not worker.is_alive() or worker.jobs_done >= cls.max_jobs:
+            _logger.info('Recycling converter worker %s after %s jobs.', worker.pid, worker.jobs_done)
+            cls._discard(worker)
+            return
+
+        with cls._lock:
+            cls._idle.append(worker)
+
+    @classmethod
+    def _discard(cls, worker: ConverterWorker):
+        worker.stop()
+        with cls._lock:
+            cls._worker_count -= 1
+
+    @classmethod
+    def shutdown(cls):
+        with cls._lock:
+            idle, cls._idle = cls._idle, list()
+
+        for worker in idle:
+            cls._discard(worker)
+
+
+atexit.register(ConverterWorkerPool.shutdown)
+
+
+class WarmRunProcess(RunProcess):
+    """ Run a command in a warm converter worker. Starts a new interpreter if no worker is available. """
+    def __init__(self, command: str, worker_args: list, args, cwd: Path,
+                 env: dict = None, identifier: int = 0,
+                 finished_callback=None, failed_callback=None, status_callback=None,
+                 usage_callback=None, stage: str = '', timeout: float = 0, log_file: Path = None,
+                 limits: ProcessLimits = None):
+        super(WarmRunProcess, self).__init__(args, cwd, env, identifier,
+                                             finished_callback, failed_callback, status_callback,
+                                             usage_callback, stage or command, timeout, log_file, limits)
+        self.command = command
+        self.worker_args = worker_args
+        self.worker: Union[None, ConverterWorker] = None
+
+    async def _start_process(self) -> bool:
+        # Acquiring may start or health check a worker, which waits for the loop
+        self.worker = await ProcessSupervisor.run_blocking(ConverterWorkerPool.acquire)
+        if self.worker is None:
+            _logger.info('No warm converter worker available. Starting a new interpreter.')
+            return await super(WarmRunProcess, self)._start_process()
+
+        _logger.info('Running %s in warm converter worker %s', self.command, self.worker.pid)
+        if self.limits:
+            self.limits.apply(self.worker.pid)
+        self.usage = ProcessUsage(self.usage.stage)
+        return True
+
+    async def _wait_process(self):
+        """ Forwards worker output until the command finished """
+        if self.worker is None:
+            return await super(WarmRunProcess, self)._wait_process()
+
+        self.process_exitcode = await self.worker.run_async(self.command, self.worker_args, self.cwd,
+                                                            self.output, self.usage)
+        if self.process_exitcode == -1:
+            # The worker died without an answer eg. SIGKILL of the kernel at the cgroup memory limit
+            self.process_exitcode = await ProcessSupervisor.run_blocking(self.worker.exitcode, 2) or -1
+        _logger.info('Converter worker %s returned exitcode %s', self.worker.pid, self.process_exitcode)
+        self.memory_error = self.worker.last_error == 'memory'
+
+        # Interpreter state after a failed conversion is unknown, do not re-use the worker
+        await ProcessSupervisor.run_blocking(ConverterWorkerPool.release, self.worker, self.process_exitcode == 0)
+
+    def kill_process(self):
+        if self.worker:
+            _logger.info('Attempting to kill converter worker %s', self.worker.pid)
+            self.worker.kill()
+
+        super(WarmRunProcess, self).kill_process()
@@ -1,12 +1,18 @@
 import os
+import re
 import sys
 import subprocess as sp
 import threading
 import locale
+import asyncio
 from pathlib import Path
 from typing import Union, Iterable
 
 from modules.log import setup_logger
+from modules.job_output import JobOutput
+from modules.process_limits import ProcessLimits
+from modules.process_supervisor import ProcessSupervisor, kill_process_tree, read_chunks, wait_process_async
+from modules.process_usage import ProcessUsage
 
 _logger = setup_logger(__name__)
 
@@ -18,34 +24,56 @@ HIGH_PRIORITY_CLASS = 0x00000080
 IDLE_PRIORITY_CLASS = 0x00000040
 NORMAL_PRIORITY_CLASS = 0x00000020
 REALTIME_PRIORITY_CLASS = 0x00000100
+CREATE_NEW_PROCESS_GROUP = 0x00000200
 
+# Output of processes that ran out of memory eg. at the RLIMIT_AS address space limit
+MEMORY_ERROR_PATTERN = re.compile(r'MemoryError|std::bad_alloc|Cannot allocate memory|out of memory', re.IGNORECASE)
+# Bytes of the output tail searched for memory errors
+MEMORY_ERROR_TAIL = 4096
 
-def create_piped_process(arguments: Union[str, Iterable], current_working_directory: Path, env=None):
+
+def create_piped_process(arguments: Union[str, Iterable], current_working_directory: Path, env=None, stdin=None,
+                         preexec_fn=None):
     _logger.debug('Running command line with arguments:\n%s\nIn cwd: %s', arguments, current_working_directory)
 
     my_env = dict()
     my_env.update(os.environ)
     my_env.update(env or dict())
 
+    # Popen attached to the supervisor loop by connect_read_pipe and a pidfd instead of
+    # asyncio.create_subprocess_exec: the asyncio child watcher reaps exited children itself, the
+    # resource usage of wait4 would be lost. The same Popen object also serves the blocking fallback of
+    # Windows, where the loop can not read the anonymous pipes, and the kill and shutdown of process groups.
+
+    # Run every process in it's own process group so the whole tree eg. usdzip grandchildren can be killed
     if sys.platform == 'win32':
         process = sp.Popen(arguments, cwd=current_working_directory.as_posix(),
-                           env=my_env, stdout=sp.PIPE, stderr=sp.STDOUT,
-                           creationflags=IDLE_PRIORITY_CLASS)
+                           env=my_env, stdin=stdin, stdout=sp.PIPE, stderr=sp.STDOUT,
+                           creationflags=IDLE_PRIORITY_CLASS | CREATE_NEW_PROCESS_GROUP)
     else:
         process = sp.Popen(arguments, cwd=current_working_directory.as_posix(),
-                           env=my_env, stdout=sp.PIPE, stderr=sp.STDOUT)
+                           env=my_env, stdin=stdin, stdout=sp.PIPE, stderr=sp.STDOUT,
+                           start_new_session=True, preexec_fn=preexec_fn)
 
+    # Detached groups do not receive Ctrl-C of the server, they are killed by the supervisor on shutdown
+    ProcessSupervisor.track(process)
     return process
 
 
+def decode_output_line(line: bytes) -> Union[bytes, str]:
+    try:
+        line = line.decode(encoding=_encoding)
+        line = line.replace('\n', '').replace('\r', '')
+    except Exception as e:
+        _logger.error('Error decoding process output: %s', e)
+
+    return line
+
+
 def log_subprocess_output(pipe, message_callback):
     """ Redirect subprocess output to logging so it appears in console and log file """
     for line in iter(pipe.readline, b''):
-        try:
-            line = line.decode(encoding=_encoding)
-            line = line.replace('\n', '')
-        except Exception as e:
-            _logger.error('Error decoding process output: %s', e)
+        line = decode_output_line(line)
 
         if line:
             _logger.info('%s', line)
@@ -54,23 +82,44 @@ def log_subprocess_output(pipe, message_callback):
                 message_callback(line)
 
 
-class RunProcess(threading.Thread):
+class RunProcess:
+    """ Runs a process supervised by the ProcessSupervisor event loop. Output is forwarded to the status
+        callback from the loop, finished and failed callbacks run in the supervisor callback threads.
+    """
+    timeout_message = 'Process exceeded its time limit and was killed.'
+    memory_message = 'Process exceeded its memory limit.'
+
     def __init__(self, args, cwd: Path,
                  # optional OS enironment
                  env: dict = None,
-                 # Thread id reported with callbacks
+                 # Job id reported with callbacks
                  identifier: int = 0,
                  # Callbacks
-                 finished_callback=None, failed_callback=None, status_callback=None):
-        super(RunProcess, self).__init__()
-
+                 finished_callback=None, failed_callback=None, status_callback=None,
+                 # Reports resource usage of the stage before the finished or failed callback
+                 usage_callback=None, stage: str = 'process',
+                 # Seconds until the process tree gets killed, 0 to run without limit
+                 timeout: float = 0,
+                 # Complete process output is appended to this file, only marked lines reach the status callback
+                 log_file: Path = None,
+                 # Linux nice, ionice, cpu affinity and memory limits
+                 limits: ProcessLimits = None):
         self.args = args
         self.cwd: Path = cwd
         self.env = env or dict()
         self.identifier = identifier
+        self.usage = ProcessUsage(stage)
+        self.timeout = timeout
+        self.timed_out = False
+        self.limits = limits
+        # Set by warm workers that reported a MemoryError
+        self.memory_error = False
+        # Aborted processes report neither success nor failure
+        self.aborted = False
 
         # -- Prepare callbacks
         self.finished_callback = self.failed_callback = self.status_callback = self._dummy_callback
+        self.usage_callback = usage_callback
 
         if finished_callback:
             self.finished_callback = finished_callback
@@ -82,8 +131,13 @@ class RunProcess(threading.Thread):
         # Prepare workers
         self.process = None
         self.process_exitcode = -1
+        self.log_file = log_file
+        self.output: Union[None, JobOutput] = None
 
+        # Set once the process ended and the callbacks were dispatched
         self.event = threading.Event()
+        self._running = False
+        self._report = None
 
     @staticmethod
     def _dummy_callback(*args, **kwargs):
@@ -92,58 +146,147 @@ class RunProcess(threading.Thread):
     def process_log_callback(self, message: str):
         self.status_callback(self.identifier, message)
 
-    def run(self):
-        # Reset thread event
-        self.event.clear()
+    def start(self):
+        self._running = True
+        ProcessSupervisor.submit(self._supervise())
+
+    def is_alive(self) -> bool:
+        return self._running
 
-        # Run in own thread to keep parent thread ready for abort signals
-        if not self._start_process():
-            self.failed_callback(self.identifier, 'Process could not be started.')
+    def join(self, timeout: float = None) -> bool:
+        return self.event.wait(timeout)
+
+    async def _supervise(self):
+        self.output = JobOutput.open(self.identifier, self.log_file, self.process_log_callback)
+
+        try:
+            await self._run()
+        except Exception as e:
+            _logger.error('Supervising process %s failed: %s', self.identifier, e, exc_info=1)
+            self.kill_process()
+            self._dispatch(self.failed_callback, 'Process returned with error code.')
+        finally:
+            # Callbacks may read the log file of the job
+            self.output.close()
+            if self._report is not None:
+                ProcessSupervisor.dispatch(self._report)
+            self._running = False
+            self.event.set()
+
+    async def _run(self):
+        # The time limit includes the start eg. waiting for a warm converter worker to start up
+        deadline = asyncio.get_running_loop().time() + self.timeout if self.timeout > 0 else None
+
+        start_task = asyncio.ensure_future(self._start_process())
+        if not await self._wait_until(start_task, deadline):
+            await ProcessSupervisor.run_blocking(self.timeout_kill)
+
+        if not await start_task:
+            self._dispatch(self.failed_callback,
+                           self.timeout_message if self.timed_out else 'Process could not be started.')
+            return
+
+        # Abort requested or time limit exceeded while the process was starting
+        if self.aborted or self.timed_out:
+            self.kill_process()
+
+        # Wait until process finished, killed or timed out
+        process_task = asyncio.ensure_future(self._wait_process())
+        if not await self._wait_until(process_task, deadline):
+            await ProcessSupervisor.run_blocking(self.timeout_kill)
+        await process_task
+
+        if self.aborted:
+            _logger.info('Process %s aborted.', self.identifier)
+            self._dispatch(None)
+            return
+
+        if self.timed_out:
+            self._dispatch(self.failed_callback, self.timeout_message)
             return
 
-        # Wait until process finished or aborted
-        while not self.event.is_set():
-            self.event.wait()
+        if self.memory_exceeded():
+            self._dispatch(self.failed_callback, self.memory_message)
+            return
 
         # Process result unsuccessful
         if self.process_exitcode != 0:
-            self.failed_callback(self.identifier, 'Process returned with error code.')
+            self._dispatch(self.failed_callback, 'Process returned with error code.')
             return
 
         # Exit successfully
-        self.finished_callback(self.identifier)
+        self._dispatch(self.finished_callback)
 
-    def _start_process(self):
+    @staticmethod
+    async def _wait_until(task, deadline: Union[None, float]) -> bool:
+        """ Wait for a task until the loop time deadline, returns False if the task did not finish """
+        timeout = None if deadline is None else max(0.0, deadline - asyncio.get_running_loop().time())
+        done, _ = await asyncio.wait({task}, timeout=timeout)
+        return bool(done)
+
+    def memory_exceeded(self) -> bool:
+        """ Process failed with a memory limit in place. The kernel kills the process group at the cgroup
+            limit, at the RLIMIT_AS limit allocations fail and the converter exits with a MemoryError.
+        """
+        if self.process_exitcode == 0 or not self.limits or not self.limits.memory_mb:
+            return False
+        if self.process_exitcode == -9 or self.memory_error:
+            return True
+        return self.output is not None and bool(MEMORY_ERROR_PATTERN.search(self.output.tail(MEMORY_ERROR_TAIL)))
+
+    def _dispatch(self, callback, *args):
+        """ Report resource usage followed by the result callback in the same callback thread
+            once the process output was closed
+        """
+        def report():
+            if self.usage_callback and self.usage.exitcode is not None:
+                self.usage_callback(self.identifier, self.usage.as_dict())
+            if callback is not None:
+                callback(self.identifier, *args)
+
+        self._report = report
+
+    async def _start_process(self) -> bool:
         """ Start process and log to file and stdout """
         try:
-            self.process = create_piped_process(self.args, self.cwd, self.env)
+            self.usage = ProcessUsage(self.usage.stage)
+            # Limits are in place before exec, nothing runs unlimited and children inherit them
+            self.process = create_piped_process(self.args, self.cwd, self.env,
+                                                preexec_fn=self.limits.preexec() if self.limits else None)
             _logger.info('Process started.')
         except Exception as e:
             _logger.error(e, exc_info=1)
             return False
 
-        # Log STDOUT in own thread to keep parent thread ready for abort signals
-        log_thread = threading.Thread(target=self._process_log_loop)
-        log_thread.start()
         return True
 
-    def _process_log_loop(self):
-        """ Reads and writes process stdout to log until process ends """
-        with self.process.stdout:
-            log_subprocess_output(self.process.stdout, self.process_log_callback)
+    async def _wait_process(self):
+        """ Forward process stdout to the job output until the process ends and collect it's exit code """
+        async for chunk in read_chunks(self.process.stdout):
+            self.output.write(chunk)
 
         _logger.info('Process stdout stream ended. Fetching exitcode.')
-        self.process_exitcode = self.process.wait()
-        _logger.info('Process ended with exitcode %s', self.process_exitcode)
-
-        # Wake up parent thread
-        self.event.set()
+        self.process_exitcode = await wait_process_async(self.process, self.usage)
+        _logger.info('Process ended with exitcode %s after %.1fs', self.process_exitcode, self.usage.wall_seconds)
 
     def kill_process(self):
         if self.process:
             try:
                 _logger.info('Attempting to kill process.')
-                self.process.kill()
+                kill_process_tree(self.process)
                 _logger.info('Process killed.')
             except Exception as e:
                 _logger.error(e)
+
+    def abort(self):
+        """ Kill the process tree without calling the finished or failed callback """
+        self.aborted = True
+        self.kill_process()
+
+    def timeout_kill(self):
+        """ Called once the process exceeded it's timeout """
+        self.timed_out = True
+        message = f'{self.usage.stage} exceeded the time limit of {self.timeout:.0f}s. Killing process tree.'
+        _logger.error('Process %s: %s', self.identifier, message)
+        self.output.message(message)
+        self.kill_process()
@@ -0,0 +1,104 @@
+import sqlite3
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from modules.log import setup_logger
+from modules.metrics import Gauge, Metrics, db_commit, db_locked, db_pool_wait
+
+_logger = setup_logger(__name__)
+
+
+class TimedQueuePool(QueuePool):
+    """ Connection pool recording the time a session waits for a connection """
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            db_pool_wait.observe(time.monotonic() - start)
+
+
+def engine_options(config) -> dict:
+    """ Engine options of a file based SQLite database shared by the waitress and process callback threads.
+        Flask-SQLAlchemy would open a new connection for every session otherwise.
+    """
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or dict())
+    uri = config.get('SQLALCHEMY_DATABASE_URI') or ''
+    if not uri.startswith('sqlite') or uri.rstrip('/').endswith((':memory:', 'sqlite:')):
+        return options
+
+    options.setdefault('poolclass', TimedQueuePool)
+    options.setdefault('pool_size', int(config.get('DB_POOL_SIZE', 12)))
+    options.setdefault('max_overflow', int(config.get('DB_POOL_OVERFLOW', 8)))
+    options.setdefault('pool_timeout', float(config.get('DB_POOL_TIMEOUT', 30)))
+
+    connect_args = options.setdefault('connect_args', dict())
+    # Pooled connections are handed between threads, but only used by one thread at a time
+    connect_args.setdefault('check_same_thread', False)
+    # Writers wait for the database lock instead of failing with "database is locked"
+    connect_args.setdefault('timeout', float(config.get('SQLITE_BUSY_TIMEOUT', 30)))
+    return options
+
+
+def instrument_database(db, config):
+    """ Set SQLite journaling on every new connection and record commit latency and lock errors """
+    journal_mode = config.get('SQLITE_JOURNAL_MODE')
+    synchronous = config.get('SQLITE_SYNCHRONOUS')
+    slow_commit = float(config.get('DB_SLOW_COMMIT_SECONDS', 1.0))
+
+    @event.listens_for(Engine, 'connect')
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+
+        cursor = dbapi_connection.cursor()
+        try:
+            if journal_mode:
+                cursor.execute(f'PRAGMA journal_mode={journal_mode}')
+                mode = cursor.fetchone()
+                if mode and mode[0].lower() != journal_mode.lower():
+                    _logger.warning('SQLite journal mode %s requested but database uses %s', journal_mode, mode[0])
+            if synchronous:
+                cursor.execute(f'PRAGMA synchronous={synchronous}')
+        finally:
+            cursor.close()
+
+    @event.listens_for(Engine, 'handle_error')
+    def _count_lock_errors(context):
+        if isinstance(context.original_exception, sqlite3.OperationalError) \
+                and 'locked' in str(context.original_exception):
+            db_locked.inc()
+            _logger.warning('Database stayed locked: %s', context.original_exception)
+
+    def _observe_commit(session):
+        started = session.info.pop('commit_started', None)
+        if started is None:
+            return
+
+        seconds = time.monotonic() - started
+        db_commit.observe(seconds)
+        if seconds > slow_commit:
+            _logger.warning('Database commit took %.2fs', seconds)
+
+    @event.listens_for(db.session, 'before_commit')
+    def _start_commit_timer(session):
+        session.info['commit_started'] = time.monotonic()
+
+    @event.listens_for(db.session, 'after_commit')
+    def _stop_commit_timer(session):
+        _observe_commit(session)
+
+    @event.listens_for(db.session, 'after_rollback')
+    def _stop_failed_commit_timer(session):
+        _observe_commit(session)
+
+    def _connections_in_use():
+        # The engine is re-created if the database uri changes, read the pool of the current one
+        pool = db.engine.pool
+        return {tuple(): pool.checkedout()} if isinstance(pool, QueuePool) else dict()
+
+    Metrics.register(Gauge('usdz_db_connections_in_use', 'Pooled database connections checked out.',
+                           collect=_connections_in_use))
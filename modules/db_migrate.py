@@ -0,0 +1,120 @@
+import io
+import json
+import os
+import pickle
+from pathlib import PurePosixPath, PureWindowsPath
+
+from sqlalchemy import inspect
+
+from modules.log import setup_logger
+
+_logger = setup_logger(__name__)
+
+
+def upgrade_schema(db) -> bool:
+    """ Add columns and indexes of the current models that are missing in an existing database.
+        db.create_all only creates missing tables, it will not alter tables of earlier app versions.
+    """
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    result = True
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            try:
+                db.engine.execute(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+                _logger.info('Added column %s %s to table %s', column.name, column_type, table.name)
+            except Exception as e:
+                _logger.error('Could not add column %s to table %s: %s', column.name, table.name, e)
+                result = False
+
+        existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+
+            try:
+                index.create(bind=db.engine)
+                _logger.info('Created index %s on table %s', index.name, table.name)
+            except Exception as e:
+                _logger.error('Could not create index %s on table %s: %s', index.name, table.name, e)
+                result = False
+
+    return result
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """ Job files of earlier app versions were pickled dicts of pathlib paths, other classes are refused """
+    def find_class(self, module, name):
+        if module == 'pathlib' and name in ('PosixPath', 'PurePosixPath', 'Path'):
+            return PurePosixPath
+        if module == 'pathlib' and name in ('WindowsPath', 'PureWindowsPath'):
+            return PureWindowsPath
+        raise pickle.UnpicklingError(f'Refusing to load {module}.{name} from a pickled job column')
+
+
+def _unpickle(value):
+    if value is None or not isinstance(value, bytes):
+        return value
+    return _LegacyUnpickler(io.BytesIO(value)).load()
+
+
+def migrate_pickled_jobs(db) -> bool:
+    """ Move the pickled files of jobs created by earlier app versions into the job_files table and
+        re-write their pickled options as JSON. The pickled files column is dropped afterwards.
+    """
+    inspector = inspect(db.engine)
+    if 'jobs' not in inspector.get_table_names():
+        return True
+
+    if 'files' not in {c['name'] for c in inspector.get_columns('jobs')}:
+        return True
+
+    job_files = db.metadata.tables['job_files']
+    migrated, failed = 0, 0
+
+    with db.engine.begin() as connection:
+        rows = connection.execute('SELECT job_id, files, option_args FROM jobs WHERE files IS NOT NULL').fetchall()
+
+        for job_id, files, option_args in rows:
+            try:
+                files, option_args = _unpickle(files) or dict(), _unpickle(option_args)
+            except Exception as e:
+                _logger.error('Could not read pickled files of job %s: %s', job_id, e)
+                files, option_args, failed = dict(), list(), failed + 1
+
+            entries = list()
+            for role, entry in files.items():
+                file_path = entry.get('file_path')
+                path = str(file_path) if file_path is not None else None
+                size = os.stat(path).st_size if path and os.path.isfile(path) else None
+                attributes = {k: v for k, v in entry.items() if k != 'file_path'}
+                entries.append({'job_id': job_id, 'role': role, 'path': path, 'size': size, 'digest': None,
+                                'attributes': attributes})
+
+            if entries:
+                connection.execute(job_files.insert(), entries)
+            connection.execute('UPDATE jobs SET files = NULL, option_args = ? WHERE job_id = ?',
+                               json.dumps(list(option_args or list())), job_id)
+            migrated += 1
+
+    _logger.info('Migrated the pickled files of %s jobs to the job_files table, %s could not be read.',
+                 migrated, failed)
+
+    try:
+        db.engine.execute('ALTER TABLE jobs DROP COLUMN files')
+    except Exception as e:
+        # SQLite before 3.35 can not drop columns, the emptied column remains unused
+        _logger.info('Could not drop the pickled files column: %s', e)
+
+    return not failed
@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple, Union
+
+from modules import filesize
+from modules.app import App, db
+from modules.log import setup_logger
+from modules.site import Urls
+
+_logger = setup_logger(__name__)
+
+
+class DownloadEntry(db.Model):
+    __tablename__ = 'downloads'
+
+    folder_id = db.Column(db.String(255), primary_key=True)
+    name = db.Column(db.String(255))
+    preview_name = db.Column(db.String(255))
+    size = db.Column(db.Integer)
+    created = db.Column(db.Float, index=True)
+    folder_mtime = db.Column(db.Float)
+
+    def __init__(self, folder_id: str):
+        self.folder_id = folder_id
+        self.name = str()
+        self.preview_name = str()
+        self.size = 0
+        self.created = time.time()
+        self.folder_mtime = 0.0
+
+    def as_dict(self) -> dict:
+        """ Download entry as used by the download and share templates """
+        preview_url = f'{Urls.downloads}/{self.folder_id}/{self.preview_name}' if self.preview_name else ''
+
+        return {'url': f'{Urls.downloads}/{self.folder_id}/{self.name}', 'preview_img': preview_url,
+                'name': self.name, 'size': filesize.size(self.size or 0, system=filesize.alternative),
+                'created': datetime.fromtimestamp(self.created).strftime('%d.%m.%Y %H:%M:%S')}
+
+
+class DownloadIndex:
+    """ Persistent index of the result files in DOWNLOAD_FOLDER. FileManager updates single folders when files
+        are moved or deleted, changes made outside the app are picked up by an mtime based reconciliation.
+    """
+    _last_reconcile = 0.0
+    # Called with the ids of removed download folders before the removal is committed
+    _remove_callbacks: List[Callable[[List[str]], None]] = list()
+    _reconcile_thread: Union[None, threading.Thread] = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def on_remove(cls, callback: Callable[[List[str]], None]):
+        cls._remove_callbacks.append(callback)
+
+    @classmethod
+    def _removed(cls, folder_ids: List[str]):
+        if not folder_ids:
+            return
+        for callback in cls._remove_callbacks:
+            callback(folder_ids)
+
+    @staticmethod
+    def download_folder() -> Path:
+        return Path(App.config.get('DOWNLOAD_FOLDER'))
+
+    @staticmethod
+    def _scan_folder(folder: Path) -> Tuple[str, str, int]:
+        """ Locate the result file and preview image of a download folder. Returns name, preview name, size. """
+        for file in folder.glob('*.*'):
+            if file.suffix.replace('.', '') not in App.config.get('UPLOAD_ALLOWED_SCENE'):
+                continue
+
+            preview_file = file.with_suffix(App.config.get('PREVIEW_IMG_SUFFIX'))
+            try:
+                size = file.stat().st_size
+            except OSError as e:
+                _logger.error('Could not access file size: %s', e)
+                size = 0
+
+            return file.name, preview_file.name if preview_file.exists() else str(), size
+
+        return str(), str(), 0
+
+    @classmethod
+    def update_folder(cls, folder_id: str, commit: bool = True):
+        """ Re-index a single download folder, removes the entry if the folder holds no result file """
+        folder = cls.download_folder() / folder_id
+        entry = DownloadEntry.query.get(folder_id)
+
+        name, preview_name, size = cls._scan_folder(folder) if folder.is_dir() else (str(), str(), 0)
+
+        if not name:
+            if entry is not None:
+                db.session.delete(entry)
+                cls._removed([folder_id])
+        else:
+            if entry is None:
+                entry = DownloadEntry(folder_id)
+                try:
+                    entry.created = folder.stat().st_mtime
+                except OSError:
+                    pass
+                db.session.add(entry)
+
+            entry.name, entry.preview_name, entry.size = name, preview_name, size
+            try:
+                entry.folder_mtime = folder.stat().st_mtime
+            except OSError:
+                pass
+
+        if commit:
+            db.session.commit()
+
+    @classmethod
+    def remove(cls, folder_id: str):
+        DownloadEntry.query.filter(DownloadEntry.folder_id == folder_id).delete()
+        cls._removed([folder_id])
+        db.session.commit()
+
+    @staticmethod
+    def get(folder_id: str) -> Union[None, dict]:
+        entry = DownloadEntry.query.get(folder_id)
+        if entry is not None:
+            return entry.as_dict()
+
+    @staticmethod
+    def get_page(page: int = 1, per_page: int = 50) -> Tuple[List[Tuple[str, dict]], int]:
+        """ Return a page of download entries, newest first, and the total number of entries """
+        total = db.session.query(db.func.count(DownloadEntry.folder_id)).scalar() or 0
+        entries = DownloadEntry.query.order_by(DownloadEntry.created.desc(), DownloadEntry.folder_id
+                                               ).offset(max(0, page - 1) * per_page).limit(per_page).all()
+
+        return [(e.folder_id, e.as_dict()) for e in entries], total
+
+    @classmethod
+    def reconcile(cls):
+        """ Compare folder modification times against the index and re-index changed, new or removed folders """
+        indexed: Dict[str, float] = dict(db.session.query(DownloadEntry.folder_id, DownloadEntry.folder_mtime).all())
+        seen, updated = set(), 0
+
+        try:
+            folders = [f for f in os.scandir(cls.download_folder().as_posix()) if f.is_dir()]
+        except OSError as e:
+            _logger.error('Could not scan download folder: %s', e)
+            return
+
+        for folder in folders:
+            seen.add(folder.name)
+            try:
+                mtime = folder.stat().st_mtime
+            except OSError:
+                continue
+
+            if indexed.get(folder.name) != mtime:
+                cls.update_folder(folder.name, commit=False)
+                updated += 1
+
+        removed = [folder_id for folder_id in indexed if folder_id not in seen]
+        for folder_id in removed:
+            DownloadEntry.query.filter(DownloadEntry.folder_id == folder_id).delete()
+        cls._removed(removed)
+
+        db.session.commit()
+        cls._last_reconcile = time.monotonic()
+
+        if updated or removed:
+            _logger.info('Reconciled download index: %s updated, %s removed.', updated, len(removed))
+
+    @classmethod
+    def _reconcile_in_context(cls):
+        with App.app_context():
+            cls.reconcile()
+
+    @classmethod
+    def reconcile_if_due(cls):
+        """ Start a background reconciliation if the last one is older than DOWNLOAD_INDEX_RECONCILE_SECONDS """
+        interval = App.config.get('DOWNLOAD_INDEX_RECONCILE_SECONDS', 300)
+
+        with cls._lock:
+            if time.monotonic() - cls._last_reconcile < interval and cls._last_reconcile:
+                return
+            if cls._reconcile_thread is not None and cls._reconcile_thread.is_alive():
+                return
+
+            cls._last_reconcile = time.monotonic()
+            cls._reconcile_thread = threading.Thread(target=cls._reconcile_in_context, daemon=True)
+            cls._reconcile_thread.start()
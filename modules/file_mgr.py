@@ -1,6 +1,5 @@
 import shutil
 import time
-from datetime import datetime
 from pathlib import Path
 from shutil import copy, rmtree
 from typing import Dict, Tuple, Union
@@ -9,10 +8,11 @@ from flask import render_template, current_app
 from werkzeug.datastructures import ImmutableMultiDict
 from werkzeug.utils import secure_filename
 
-from modules import filesize
+from modules.download_index import DownloadIndex
 from modules.ftp import FtpRemote
 from modules.globals import APP_NAME, get_current_modules_dir
 from modules.log import setup_logger
+from modules.metrics import share_failures
 from modules.settings import JsonConfig
 from modules.site import JobFormFields, Urls
 
@@ -21,10 +21,13 @@ _logger = setup_logger(__name__)
 
 class FileManager:
     static_img_dir = Path(get_current_modules_dir()) / APP_NAME / Urls.static_images
+    upload_sessions_dir = '.uploads'
 
     def __init__(self):
         self.job_dir = None
         self.files = dict()
+        # Size and sha256 of files that were hashed while they were uploaded
+        self.digests: Dict[Path, Tuple[int, str]] = dict()
         self.out_suffix = '.usdz'
 
     @classmethod
@@ -34,12 +37,14 @@ class FileManager:
         download_dir = current_app.config.get('DOWNLOAD_FOLDER') / folder_id
         if not download_dir.exists():
             _logger.error('File to share not found at: %s', download_dir.as_posix())
+            share_failures.inc(1, 'missing_download')
             return False
 
         # -- Clear and create share sub-directory --
         share_dir = download_dir / 'share'
         if not cls.clear_folder(share_dir, re_create=True):
             _logger.error('Could not create share folder at: %s', share_dir.as_posix())
+            share_failures.inc(1, 'share_folder')
             return False
 
         # -- Save preview image file in share folder --
@@ -62,6 +67,7 @@ class FileManager:
             copy(in_scene_file, scene_path)
         except Exception as e:
             _logger.error('Could not save USDZ output file: %s', e)
+            share_failures.inc(1, 'copy')
             return False
 
         # -- Create index html file --
@@ -80,13 +86,16 @@ class FileManager:
         conf = JsonConfig.load_config(current_app.config.get('SHARE_HOST_CONFIG_PATH'))
         remote = FtpRemote(conf)
         if not remote.connect():
+            share_failures.inc(1, 'connect')
             return False
         if not remote.create_dir(form.get('share_folder')):
+            share_failures.inc(1, 'remote_dir')
             return False
 
         # Upload files
         for local_file in (index_html_path, scene_path, img_path):
             if not remote.put(local_file):
+                share_failures.inc(1, 'transfer')
                 return False
 
         # Clean up share directory
@@ -99,6 +108,7 @@ class FileManager:
         upload_dir: Path = current_app.config.get('UPLOAD_FOLDER')
         _logger.debug('CLeaning upload folder: %s', upload_dir.as_posix())
         active_job_dirs = [j.job_dir() for j in jobs if not j.completed]
+        upload_expiry = current_app.config.get('CHUNKED_UPLOAD_EXPIRY', 0)
 
         if active_job_dirs:
             _logger.info('Not touching active jobs dirs during clean-up: %s', active_job_dirs)
@@ -106,10 +116,25 @@ class FileManager:
         success = True
         for p in upload_dir.glob('*'):
             if p not in active_job_dirs:
+                # Keep chunked uploads that can still be resumed
+                if cls._has_pending_uploads(p, upload_expiry):
+                    _logger.info('Not touching resumable upload during clean-up: %s', p.name)
+                    continue
                 success = False if not cls.clear_folder(p, False) else success
 
         return success
 
+    @classmethod
+    def _has_pending_uploads(cls, folder: Path, expiry: float) -> bool:
+        """ Folder contains chunked uploads that were active within expiry seconds """
+        sessions_dir = folder / cls.upload_sessions_dir
+        if not sessions_dir.is_dir():
+            return False
+
+        last_activity = max((f.stat().st_mtime for f in folder.glob('*') if f.is_file()),
+                            default=sessions_dir.stat().st_mtime)
+        return time.time() - last_activity < expiry
+
     @staticmethod
     def clear_folder(folder: Path, re_create: bool = True) -> bool:
         """ Clear all contents of a directory aka deleting and re-creating it. """
@@ -155,6 +180,9 @@ class FileManager:
             _logger.error('Error moving file: %s', e, exc_info=1)
             return
 
+        # Index entry will be committed with the job
+        DownloadIndex.update_folder(job_download_dir.name, commit=False)
+
         return new_file_path
 
     @classmethod
@@ -181,51 +209,12 @@ class FileManager:
             else:
                 _logger.debug('Skipping backup of non existing file: %s', in_file)
 
-    @classmethod
-    def list_downloads(cls) -> Dict[str, Dict]:
-        """ Return contents of download directory:
-            Dict[folder_name(unique)] = Tuple[download_url, file_name, file_size]
-        """
-        download_files: Dict[str, Dict] = dict()
-
-        # Iterate sub directory's
-        for folder in current_app.config.get('DOWNLOAD_FOLDER').glob('*'):
-            for file in folder.glob('*.*'):
-                if file.suffix.replace('.', '') not in current_app.config.get('UPLOAD_ALLOWED_SCENE'):
-                    continue
-
-                # Create file url
-                download_url = f'{Urls.downloads}/{folder.name}/{file.name}'
-
-                # Preview Image Url
-                preview_file = file.with_suffix(current_app.config.get("PREVIEW_IMG_SUFFIX"))
-                if preview_file.exists():
-                    preview_url = f'{Urls.downloads}/{folder.name}/{preview_file.name}'
-                    _logger.debug('Setting download preview img url: %s', preview_url)
-                else:
-                    preview_url = ''
-
-                try:
-                    # File size
-                    size = filesize.size(file.stat().st_size, system=filesize.alternative)
-                    # Created Date from folder modification time
-                    created = datetime.fromtimestamp(folder.stat().st_mtime).strftime('%d.%m.%Y %H:%M:%S')
-                except Exception as e:
-                    _logger.error('Could not access file size: %s', e)
-                    size = 'N/A'
-                    created = 'N/A'
-
-                # Store entry
-                download_files[folder.name] = {'url': download_url, 'preview_img': preview_url,
-                                               'name': file.name, 'size': size, 'created': created}
-
-        return download_files
-
     @classmethod
     def delete_download(cls, folder_id: str) -> bool:
         download_dir = current_app.config.get('DOWNLOAD_FOLDER') / folder_id
 
         if cls.clear_folder(download_dir, re_create=False):
+            DownloadIndex.remove(folder_id)
             return True
 
         return False
@@ -263,6 +252,13 @@ class FileManager:
 
         file_path = self.job_dir / secure_filename(file.filename)
 
+        # File was streamed into the job directory while the request was parsed
+        streamed = getattr(file.stream, 'path', None)
+        if streamed == file_path and hasattr(file.stream, 'sha256'):
+            file.stream.close()
+            self.digests[file_path] = (file.stream.size, file.stream.sha256)
+            return file_path
+
         # File already saved
         if file_path.exists():
             return file_path
@@ -369,14 +365,16 @@ class FileManager:
 
         return msg
 
-    def handle_post_request(self, files: ImmutableMultiDict, form: ImmutableMultiDict) -> Tuple[bool, str]:
+    def handle_post_request(self, files: ImmutableMultiDict, form: ImmutableMultiDict,
+                            job_dir: Path = None) -> Tuple[bool, str]:
         """ Handle POST request and store files in new job directory if valid files found.
 
         :param ImmutableMultiDict files: POST request files dict to handle
         :param ImmutableMultiDict form: POST request form dict
+        :param Path job_dir: optional job directory already containing the files eg. of a chunked upload
         :return: bool, message
         """
-        self.job_dir = self.create_job_dir()
+        self.job_dir = job_dir or self.create_job_dir()
         self.out_suffix = form.get('outSuffix', self.out_suffix)
         if not self._save_scene_files(files):
             return False, 'Scene file not found or not supported.'
@@ -5,6 +5,7 @@ from typing import Union
 
 from paramiko import Transport, SFTPClient
 from modules.log import setup_logger
+from modules.metrics import share_bytes, share_seconds
 
 _logger = setup_logger(__name__)
 
@@ -232,11 +233,19 @@ class FtpRemote:
 
         local_path = Path(local_path)
         ftp_file = local_path.name
+        started = time.monotonic()
 
         if self.is_sftp:
-            return self._put_sftp(local_path, ftp_file)
+            result = self._put_sftp(local_path, ftp_file)
         else:
-            return self._put_ftp(local_path, ftp_file)
+            result = self._put_ftp(local_path, ftp_file)
+
+        if result:
+            protocol = 'sftp' if self.is_sftp else 'ftps' if self.is_ftps else 'ftp'
+            share_bytes.inc(local_path.stat().st_size, protocol)
+            share_seconds.inc(time.monotonic() - started, protocol)
+
+        return result
 
     def _put_ftp(self, local_path: Path, ftp_file: str) -> bool:
         self._temp_total = local_path.stat().st_size
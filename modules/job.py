@@ -1,17 +1,40 @@
+import functools
+import hashlib
+import itertools
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+import weakref
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Iterator, Tuple, Union
+from typing import Dict, Iterator, List, Set, Tuple, Union
 
+from sqlalchemy import event, inspect
 from werkzeug.datastructures import ImmutableMultiDict
-from werkzeug.utils import secure_filename
 
 from modules.app import App, db
+from modules.converter_pool import ConverterWorkerPool, WarmRunProcess
 from modules.create_process import RunProcess
+from modules.download_index import DownloadEntry, DownloadIndex
 from modules.file_mgr import FileManager
 from modules.globals import default_tex_coord_set_names
+from modules.job_cost import JobCostModel
+from modules.job_events import JobEvents
+from modules.job_output import JobOutput
+from modules.job_state import JobStateRegistry
 from modules.log import setup_logger
+from modules.metrics import Gauge, Metrics, job_failures, stage_duration
+from modules.preview_queue import PreviewQueue, PreviewRequest
+from modules.process_limits import ProcessLimits, slot_cpus
+from modules.process_supervisor import ProcessSupervisor
+from modules.process_usage import ProcessUsage, STAGE_CONVERT, STAGE_POST_PROCESS, STAGE_PREVIEW, STAGE_STATIC_MOVE
+from modules.result_cache import ResultCache
 from modules.site import JobFormFields, Urls
 from modules.usdzconvert_args import create_usdzconvert_arguments, usd_env, create_abc_post_process_arguments, \
-    create_usdscript_arguments
+    create_usdscript_arguments, create_converter_worker_arguments
 from modules.utils import get_usdz_color_argument
 
 _logger = setup_logger(__name__)
@@ -25,18 +48,93 @@ Session = orm.scoped_session(session_factory)
 """
 
 
+class JobFile(db.Model):
+    """ A file of a job by role eg. scene_file, out_file, preview or a texture map with it's map settings """
+    __tablename__ = 'job_files'
+    __table_args__ = (db.UniqueConstraint('job_id', 'role'),)
+
+    file_id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('jobs.job_id', ondelete='CASCADE'), index=True, nullable=False)
+    role = db.Column(db.String(64), nullable=False)
+    path = db.Column(db.String(1024))
+    size = db.Column(db.BigInteger)
+    digest = db.Column(db.String(64))
+    # Texture map channel, material, uv set, map type and color
+    attributes = db.Column(db.JSON)
+
+    def __init__(self, role: str):
+        self.role = role
+        self.attributes = dict()
+
+    def entry(self) -> dict:
+        """ File entry as used by the converter arguments """
+        entry = dict(self.attributes or dict())
+        entry['file_path'] = Path(self.path) if self.path is not None else None
+        return entry
+
+    def set_entry(self, entry: dict):
+        file_path = entry.get('file_path')
+        self.set_path(file_path)
+        self.attributes = {k: v for k, v in entry.items() if k != 'file_path'}
+
+    def set_path(self, file_path: Union[None, Path]):
+        if self.path is not None and file_path is not None and Path(self.path) == Path(file_path):
+            return
+        self.path = str(file_path) if file_path is not None else None
+        self.size, self.digest = None, None
+
+    def update_stat(self, create_digest: bool = False):
+        """ Record size and optionally the sha256 digest of an existing file """
+        if not self.path or not Path(self.path).is_file():
+            return
+
+        file = Path(self.path)
+        self.size = file.stat().st_size
+        if create_digest:
+            self.digest = ResultCache.file_digest(file)
+
+
 class ConversionJob(db.Model):
     __tablename__ = 'jobs'
 
     job_id = db.Column(db.Integer, primary_key=True)
-    files = db.Column(db.PickleType)
-    option_args = db.Column(db.PickleType)
+    file_entries = db.relationship(JobFile, order_by=JobFile.file_id, cascade='all, delete-orphan')
+    option_args = db.Column(db.JSON)
     additional_args = db.Column(db.String(120))
-    state = db.Column(db.Integer)
+    state = db.Column(db.Integer, index=True)
     progress = db.Column(db.Integer)
-    completed = db.Column(db.Boolean)
-    process_messages = db.Column(db.String(1000))
+    completed = db.Column(db.Boolean, index=True)
+    # Heavy columns are only loaded on access, listings query their length or skip them
+    process_messages = db.deferred(db.Column(db.String(1000)))
     errors = db.Column(db.String(200))
+    input_digest = db.Column(db.String(64))
+    # Light columns for job listings that do not load the job files
+    folder_id = db.Column(db.String(64), index=True)
+    scene_name = db.Column(db.String(255))
+    file_count = db.Column(db.Integer)
+    # Stored once the result and preview were moved to the download folder, cleared if the download is removed
+    output_name = db.Column(db.String(255))
+    download_url = db.Column(db.String(512))
+    preview_url = db.Column(db.String(512))
+    # Resource usage of every subprocess stage, see ProcessUsage
+    resource_usage = db.deferred(db.Column(db.JSON))
+    # Server process running the job and the time its lease ends unless renewed by a heartbeat, see JobLeases
+    lease_owner = db.Column(db.String(120))
+    lease_expires = db.Column(db.Float)
+    attempts = db.Column(db.Integer)
+    # Pipeline stage to continue with after the job was recovered
+    resume_stage = db.Column(db.String(32))
+    # Scheduling, see JobScheduler
+    submitter = db.Column(db.String(80), index=True)
+    lane = db.Column(db.String(16))
+    priority = db.Column(db.Integer)
+    # Expected and actual cost, see JobCostModel
+    input_bytes = db.Column(db.BigInteger)
+    texture_count = db.Column(db.Integer)
+    estimated_seconds = db.Column(db.Float)
+    duration_seconds = db.Column(db.Float)
+    created = db.Column(db.Float, index=True)
+    started = db.Column(db.Float)
 
     class States:
         queued = 0
@@ -44,14 +142,25 @@ class ConversionJob(db.Model):
         post_processed = 2
         finished = 3
         failed = 4
+        cancelled = 5
+
+    # Metric labels of known error messages
+    failure_reasons = {'Process returned with error code.': 'process_error',
+                       'Process could not be started.': 'process_start',
+                       'Could not move USDZ to static directory.': 'static_move',
+                       RunProcess.timeout_message: 'timeout',
+                       RunProcess.memory_message: 'memory',
+                       'Job was interrupted too many times.': 'interrupted'}
 
     state_names = {States.queued: 'Queued', States.in_progress: 'In progress', States.post_processed: 'post processing',
-                   States.finished: 'finished', States.failed: 'failed'}
+                   States.finished: 'finished', States.failed: 'failed', States.cancelled: 'cancelled'}
 
-    def __init__(self, job_dir: Path, files: dict, form: ImmutableMultiDict):
+    def __init__(self, job_dir: Path, files: dict, form: ImmutableMultiDict,
+                 file_digests: Dict[Path, Tuple[int, str]] = None):
+        files = dict(files)
+        files['job_dir'] = {'file_path': job_dir}
+        files['preview'] = {'file_path': Path('.')}
         self.files = files
-        self.files['job_dir'] = {'file_path': job_dir}
-        self.files['preview'] = {'file_path': Path('.')}
 
         self.option_args = self.create_options(form)
         self.additional_args = form.get(JobFormFields.additional_args, '')
@@ -62,6 +171,69 @@ class ConversionJob(db.Model):
 
         self.process_messages = str()
         self.errors = str()
+        self.input_digest = str()
+        self.resource_usage = list()
+        self.attempts = 0
+        self.priority = 0
+        self.created = time.time()
+        self.update_summary()
+        self.set_file_digests(file_digests or dict())
+        self.update_cost()
+
+    def update_summary(self):
+        self.folder_id = self.job_dir().name
+        self.scene_name = self.files.get(JobFormFields.scene_file_field.id, dict()).get('file_path', Path('.')).name
+        self.file_count = len([f for f in self.file_entries
+                               if f.path and f.role not in ('job_dir', 'preview', 'out_file')])
+
+    @property
+    def files(self) -> Dict[str, dict]:
+        """ Job files by role. Returns a copy, use the set file methods to change a path. """
+        return {f.role: f.entry() for f in self.file_entries}
+
+    @files.setter
+    def files(self, files: Dict[str, dict]):
+        existing = {f.role: f for f in self.file_entries}
+
+        for role, entry in files.items():
+            job_file = existing.pop(role, None)
+            if job_file is None:
+                job_file = JobFile(role)
+                self.file_entries.append(job_file)
+            job_file.set_entry(entry)
+
+        for job_file in existing.values():
+            self.file_entries.remove(job_file)
+
+    def set_file_digests(self, file_digests: Dict[Path, Tuple[int, str]]):
+        """ Record size and sha256 of files that were hashed while they were uploaded """
+        for job_file in self.file_entries:
+            if job_file.path and Path(job_file.path) in file_digests:
+                job_file.size, job_file.digest = file_digests[Path(job_file.path)]
+
+    def input_digests(self) -> Dict[str, str]:
+        """ Known sha256 digests of the input files by file name """
+        return {Path(f.path).name: f.digest for f in self.file_entries if f.path and f.digest}
+
+    def update_cost(self):
+        """ Estimate the conversion seconds from the uploaded files and record their size and digest """
+        input_bytes, texture_count = 0, 0
+        for job_file in self.file_entries:
+            if job_file.role in ('job_dir', 'preview', 'out_file'):
+                continue
+
+            job_file.update_stat(create_digest=not job_file.digest)
+            if job_file.size is None:
+                continue
+            input_bytes += job_file.size
+            if job_file.role.startswith(JobFormFields.TextureMap.file_storage):
+                texture_count += 1
+
+        self.input_bytes, self.texture_count = input_bytes, texture_count
+        self.estimated_seconds = JobCostModel.estimate(self.scene_suffix(), input_bytes, texture_count)
+
+    def scene_suffix(self) -> str:
+        return Path(self.scene_name or '').suffix.lower()
 
     @staticmethod
     def create_options(form: ImmutableMultiDict) -> list:
@@ -93,9 +265,14 @@ class ConversionJob(db.Model):
         return self.files.get('preview', dict()).get('file_path', Path('.'))
 
     def _set_file(self, file_key: str, val: Path):
-        self.files[file_key]['file_path'] = val
-        # Force a database update of PickeldType by reassigning the value
-        ConversionJob.query.filter_by(job_id=self.job_id).update(dict(files=self.files))
+        job_file = next((f for f in self.file_entries if f.role == file_key), None)
+        if job_file is None:
+            job_file = JobFile(file_key)
+            self.file_entries.append(job_file)
+        job_file.set_path(val)
+
+    def set_scene_file(self, val: Path):
+        self._set_file(JobFormFields.scene_file_field.id, val)
 
     def set_out_file(self, val: Path):
         self._set_file('out_file', val)
@@ -143,25 +320,13 @@ class ConversionJob(db.Model):
         self.message_update(self.create_arguments_message(args) + '\n')
 
     def message_update(self, msg):
-        self.process_messages += f'{msg}\n'
+        # Messages are appended to the database by the message sink, never through this instance
+        JobMessageSink.append(self.job_id, msg)
         self.progress = min(self.progress, self.progress + 15)
 
-    def preview_url(self) -> Union[None, str]:
-        if self.preview_file().exists() and self.completed:
-            return f'{Urls.downloads}/' \
-                   f'{secure_filename(self.job_dir().name)}/{self.preview_file().name}'
-
-    def direct_download_url(self) -> Union[None, str]:
-        if self.state == self.States.failed:
-            return
-
-        if self.out_file().exists() and self.completed:
-            return f'{Urls.downloads}/' \
-                   f'{secure_filename(self.job_dir().name)}/{self.out_file().name}'
-
-    def download_dir_id(self) -> Union[None, str]:
-        if self.out_file().exists() and self.completed:
-            return f'{secure_filename(self.job_dir().name)}'
+    @staticmethod
+    def _download_url(static_file: Path) -> str:
+        return f'{Urls.downloads}/{static_file.parent.name}/{static_file.name}'
 
     def get_state(self) -> str:
         return self.state_names.get(self.state, 'No job state set')
@@ -169,8 +334,13 @@ class ConversionJob(db.Model):
     def set_error(self, error_message: str):
         self.errors = error_message
 
+    def set_state(self, state: int):
+        """ Change the job state. Reading the current state first lets the flush count the transition. """
+        if self.state != state:
+            self.state = state
+
     def set_in_progress(self):
-        self.state = self.States.in_progress
+        self.set_state(self.States.in_progress)
         self.progress = 5
 
     def set_preview_image_static(self):
@@ -180,10 +350,19 @@ class ConversionJob(db.Model):
             return
 
         self.set_preview_file(img_file_path)
+        self.preview_url = self._download_url(img_file_path)
+
+    def add_stage_usage(self, usage: dict):
+        # Re-assign to let SQLAlchemy detect the change of the JSON column
+        self.resource_usage = list(self.resource_usage or list()) + [usage]
+        stage_duration.observe(usage.get('wall_seconds') or 0.0, usage.get('stage', ''))
 
     def set_complete(self):
         # Move Job file to static, public available, directory
+        usage = ProcessUsage(STAGE_STATIC_MOVE)
         static_file_path = FileManager.move_to_static_dir(self.out_file(), self.job_dir().name)
+        usage.stop()
+        self.add_stage_usage(usage.as_dict())
 
         if static_file_path is None:
             _logger.error('Could not move final Job file. Setting job failed.')
@@ -193,23 +372,493 @@ class ConversionJob(db.Model):
         _logger.info('Moved Job result file to static directory: %s', static_file_path)
 
         self.set_out_file(static_file_path)
-        self.state = self.States.finished
+        self.output_name = static_file_path.name
+        self.download_url = self._download_url(static_file_path)
+        self.set_state(self.States.finished)
         self.completed = True
         self.progress = 100
+        self.record_duration()
+
+    def record_duration(self):
+        """ Sum the stages of the last attempt and feed converted jobs to the cost model """
+        stages = [u for u in self.resource_usage or list() if (u.get('started') or 0) >= (self.started or 0)]
+        self.duration_seconds = round(sum(u.get('wall_seconds') or 0.0 for u in stages), 3)
+
+        # Results served from the cache did not run the converter
+        if any(u.get('stage') == STAGE_CONVERT for u in stages):
+            JobCostModel.add(self.scene_suffix(), self.input_bytes, self.texture_count, self.duration_seconds)
+
+    def set_cancelled(self):
+        self.set_state(self.States.cancelled)
+        self.completed = True
+        self.progress = 0
+        self.set_error('Job was cancelled.')
 
     def set_failed(self, error_msg: str = ''):
-        self.state = self.States.failed
+        job_failures.inc(1, self.failure_reasons.get(error_msg, 'other'))
+        self.set_state(self.States.failed)
         self.completed = True
         if error_msg:
             self.set_error(error_msg)
         self.progress = 0
 
 
+@event.listens_for(db.session, 'after_commit')
+def _notify_job_events(session):
+    """ Wake up job status streams after every commit """
+    JobEvents.notify()
+
+
+class JobStateCounts:
+    """ Number of jobs per state kept in memory for metrics. State transitions of job rows are counted on flush,
+        metric scrapes only read the counts. The counts are loaded on start up and re-synced by the lease
+        heartbeat every METRICS_RESYNC_SECONDS to correct rolled back changes.
+    """
+    _counts: Dict[int, int] = dict()
+    _synced = 0.0
+    _lock = threading.Lock()
+
+    @classmethod
+    def change(cls, old_state: Union[None, int], new_state: Union[None, int]):
+        with cls._lock:
+            if old_state is not None:
+                cls._counts[old_state] = cls._counts.get(old_state, 0) - 1
+            if new_state is not None:
+                cls._counts[new_state] = cls._counts.get(new_state, 0) + 1
+
+    @classmethod
+    def sync(cls):
+        counts = dict(db.session.query(ConversionJob.state, db.func.count(ConversionJob.job_id)
+                                       ).group_by(ConversionJob.state).all())
+        with cls._lock:
+            cls._counts = counts
+            cls._synced = time.monotonic()
+
+    @classmethod
+    def resync_due(cls) -> bool:
+        return time.monotonic() - cls._synced > App.config.get('METRICS_RESYNC_SECONDS', 300)
+
+    @classmethod
+    def collect(cls) -> Dict[tuple, float]:
+        with cls._lock:
+            counts = dict(cls._counts)
+
+        return {(name.lower().replace(' ', '_'),): counts.get(state, 0)
+                for state, name in ConversionJob.state_names.items()}
+
+
+@event.listens_for(db.session, 'after_flush')
+def _count_job_states(session, flush_context):
+    for job in session.new:
+        if isinstance(job, ConversionJob):
+            JobStateCounts.change(None, job.state)
+
+    for job in session.dirty:
+        if isinstance(job, ConversionJob):
+            # set_state loads the previous state of expired jobs
+            history = inspect(job).attrs.state.history
+            if history.added:
+                JobStateCounts.change(history.deleted[0] if history.deleted else None, history.added[0])
+
+    for job in session.deleted:
+        if isinstance(job, ConversionJob):
+            JobStateCounts.change(job.state, None)
+
+
+class JobMessageSink:
+    """ Collects process output per job and appends it to the job messages in batches.
+
+        Buffers are flushed by a background thread every MESSAGE_FLUSH_INTERVAL seconds or once a job
+        buffered MESSAGE_FLUSH_LINES lines. JobManager flushes a job on every stage transition.
+    """
+    _buffers: Dict[int, List[str]] = dict()
+    _lock = threading.Lock()
+    _write_lock = threading.Lock()
+    _wake = threading.Event()
+    _flush_thread: Union[None, threading.Thread] = None
+
+    @classmethod
+    def append(cls, job_id: int, message: str):
+        with cls._lock:
+            lines = cls._buffers.setdefault(job_id, list())
+            lines.append(message)
+            line_count = len(lines)
+
+            if cls._flush_thread is None:
+                cls._flush_thread = threading.Thread(target=cls._flush_loop, daemon=True)
+                cls._flush_thread.start()
+
+        if line_count >= App.config.get('MESSAGE_FLUSH_LINES', 200):
+            cls._wake.set()
+
+    @classmethod
+    def flush(cls, job_id: int = None):
+        """ Write buffered messages of a single or of all jobs to the database """
+        # Keep batches of the same job in order
+        with cls._write_lock:
+            with cls._lock:
+                if job_id is None:
+                    buffers, cls._buffers = cls._buffers, dict()
+                elif job_id in cls._buffers:
+                    buffers = {job_id: cls._buffers.pop(job_id)}
+                else:
+                    return
+
+            for _id, lines in buffers.items():
+                cls._write(_id, lines)
+
+    @staticmethod
+    def _write(job_id: int, lines: List[str]):
+        """ Append lines in a single statement without loading the existing messages """
+        jobs = ConversionJob.__table__
+        chunk = ''.join(f'{line}\n' for line in lines)
+
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    jobs.update().where(jobs.c.job_id == job_id).values(
+                        process_messages=db.func.coalesce(jobs.c.process_messages, '') + chunk)
+                    )
+        except Exception as e:
+            _logger.error('Could not write %s messages of job %s: %s', len(lines), job_id, e)
+            return
+
+        JobEvents.notify()
+
+    @staticmethod
+    def _write_progress(progress: Dict[int, int]):
+        """ Write behind the live progress of running jobs, never moves a job backwards """
+        if not progress:
+            return
+
+        jobs = ConversionJob.__table__
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    jobs.update().where(db.and_(jobs.c.job_id == db.bindparam('_job_id'),
+                                                jobs.c.completed.isnot(True),
+                                                jobs.c.state.in_((ConversionJob.States.in_progress,
+                                                                  ConversionJob.States.post_processed)),
+                                                db.func.coalesce(jobs.c.progress, 0) < db.bindparam('_progress'))
+                                         ).values(progress=db.bindparam('_progress')),
+                    [{'_job_id': job_id, '_progress': value} for job_id, value in progress.items()])
+        except Exception as e:
+            _logger.error('Could not write progress of jobs %s: %s', list(progress), e)
+            return
+
+        JobEvents.notify()
+
+    @classmethod
+    def _flush_loop(cls):
+        while True:
+            cls._wake.wait(timeout=App.config.get('MESSAGE_FLUSH_INTERVAL', 2.0))
+            cls._wake.clear()
+            cls.flush()
+            cls._write_progress(JobStateRegistry.take_dirty())
+
+
+class JobLeases:
+    """ Running jobs are leased to this server process. A heartbeat renews the leases of the jobs
+        occupying our worker slots. Jobs with an expired lease lost their worker and get recovered.
+    """
+    owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+    _thread: Union[None, threading.Thread] = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def lease_seconds() -> float:
+        return float(App.config.get('JOB_LEASE_SECONDS', 60))
+
+    @classmethod
+    def expires(cls) -> float:
+        return time.time() + cls.lease_seconds()
+
+    @classmethod
+    def renew(cls, job_ids: List[int]):
+        if not job_ids:
+            return
+
+        ConversionJob.query.filter(ConversionJob.job_id.in_(job_ids), ConversionJob.lease_owner == cls.owner
+                                   ).update(dict(lease_expires=cls.expires()), synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def owner_gone(cls, owner: Union[None, str]) -> bool:
+        """ True if the lease owner is a server process of this host that is no longer running """
+        host, _, pid = (owner or '').rpartition(':')[0].rpartition(':')
+        if owner == cls.owner or host != socket.gethostname() or not pid.isdigit():
+            return False
+
+        if int(pid) == os.getpid():
+            # A previous server process that had our pid, eg. before a container restart
+            return True
+        if sys.platform == 'win32':
+            # os.kill would terminate the process, leases of other processes have to expire
+            return False
+
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+        return False
+
+    @classmethod
+    def start(cls):
+        with cls._lock:
+            if cls._thread is None or not cls._thread.is_alive():
+                cls._thread = threading.Thread(target=cls._heartbeat_loop, daemon=True)
+                cls._thread.start()
+
+    @classmethod
+    def _heartbeat_loop(cls):
+        while True:
+            time.sleep(float(App.config.get('JOB_HEARTBEAT_SECONDS', 15)))
+
+            try:
+                with App.app_context():
+                    cls.renew(JobManager.running_job_ids())
+                    if JobStateCounts.resync_due():
+                        JobStateCounts.sync()
+
+                if JobManager.recover_jobs():
+                    JobManager.run_job_queue()
+                JobManager.run_preview_queue()
+            except Exception as e:
+                _logger.error('Job lease heartbeat failed: %s', e, exc_info=1)
+
+
+class WorkerSlot:
+    """ A conversion slot of the JobManager worker pool """
+    def __init__(self, slot_id: int):
+        self.slot_id = slot_id
+        self.job_id: Union[None, int] = None
+        self.jobs_processed = 0
+        self.busy_seconds = 0.0
+
+        self._busy_since = 0.0
+        self._created = time.monotonic()
+
+    def is_free(self) -> bool:
+        return self.job_id is None
+
+    def occupy(self, job_id: int):
+        self.job_id = job_id
+        self._busy_since = time.monotonic()
+
+    def release(self):
+        if self.job_id is None:
+            return
+
+        self.busy_seconds += time.monotonic() - self._busy_since
+        self.jobs_processed += 1
+        self.job_id = None
+
+    def utilisation(self) -> float:
+        """ Share of time 0.0-1.0 this slot spent running jobs since the slot was created """
+        busy_seconds = self.busy_seconds
+        if self.job_id is not None:
+            busy_seconds += time.monotonic() - self._busy_since
+
+        uptime = time.monotonic() - self._created
+        if uptime <= 0:
+            return 0.0
+        return min(1.0, busy_seconds / uptime)
+
+
+class JobScheduler:
+    """ Picks the next queued job. Jobs are submitted to the interactive lane or, for scripted batches,
+        the bulk lane. While both lanes wait, every BULK_LANE_SHARE claim goes to the bulk lane. Within a lane
+        jobs are shared between submitters by the number of jobs they are running, then higher priorities run
+        first. Then the shortest expected job runs first, every second a job waits reduces its cost by
+        JOB_AGING_FACTOR seconds so expensive jobs are not starved. Remaining ties are resolved round robin
+        between submitters. Only submitters identified by an API token may request a priority or lane.
+    """
+    lane_interactive = 'interactive'
+    lane_bulk = 'bulk'
+    lanes = (lane_interactive, lane_bulk)
+
+    _claims_since_bulk = 0
+    _served: Dict[str, int] = dict()
+    _serve_counter = itertools.count(1)
+    _lock = threading.Lock()
+
+    @staticmethod
+    def submitter_key(remote_addr: str, api_token: str = None) -> str:
+        """ Identify the submitter by API token or remote address. Tokens are stored hashed. """
+        if api_token:
+            return 'token:' + hashlib.sha256(api_token.encode('utf-8')).hexdigest()[:16]
+        return f'addr:{remote_addr or "unknown"}'
+
+    @staticmethod
+    def is_token_submitter(submitter: str) -> bool:
+        return bool(submitter) and submitter.startswith('token:')
+
+    @classmethod
+    def assign(cls, job: ConversionJob, submitter: str, form: ImmutableMultiDict):
+        """ Set submitter, lane and priority of a new job. Anonymous submitters always get priority 0
+            and the automatic lane.
+        """
+        job.submitter = submitter
+        trusted = cls.is_token_submitter(submitter)
+
+        priority = form.get(JobFormFields.priority, '0').strip() if trusted else '0'
+        min_priority, max_priority = App.config.get('JOB_PRIORITY_RANGE', (-5, 5))
+        try:
+            job.priority = max(min_priority, min(max_priority, int(priority)))
+        except ValueError:
+            job.priority = 0
+
+        lane = form.get(JobFormFields.lane, '').strip().lower() if trusted else ''
+        if lane not in cls.lanes:
+            # Submitters that already wait for a batch of jobs are moved to the bulk lane
+            queued = ConversionJob.query.filter_by(submitter=submitter, state=ConversionJob.States.queued).count()
+            lane = cls.lane_bulk if queued >= App.config.get('BULK_LANE_QUEUED_JOBS', 3) else cls.lane_interactive
+        job.lane = lane
+
+    @classmethod
+    def next_job(cls) -> Union[None, ConversionJob]:
+        states = ConversionJob.States
+        queued = cls._queued_rows()
+        if not queued:
+            return None
+
+        running = dict(db.session.query(ConversionJob.submitter, db.func.count(ConversionJob.job_id)).filter(
+            ConversionJob.state.in_((states.in_progress, states.post_processed)),
+            ConversionJob.completed.is_(False)).group_by(ConversionJob.submitter).all())
+
+        lane = cls._pick_lane({row.lane or cls.lane_interactive for row in queued})
+
+        with cls._lock:
+            served = dict(cls._served)
+
+        now, aging = time.time(), float(App.config.get('JOB_AGING_FACTOR', 1.0))
+        candidates = [row for row in queued if (row.lane or cls.lane_interactive) == lane]
+        best = min(candidates, key=lambda r: (running.get(r.submitter, 0), -(r.priority or 0),
+                                              cls.effective_cost(r, now, aging), served.get(r.submitter, 0),
+                                              r.job_id))
+        return ConversionJob.query.get(best.job_id)
+
+    @staticmethod
+    def _queued_rows() -> list:
+        return db.session.query(ConversionJob.job_id, ConversionJob.lane, ConversionJob.submitter,
+                                ConversionJob.priority, ConversionJob.estimated_seconds, ConversionJob.created
+                                ).filter(ConversionJob.state == ConversionJob.States.queued).all()
+
+    @staticmethod
+    def effective_cost(row, now: float, aging: float) -> float:
+        waited = now - row.created if row.created else 0.0
+        return (row.estimated_seconds or 0.0) - aging * waited
+
+    @classmethod
+    def estimate_completion(cls, workers: int) -> Dict[int, float]:
+        """ Seconds until unfinished jobs are expected to complete. Simulates the worker slots running the
+            current jobs followed by the queue in scheduling order, lanes and submitter shares are ignored.
+        """
+        now, aging = time.time(), float(App.config.get('JOB_AGING_FACTOR', 1.0))
+        states = ConversionJob.States
+        running = db.session.query(ConversionJob.job_id, ConversionJob.estimated_seconds, ConversionJob.started
+                                   ).filter(ConversionJob.state.in_((states.in_progress, states.post_processed)),
+                                            ConversionJob.completed.is_(False)).all()
+
+        eta = dict()
+        slots = [0.0] * max(1, workers)
+        for row in running:
+            remaining = max(0.0, (row.estimated_seconds or 0.0) - (now - (row.started or now)))
+            eta[row.job_id] = remaining
+            slot = slots.index(min(slots))
+            slots[slot] = max(slots[slot], remaining)
+
+        for row in sorted(cls._queued_rows(), key=lambda r: (-(r.priority or 0), cls.effective_cost(r, now, aging),
+                                                             r.job_id)):
+            slot = slots.index(min(slots))
+            slots[slot] += row.estimated_seconds or 0.0
+            eta[row.job_id] = slots[slot]
+
+        return {job_id: round(seconds, 1) for job_id, seconds in eta.items()}
+
+    @classmethod
+    def _pick_lane(cls, waiting_lanes: set) -> str:
+        if len(waiting_lanes) == 1:
+            return waiting_lanes.pop()
+
+        bulk_share = max(1, int(App.config.get('BULK_LANE_SHARE', 4)))
+        with cls._lock:
+            return cls.lane_bulk if cls._claims_since_bulk >= bulk_share - 1 else cls.lane_interactive
+
+    @classmethod
+    def claimed(cls, job: ConversionJob):
+        """ Account a claimed job for lane shares and submitter round robin """
+        with cls._lock:
+            if job.lane == cls.lane_bulk:
+                cls._claims_since_bulk = 0
+            else:
+                cls._claims_since_bulk += 1
+            cls._served[job.submitter] = next(cls._serve_counter)
+
+
 class JobManager:
+    _slots: List[WorkerSlot] = list()
+    _slot_lock = threading.Lock()
+    # Process thread of the current stage of every job, entries vanish once a thread finished
+    _processes = weakref.WeakValueDictionary()
+    # Jobs a cancellation is writing the cancelled state of, claims and process callbacks leave them alone
+    _cancelling: Set[int] = set()
+    # Jobs a process callback is writing the result of, they can no longer be cancelled
+    _completing: Set[int] = set()
+
     @staticmethod
     def get_jobs() -> Iterator[ConversionJob]:
         return ConversionJob.query.all()
 
+    @staticmethod
+    def update_job_summaries():
+        """ Fill the listing columns of jobs created by earlier app versions """
+        jobs = ConversionJob.query.filter(db.or_(ConversionJob.folder_id.is_(None),
+                                                 ConversionJob.file_count.is_(None))).all()
+        for job in jobs:
+            job.update_summary()
+
+        # Result and preview of finished jobs are looked up once in the download index
+        rows = db.session.query(ConversionJob.job_id, ConversionJob.folder_id, DownloadEntry.name,
+                                DownloadEntry.preview_name
+                                ).join(DownloadEntry, DownloadEntry.folder_id == ConversionJob.folder_id
+                                       ).filter(ConversionJob.state == ConversionJob.States.finished,
+                                                ConversionJob.output_name.is_(None)).all()
+        for job_id, folder_id, name, preview_name in rows:
+            ConversionJob.query.filter_by(job_id=job_id).update(
+                {'output_name': name, 'download_url': f'{Urls.downloads}/{folder_id}/{name}' if name else None,
+                 'preview_url': f'{Urls.downloads}/{folder_id}/{preview_name}' if preview_name else None},
+                synchronize_session=False)
+
+        if jobs or rows:
+            db.session.commit()
+            _logger.info('Updated listing columns of %s jobs.', len(jobs) + len(rows))
+
+    @staticmethod
+    def clear_download_urls(folder_ids: List[str]):
+        """ Called by the download index once download folders were removed """
+        ConversionJob.query.filter(ConversionJob.folder_id.in_(folder_ids)).update(
+            {'download_url': None, 'preview_url': None}, synchronize_session=False)
+
+    @staticmethod
+    def load_cost_model():
+        """ Feed the cost model with the recent finished jobs """
+        history = int(App.config.get('JOB_COST_HISTORY', 200))
+        rows = db.session.query(ConversionJob.scene_name, ConversionJob.input_bytes, ConversionJob.texture_count,
+                                ConversionJob.duration_seconds, ConversionJob.resource_usage
+                                ).filter(ConversionJob.state == ConversionJob.States.finished,
+                                         ConversionJob.duration_seconds.isnot(None)
+                                         ).order_by(ConversionJob.job_id.desc()).limit(history * 10).all()
+
+        samples = [(Path(name or '').suffix, input_bytes, textures, seconds)
+                   for name, input_bytes, textures, seconds, usage in reversed(rows)
+                   if any(u.get('stage') == STAGE_CONVERT for u in usage or list())]
+        JobCostModel.load(samples, history)
+        _logger.info('Loaded %s finished jobs into the job cost model.', len(samples))
+
     @staticmethod
     def get_job_by_id(_id: int) -> Union[None, ConversionJob]:
         if isinstance(_id, str) and _id.isdigit():
@@ -219,25 +868,281 @@ class JobManager:
 
     @staticmethod
     def _get_next_job() -> Union[None, ConversionJob]:
-        return ConversionJob.query.filter_by(completed=False).first()
+        return JobScheduler.next_job()
+
+    @classmethod
+    def _claim_next_job(cls) -> Union[None, ConversionJob]:
+        """ Atomically move the next queued job to in progress. Returns None if the queue is empty. """
+        while True:
+            job = cls._get_next_job()
+            if not job or job.job_id in cls._cancelling:
+                return None
+
+            # Only one caller can win the state transition of a queued row
+            claimed = ConversionJob.query.filter_by(job_id=job.job_id, state=ConversionJob.States.queued).update(
+                dict(state=ConversionJob.States.in_progress, progress=5, started=time.time(),
+                     lease_owner=JobLeases.owner, lease_expires=JobLeases.expires(),
+                     attempts=db.func.coalesce(ConversionJob.attempts, 0) + 1), synchronize_session=False)
+            db.session.commit()
+
+            if claimed:
+                JobStateCounts.change(ConversionJob.States.queued, ConversionJob.States.in_progress)
+                JobScheduler.claimed(job)
+                return job
+
+    @classmethod
+    def _get_slots(cls) -> List[WorkerSlot]:
+        if not cls._slots:
+            workers = max(1, int(App.config.get('CONVERSION_WORKERS') or 1))
+            cls._slots = [WorkerSlot(slot_id) for slot_id in range(workers)]
+            _logger.info('Created conversion worker pool with %s slots', workers)
+
+            if App.config.get('CONVERTER_WARM_WORKERS'):
+                ConverterWorkerPool.configure(create_converter_worker_arguments(), App.config['USDZ_CONVERTER_PATH'],
+                                              usd_env(), workers, App.config.get('CONVERTER_WORKER_MAX_JOBS', 25),
+                                              float(App.config.get('CONVERTER_WORKER_START_TIMEOUT', 120)),
+                                              float(App.config.get('CONVERTER_WORKER_PING_TIMEOUT', 10)))
+
+            JobOutput.tail_bytes = int(App.config.get('JOB_OUTPUT_TAIL_KB', 64)) * 1024
+            preview_workers = int(App.config.get('PREVIEW_WORKERS', 1))
+            PreviewQueue.configure(preview_workers, int(App.config.get('PREVIEW_QUEUE_SIZE', 50)))
+            # A callback thread for every process that can finish at the same time
+            ProcessSupervisor.configure(workers + preview_workers)
+        return cls._slots
+
+    @classmethod
+    def _get_free_slot(cls) -> Union[None, WorkerSlot]:
+        for slot in cls._get_slots():
+            if slot.is_free():
+                return slot
+
+    @staticmethod
+    def _progress_range(job: ConversionJob, stage: str) -> Tuple[int, int]:
+        """ Job progress covered by a stage, Alembic conversions continue with the post process at 75% """
+        if stage == STAGE_POST_PROCESS:
+            return 75, 95
+        return (5, 75) if job.scene_suffix() == '.abc' else (5, 95)
+
+    @classmethod
+    def _release_slot(cls, job_id: int):
+        JobStateRegistry.finish(job_id)
+
+        with cls._slot_lock:
+            for slot in cls._get_slots():
+                if slot.job_id == job_id:
+                    slot.release()
+                    _logger.info('Worker slot %s finished job %s. Slot utilisation: %.1f%%',
+                                 slot.slot_id, job_id, slot.utilisation() * 100)
+
+    @classmethod
+    def running_jobs(cls) -> int:
+        return len(cls.running_job_ids())
+
+    @classmethod
+    def running_job_ids(cls) -> List[int]:
+        with cls._slot_lock:
+            return [slot.job_id for slot in cls._slots if not slot.is_free()]
+
+    @classmethod
+    def recover_jobs(cls, startup: bool = False) -> int:
+        """ Re-queue unfinished jobs whose lease expired because the server process running them died.
+            On startup leases of previous server processes on this host are recovered before they expire,
+            leases of running server processes are left alone. Jobs continue with the pipeline stage they
+            were interrupted in or fail after JOB_MAX_ATTEMPTS. Returns the number of re-queued jobs.
+        """
+        requeued = 0
+
+        with App.app_context():
+            running_job_ids, now = cls.running_job_ids(), time.time()
+            expired = db.or_(ConversionJob.lease_expires.is_(None), ConversionJob.lease_expires < now)
+            if startup:
+                # Leases of this host are checked for a dead owner below
+                expired = db.or_(expired, ConversionJob.lease_owner.is_(None),
+                                 ConversionJob.lease_owner.startswith(f'{socket.gethostname()}:', autoescape=True))
+
+            jobs = ConversionJob.query.filter(
+                ConversionJob.completed.is_(False),
+                ConversionJob.state.in_((ConversionJob.States.in_progress, ConversionJob.States.post_processed)),
+                expired
+            ).all()
+
+            for job in jobs:
+                if job.job_id in running_job_ids or not cls._lease_lost(job, now):
+                    continue
+
+                if (job.attempts or 0) >= App.config.get('JOB_MAX_ATTEMPTS', 3):
+                    _logger.error('Job %s was interrupted %s times. Setting job failed.', job.job_id, job.attempts)
+                    job.set_failed('Job was interrupted too many times.')
+                    continue
+
+                cls._requeue_job(job)
+                requeued += 1
+
+            if jobs:
+                db.session.commit()
+
+        if requeued:
+            _logger.info('Recovered %s interrupted jobs.', requeued)
+        return requeued
+
+    @staticmethod
+    def _lease_lost(job: ConversionJob, now: float) -> bool:
+        """ The lease of the job expired or the server process holding it is gone """
+        if job.lease_owner is None or job.lease_expires is None or job.lease_expires < now:
+            return True
+        return JobLeases.owner_gone(job.lease_owner)
+
+    @classmethod
+    def _requeue_job(cls, job: ConversionJob):
+        """ Queue an interrupted job to continue with the stage it was interrupted in """
+        job.resume_stage = None
+
+        if job.state == ConversionJob.States.post_processed:
+            # Post process reads the usdc written by the converter, restart the conversion if it is missing
+            converted_file = job.out_file().with_suffix('.usdc')
+            if converted_file.exists():
+                job.resume_stage = STAGE_POST_PROCESS
+            else:
+                job.set_scene_file(job.out_file().with_suffix('.abc'))
+
+        _logger.info('Re-queuing interrupted job %s from stage %s', job.job_id, job.resume_stage or STAGE_CONVERT)
+        job.message_update(f'Job was interrupted and will continue with stage {job.resume_stage or STAGE_CONVERT}.')
+        job.set_state(ConversionJob.States.queued)
+        job.progress = 0
+        job.lease_owner, job.lease_expires = None, None
+
+    @classmethod
+    def worker_utilisation(cls) -> List[dict]:
+        """ Report the state and utilisation of every worker slot """
+        with cls._slot_lock:
+            return [{'slot_id': slot.slot_id, 'job_id': slot.job_id, 'jobs_processed': slot.jobs_processed,
+                     'utilisation': round(slot.utilisation() * 100, 1)} for slot in cls._get_slots()]
 
     @classmethod
     def remove_job(cls, job_id: int) -> Tuple[bool, str]:
+        if str(job_id).isdigit() and JobStateRegistry.is_active(int(job_id)):
+            return False, f'Job {job_id} is in process and needs to be cancelled before it can be deleted.'
+
         with App.app_context():
             job = cls.get_job_by_id(job_id)
 
-            if job and job.completed:
+            if not job:
+                return False, f'Could not find job {job_id} you requested deletion for.'
+            elif job.completed:
+                log_file = cls.job_log_file(job.job_id)
                 db.session.delete(job)
                 db.session.commit()
+                if log_file.exists():
+                    log_file.unlink()
                 _logger.debug('Deleted job: %s', job_id)
                 return True, f'Job {job_id} successfully deleted.'
             elif not job.completed:
-                return False, f'Job {job_id} is in process and can not be deleted.'
-            elif not job:
-                return False, f'Could not find job {job_id} you requested deletion for.'
+                return False, f'Job {job_id} is in process and needs to be cancelled before it can be deleted.'
 
         return False, f'Could not delete job {job_id}. Unknown error.'
 
+    @classmethod
+    def cancel_job(cls, job_id: int) -> Tuple[bool, str]:
+        """ Dequeue a queued job or kill the process tree of a running job. The job dir is removed and
+            the worker slot becomes available to the next queued job immediately.
+        """
+        with App.app_context():
+            job = cls.get_job_by_id(job_id)
+
+            if not job:
+                return False, f'Could not find job {job_id} you requested cancellation for.'
+            elif job.completed:
+                return False, f'Job {job_id} already completed and can not be cancelled.'
+
+            # The marker keeps the queue from claiming the job and process callbacks from writing their result,
+            # the database is written outside of the slot lock
+            job_id, job_dir = job.job_id, job.job_dir()
+            with cls._slot_lock:
+                if job_id in cls._completing or job_id in cls._cancelling:
+                    return False, f'Job {job_id} is about to complete and can not be cancelled.'
+                cls._cancelling.add(job_id)
+                was_queued = not any(slot.job_id == job_id for slot in cls._get_slots())
+                process_thread = cls._processes.pop(job_id, None)
+
+            try:
+                # A result written before the marker was set wins
+                db.session.expire(job, ['state', 'completed'])
+                if job.completed:
+                    return False, f'Job {job_id} already completed and can not be cancelled.'
+
+                job.set_cancelled()
+                db.session.commit()
+            finally:
+                with cls._slot_lock:
+                    cls._cancelling.discard(job_id)
+            JobMessageSink.flush(job_id)
+
+            if process_thread is not None and process_thread.is_alive():
+                _logger.info('Killing process of cancelled job %s', job_id)
+                process_thread.abort()
+
+            FileManager.clear_folder(job_dir, re_create=False)
+
+        _logger.info('Cancelled %s job %s', 'queued' if was_queued else 'running', job_id)
+        if not was_queued:
+            cls._release_slot(job_id)
+        # A claim skipped the job while it was cancelled
+        cls.run_job_queue()
+
+        return True, f'Job {job_id} cancelled.'
+
+    @classmethod
+    @contextmanager
+    def _job_result(cls, job_id: int) -> Iterator[Union[None, ConversionJob]]:
+        """ Guard the result write of a job against a racing cancellation. Yields None if the job was
+            cancelled, otherwise cancellations are refused until the result is written.
+        """
+        with cls._slot_lock:
+            cancelling = job_id in cls._cancelling
+            if not cancelling:
+                cls._completing.add(job_id)
+
+        if cancelling:
+            yield None
+            return
+
+        try:
+            job = cls.get_job_by_id(job_id)
+            if job is not None:
+                # Re-read the state, a cancellation might have been committed since the job was loaded
+                db.session.expire(job, ['state', 'completed'])
+            yield None if cls._is_cancelled(job) else job
+        finally:
+            with cls._slot_lock:
+                cls._completing.discard(job_id)
+
+    @staticmethod
+    def _is_cancelled(job: ConversionJob) -> bool:
+        """ Process callbacks racing a cancellation must not touch the job anymore """
+        return job is None or job.state == ConversionJob.States.cancelled
+
+    @classmethod
+    def _track_process(cls, job_id: int, process_thread: RunProcess):
+        with cls._slot_lock:
+            cls._processes[job_id] = process_thread
+
+    @classmethod
+    def _start_job_process(cls, job: ConversionJob, process_thread: RunProcess) -> bool:
+        """ Register and start the process of a claimed job unless it was cancelled since it was claimed.
+            A cancellation either sees the cancelled state first or finds the started process to abort.
+        """
+        with cls._slot_lock:
+            # Commit expires the job, it's state is re-read from the database
+            db.session.commit()
+            if job.job_id in cls._cancelling or cls._is_cancelled(job):
+                _logger.info('Job %s was cancelled before its %s process started', process_thread.identifier,
+                             process_thread.usage.stage)
+                return False
+
+            cls._processes[job.job_id] = process_thread
+            process_thread.start()
+            return True
+
     @classmethod
     def create_job_arguments(cls, job: ConversionJob) -> list:
         args = list()
@@ -325,20 +1230,151 @@ class JobManager:
 
     @classmethod
     def run_job_queue(cls):
-        with App.app_context():
-            job = cls._get_next_job()
-            if not job:
+        """ Start queued jobs until every worker slot is occupied or the queue is empty """
+        while True:
+            with App.app_context():
+                job = cls._claim_job_slot()
+                if job is None:
+                    return
+
+                resume_stage, job.resume_stage = job.resume_stage, None
+
+                if cls._finish_from_cache(job):
+                    cls._release_slot(job.job_id)
+                    continue
+
+                if resume_stage == STAGE_POST_PROCESS:
+                    job.set_state(ConversionJob.States.post_processed)
+                    job.progress = 75
+                    db.session.commit()
+
+                    cls._start_post_process(job, job.out_file().with_suffix('.usdc'))
+                    db.session.commit()
+                    continue
+
+                process_thread = cls._create_job_process(job)
+                if cls._start_job_process(job, process_thread):
+                    _logger.info('Started conversion process of job %s', process_thread.identifier)
+
+    @classmethod
+    def _claim_job_slot(cls) -> Union[None, ConversionJob]:
+        """ Claim the next queued job for a free worker slot """
+        with cls._slot_lock:
+            slot = cls._get_free_slot()
+            if slot is None:
                 return
-            job.set_in_progress()
-            job_arguments = create_usdzconvert_arguments(cls.create_job_arguments(job))
-            _logger.info('Running Job with arguments: %s', job_arguments)
-            job.add_arguments_message(job_arguments)  # Document cmd line arguments
 
-            process_thread = RunProcess(job_arguments, job.job_dir(), usd_env(), job.job_id,
-                                        cls._finished_callback, cls._failed_callback, cls._message_callback)
+            job = cls._claim_next_job()
+            if job:
+                slot.occupy(job.job_id)
+                JobStateRegistry.start(job.job_id, ConversionJob.States.in_progress, STAGE_CONVERT, 5,
+                                       cls._progress_range(job, STAGE_CONVERT))
+                _logger.info('Worker slot %s claimed job %s', slot.slot_id, job.job_id)
+
+            return job
+
+    @classmethod
+    def _create_job_process(cls, job: ConversionJob) -> RunProcess:
+        converter_arguments = cls.create_job_arguments(job)
+        job_arguments = create_usdzconvert_arguments(converter_arguments)
+        _logger.info('Running Job %s with arguments: %s', job.job_id, job_arguments)
+        job.add_arguments_message(job_arguments)  # Document cmd line arguments
+
+        process_thread = cls._create_converter_process(STAGE_CONVERT, converter_arguments, job_arguments, job)
+        db.session.commit()
+        JobMessageSink.flush(job.job_id)
+        return process_thread
+
+    @classmethod
+    def _finish_from_cache(cls, job: ConversionJob) -> bool:
+        """ Complete the job with the cached result of a job with identical inputs and arguments """
+        if not ResultCache.enabled():
+            return False
+
+        if not job.input_digest:
+            job.input_digest = ResultCache.create_digest(job.job_dir(), cls.create_job_arguments(job),
+                                                          job.input_digests())
             db.session.commit()
-        process_thread.start()
-        _logger.info('Started thread with id: %s', process_thread.ident)
+
+        entry = ResultCache.get(job.input_digest)
+        if entry is None or not ResultCache.link(entry.file(), job.out_file()):
+            return False
+
+        with cls._job_result(job.job_id) as job:
+            if job is None:
+                return True
+
+            _logger.info('Job %s finished with cached result %s', job.job_id, entry.digest)
+            job.message_update(f'Identical files and options have been converted before. '
+                               f'Serving cached result {entry.file_name}.')
+            job.set_complete()
+
+            preview_file = entry.preview_file()
+            if job.completed and preview_file is not None and preview_file.exists():
+                img_file = job.job_dir() / preview_file.name
+                if ResultCache.link(preview_file, img_file):
+                    job.set_preview_file(img_file)
+                    job.set_preview_image_static()
+            elif job.completed:
+                cls._queue_preview(job)
+
+            db.session.commit()
+            JobMessageSink.flush(job.job_id)
+        return True
+
+    @classmethod
+    def _create_converter_process(cls, command: str, worker_args: list, args: list,
+                                  job: ConversionJob) -> RunProcess:
+        """ Run a converter command in a warm converter worker if enabled, otherwise in a new interpreter """
+        if App.config.get('CONVERTER_WARM_WORKERS'):
+            return WarmRunProcess(command, worker_args, args, job.job_dir(), usd_env(), job.job_id,
+                                  cls._finished_callback, cls._failed_callback, cls._message_callback,
+                                  cls._usage_callback, timeout=cls._stage_timeout(command),
+                                  log_file=cls.job_log_file(job.job_id),
+                                  limits=cls._process_limits(command, job.job_id))
+
+        return RunProcess(args, job.job_dir(), usd_env(), job.job_id,
+                          cls._finished_callback, cls._failed_callback, cls._message_callback,
+                          cls._usage_callback, command, cls._stage_timeout(command), cls.job_log_file(job.job_id),
+                          cls._process_limits(command, job.job_id))
+
+    @staticmethod
+    def job_log_file(job_id: int) -> Path:
+        """ Complete process output of all stages of a job """
+        return Path(App.config.get('JOB_LOG_FOLDER')) / f'{job_id}.log'
+
+    @classmethod
+    def job_log_tail(cls, job_id: int, limit: int = None) -> str:
+        """ End of the process output of a job, from memory while a process of the job is running """
+        limit = limit or JobOutput.tail_bytes
+        output = JobOutput.get(job_id)
+        if output is not None:
+            return output.tail(limit)
+        return JobOutput.read_tail(cls.job_log_file(job_id), limit)
+
+    @staticmethod
+    def _stage_timeout(stage: str) -> float:
+        """ Seconds a stage may run before it's process tree gets killed, 0 for no limit """
+        return float((App.config.get('STAGE_TIMEOUTS') or dict()).get(stage) or 0)
+
+    @classmethod
+    def _process_limits(cls, stage: str, job_id: int) -> ProcessLimits:
+        """ Process controls of a stage, pinned to the CPUs and cgroup of the worker slot running the job """
+        settings = (App.config.get('STAGE_PROCESS_LIMITS') or dict()).get(stage) or dict()
+
+        with cls._slot_lock:
+            slots = cls._get_slots()
+            slot_id = next((slot.slot_id for slot in slots if slot.job_id == job_id), None)
+
+        cpus, cgroup = set(), None
+        if slot_id is not None:
+            cpus = slot_cpus(slot_id, len(slots), App.config.get('CONVERSION_CPU_AFFINITY'),
+                             App.config.get('WEB_SERVER_CPUS', 1))
+            if App.config.get('CONVERSION_CGROUP'):
+                cgroup = Path(App.config.get('CONVERSION_CGROUP')) / f'slot-{slot_id}'
+
+        return ProcessLimits(settings.get('nice', 0), settings.get('ionice'), settings.get('ionice_level', 7),
+                             cpus, settings.get('memory_mb', 0), cgroup)
 
     @classmethod
     def _run_post_process(cls, job: ConversionJob) -> bool:
@@ -349,88 +1385,239 @@ class JobManager:
             return False
 
         job.progress = 75
+        if not cls._start_post_process(job, scene_file.with_suffix('.usdc')):
+            # Cancelled while the conversion finished, the cancellation released the slot
+            return True
+
+        # Post process will create a usdz
+        job.set_scene_file(scene_file.parent / f'{scene_file.stem}_out.usdc')
+        job.set_out_file(job.out_file().with_suffix('.usdz'))
+        job.set_state(ConversionJob.States.post_processed)
+        db.session.commit()
+        return True
+
+    @classmethod
+    def _start_post_process(cls, job: ConversionJob, converted_file: Path) -> bool:
+        """ Start the Alembic post process of the usdc file written by the converter """
         job.message_update('USDZ Conversion Server is post processing your Alembic input file.')
+        JobStateRegistry.transition(job.job_id, ConversionJob.States.post_processed, STAGE_POST_PROCESS, 75,
+                                    cls._progress_range(job, STAGE_POST_PROCESS))
 
-        # --- Start Alembic post process ---
         args = create_abc_post_process_arguments()
-        args.append(scene_file.with_suffix('.usdc'))
+        args.append(converted_file)
 
         job.add_arguments_message(args)
 
-        post_process_thread = RunProcess(args, job.job_dir(), usd_env(), job.job_id,
-                                         cls._finished_callback, cls._failed_callback, cls._message_callback)
-        post_process_thread.start()
-        _logger.info('Started post processing thread with id: %s', post_process_thread.ident)
+        post_process_thread = cls._create_converter_process(STAGE_POST_PROCESS, args[-1:], args, job)
+        if not cls._start_job_process(job, post_process_thread):
+            return False
 
-        # Post process will create a usdz
-        job.files[JobFormFields.scene_file_field.id]['file_path'] = scene_file.parent / f'{scene_file.stem}_out.usdc'
-        job.set_out_file(job.out_file().with_suffix('.usdz'))
-        job.state = ConversionJob.States.post_processed
-        db.session.commit()
+        _logger.info('Started post processing of job %s', job.job_id)
         return True
 
-    @classmethod
-    def _run_usdrecord(cls, job: ConversionJob):
-        """ Create a preview image of the output scene file """
-        args = create_usdscript_arguments('usdrecord')
-        if not args[-1:][0].exists():
-            # Our environment does not provide USD imaging components
-            return
+    @staticmethod
+    def _preview_available() -> bool:
+        # Our environment may not provide USD imaging components
+        return create_usdscript_arguments('usdrecord')[-1].exists()
 
+    @classmethod
+    def _queue_preview(cls, job: ConversionJob):
+        """ Queue the preview image of a finished job """
         usdz_file = job.out_file()
-        if not usdz_file.exists():
+        if not cls._preview_available() or not usdz_file.exists():
             # No scene file to create preview image from
             return
-        img_file = usdz_file.with_suffix(App.config.get('PREVIEW_IMG_SUFFIX'))
-        if img_file.exists():
+        if usdz_file.with_suffix(App.config.get('PREVIEW_IMG_SUFFIX')).exists():
             # Preview image already created
             return
-        job.set_preview_file(img_file)
 
-        args += [usdz_file, img_file, '--imageWidth', '400', '--renderer', 'GL']
+        PreviewQueue.add(PreviewRequest(usdz_file.parent.name, usdz_file, job.job_id))
+
+    @classmethod
+    def run_preview_queue(cls):
+        """ Start queued preview renders while render slots are free and the conversion backlog is short.
+            Missing previews of older downloads are rendered once no job is queued or running.
+        """
+        with App.app_context():
+            if PreviewQueue.running() >= PreviewQueue.max_running or not cls._preview_available():
+                return
+
+            queued = ConversionJob.query.filter_by(state=ConversionJob.States.queued).count()
+            if queued >= App.config.get('PREVIEW_DEFER_QUEUED_JOBS', 2):
+                return
+
+            while True:
+                backfill = None
+                if not PreviewQueue.pending() and not queued and not cls.running_jobs():
+                    backfill = cls._next_preview_backfill()
+
+                request = PreviewQueue.claim(backfill)
+                if request is None:
+                    return
+
+                try:
+                    cls._start_preview(request)
+                except Exception as e:
+                    _logger.error('Could not start preview of %s: %s', request.folder_id, e, exc_info=1)
+                    PreviewQueue.done(request.folder_id)
+
+    @staticmethod
+    def _next_preview_backfill() -> Union[None, PreviewRequest]:
+        """ Newest download without preview image that was not attempted before """
+        if not App.config.get('PREVIEW_BACKFILL'):
+            return
+
+        missing = db.or_(DownloadEntry.preview_name.is_(None), DownloadEntry.preview_name == '')
+        query = DownloadEntry.query.filter(missing).order_by(DownloadEntry.created.desc())
+
+        for entry in query.limit(100):
+            scene_file = DownloadIndex.download_folder() / entry.folder_id / entry.name
+            if PreviewQueue.is_attempted(entry.folder_id) or scene_file.suffix not in ('.usdz', '.usdc', '.usda'):
+                continue
+            if scene_file.exists():
+                return PreviewRequest(entry.folder_id, scene_file)
+
+    @classmethod
+    def _start_preview(cls, request: PreviewRequest):
+        """ Create a preview image of a finished job or a download """
+        job = cls.get_job_by_id(request.job_id) if request.job_id is not None else None
+        if (request.job_id is not None and job is None) or not request.scene_file.exists():
+            # Job or download was removed while the preview was waiting
+            PreviewQueue.done(request.folder_id)
+            return
+
+        img_file = request.scene_file.with_suffix(App.config.get('PREVIEW_IMG_SUFFIX'))
+        args = create_usdscript_arguments('usdrecord')
+        args += [request.scene_file, img_file, '--imageWidth', '400', '--renderer', 'GL']
 
+        finished_callback = functools.partial(cls._preview_image_generated, request)
+        failed_callback = functools.partial(cls._preview_failed, request)
+
+        if job is None:
+            process = RunProcess(args, request.scene_file.parent, usd_env(), 0, finished_callback, failed_callback,
+                                 stage=STAGE_PREVIEW, timeout=cls._stage_timeout(STAGE_PREVIEW),
+                                 limits=cls._process_limits(STAGE_PREVIEW, 0))
+            process.start()
+            _logger.info('Started preview image backfill of download %s', request.folder_id)
+            return
+
+        job.set_preview_file(img_file)
         job.add_arguments_message(args)
 
-        post_process_thread = RunProcess(args, job.job_dir(), usd_env(), job.job_id,
-                                         cls._preview_image_generated, None, cls._message_callback)
-        post_process_thread.start()
-        _logger.info('Started preview image generation thread with id: %s', post_process_thread.ident)
+        process = RunProcess(args, request.scene_file.parent, usd_env(), job.job_id,
+                             finished_callback, failed_callback, cls._message_callback,
+                             cls._usage_callback, STAGE_PREVIEW, cls._stage_timeout(STAGE_PREVIEW),
+                             cls.job_log_file(job.job_id), cls._process_limits(STAGE_PREVIEW, job.job_id))
+        cls._track_process(job.job_id, process)
+        process.start()
+        _logger.info('Started preview image generation of job %s', job.job_id)
         db.session.commit()
 
     @classmethod
-    def _preview_image_generated(cls, thread_id: int):
-        with App.app_context():
-            job = cls.get_job_by_id(thread_id)
-            job.set_preview_image_static()
-            db.session.commit()
+    def _preview_image_generated(cls, request: PreviewRequest, thread_id: int):
+        try:
+            if request.job_id is None:
+                with App.app_context():
+                    DownloadIndex.update_folder(request.folder_id, commit=False)
+                    img_file = request.scene_file.with_suffix(App.config.get('PREVIEW_IMG_SUFFIX'))
+                    ConversionJob.query.filter_by(folder_id=request.folder_id).update(
+                        {'preview_url': ConversionJob._download_url(img_file)}, synchronize_session=False)
+                    db.session.commit()
+                return
+
+            JobMessageSink.flush(thread_id)
+
+            with App.app_context():
+                job = cls.get_job_by_id(thread_id)
+                if job is None:
+                    return
+                job.set_preview_image_static()
+                db.session.commit()
+
+                ResultCache.store_preview(job.input_digest, job.preview_file())
+        finally:
+            PreviewQueue.done(request.folder_id)
+            cls.run_preview_queue()
+
+    @classmethod
+    def _preview_failed(cls, request: PreviewRequest, thread_id: int, error: str):
+        _logger.info('Preview image of %s could not be created: %s', request.folder_id, error)
+        if request.job_id is not None:
+            JobMessageSink.flush(thread_id)
+
+        PreviewQueue.done(request.folder_id)
+        cls.run_preview_queue()
 
     @classmethod
     def _failed_callback(cls, thread_id: int, error: str):
-        with App.app_context():
-            _logger.info('Job processing failed: %s', error)
-            cls.get_job_by_id(thread_id).set_failed(error)
-            db.session.commit()
-            cls.run_job_queue()
+        JobMessageSink.flush(thread_id)
+
+        with App.app_context(), cls._job_result(thread_id) as job:
+            if job is not None:
+                _logger.info('Job processing failed: %s', error)
+                # Messages only contain marked lines, add the context of the failure
+                tail = cls.job_log_tail(thread_id, App.config.get('JOB_FAILURE_OUTPUT_BYTES', 4096)).strip()
+                if tail:
+                    JobMessageSink.append(thread_id, f'Last process output:\n{tail}')
+                    JobMessageSink.flush(thread_id)
+                job.set_failed(error)
+                db.session.commit()
+
+        cls._release_slot(thread_id)
+        cls.run_job_queue()
+        cls.run_preview_queue()
 
     @classmethod
     def _finished_callback(cls, thread_id: int):
-        with App.app_context():
-            job = cls.get_job_by_id(thread_id)
+        JobMessageSink.flush(thread_id)
+
+        with App.app_context(), cls._job_result(thread_id) as job:
+            if job is None:
+                cls._release_slot(thread_id)
+                return
 
             # -- Post process alembic input --
             if cls._run_post_process(job):
+                JobMessageSink.flush(thread_id)
                 return
 
             _logger.info('Job processing finished.')
             job.set_complete()
             db.session.commit()
 
-            # -- Try to create scene preview image --
-            cls._run_usdrecord(job)
+            if job.state == ConversionJob.States.finished:
+                ResultCache.store(job.input_digest, job.out_file())
+
+            # -- Queue scene preview image, rendered apart from the conversion slots --
+            cls._queue_preview(job)
+            JobMessageSink.flush(thread_id)
+
+        cls._release_slot(thread_id)
         cls.run_job_queue()
+        cls.run_preview_queue()
 
     @classmethod
-    def _message_callback(cls, thread_id: int, message):
+    def _usage_callback(cls, thread_id: int, usage: dict):
+        _logger.info('Job %s stage %s took %ss, cpu %s/%ss, peak rss %s kB', thread_id, usage.get('stage'),
+                     usage.get('wall_seconds'), usage.get('cpu_user'), usage.get('cpu_system'),
+                     usage.get('max_rss_kb'))
+
         with App.app_context():
-            cls.get_job_by_id(thread_id).message_update(message)
-            db.session.commit()
+            job = cls.get_job_by_id(thread_id)
+            if job is not None:
+                job.add_stage_usage(usage)
+                db.session.commit()
+
+    @classmethod
+    def _message_callback(cls, thread_id: int, message):
+        JobMessageSink.append(thread_id, message)
+        JobStateRegistry.output(thread_id, message)
+
+
+DownloadIndex.on_remove(JobManager.clear_download_urls)
+
+Metrics.register(Gauge('usdz_jobs', 'Jobs by state.', ('state',), collect=JobStateCounts.collect))
+Metrics.register(Gauge('usdz_jobs_running', 'Jobs occupying a conversion worker slot.',
+                       collect=lambda: {tuple(): JobManager.running_jobs()}))
+Metrics.register(Gauge('usdz_worker_slots', 'Configured conversion worker slots.',
+                       collect=lambda: {tuple(): len(JobManager._slots)}))
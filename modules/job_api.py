@@ -0,0 +1,174 @@
+import csv
+import io
+from types import SimpleNamespace
+from typing import Iterable, Iterator, List, Tuple, Union
+
+from modules.app import App, db
+from modules.job import ConversionJob, JobManager, JobScheduler
+from modules.job_state import JobStateRegistry
+from modules.log import setup_logger
+from modules.site import Urls
+
+_logger = setup_logger(__name__)
+
+# Fields of the job listing. Heavy columns, messages and files, are only served by the job detail.
+JOB_LIST_FIELDS = ('job_id', 'state', 'state_name', 'progress', 'completed', 'errors', 'scene_name',
+                   'download_url', 'preview_url', 'share_id', 'messages_length', 'lane', 'priority',
+                   'estimated_seconds', 'eta_seconds')
+JOB_LIST_MAX_LIMIT = 100
+USAGE_EXPORT_FIELDS = ('stage', 'started', 'wall_seconds', 'cpu_user', 'cpu_system', 'max_rss_kb',
+                       'read_bytes', 'write_bytes', 'exitcode')
+
+
+def parse_job_states(states_arg: str) -> List[int]:
+    """ Parse 'queued,failed' or '0,4' query argument into job states """
+    names = {name.lower().replace(' ', '_'): state for state, name in ConversionJob.state_names.items()}
+    states = list()
+
+    for entry in states_arg.split(','):
+        entry = entry.strip().lower()
+        if entry.isdigit():
+            states.append(int(entry))
+        elif entry in names:
+            states.append(names[entry])
+
+    return states
+
+
+def parse_job_fields(fields_arg: str) -> Tuple[str, ...]:
+    fields = tuple(f for f in fields_arg.split(',') if f in JOB_LIST_FIELDS)
+    return fields or JOB_LIST_FIELDS
+
+
+def _summary(row, fields: Iterable[str], eta: dict = None) -> dict:
+    """ Create a job listing entry from a projection row without touching the filesystem """
+    finished = row.state == ConversionJob.States.finished and bool(row.download_url)
+
+    summary = {'job_id': row.job_id, 'state': row.state,
+               'state_name': ConversionJob.state_names.get(row.state, 'No job state set'),
+               'progress': row.progress or 0, 'completed': bool(row.completed), 'errors': row.errors or '',
+               'scene_name': row.scene_name or '',
+               'download_url': row.download_url if finished else None,
+               'preview_url': row.preview_url or None,
+               'share_id': row.folder_id if finished else None,
+               'messages_length': getattr(row, 'messages_length', None),
+               'lane': row.lane, 'priority': row.priority or 0, 'estimated_seconds': row.estimated_seconds,
+               'eta_seconds': (eta or dict()).get(row.job_id) if not row.completed else None}
+
+    # Running jobs report their live state, the database only receives stage changes and written behind progress
+    live = JobStateRegistry.get(row.job_id) if not row.completed else None
+    if live is not None:
+        summary.update({'state': live['state'], 'progress': max(summary['progress'], live['progress']),
+                        'state_name': ConversionJob.state_names.get(live['state'], 'No job state set')})
+
+    return {f: summary[f] for f in fields}
+
+
+def list_jobs(limit: int, before: int = None, after: int = None, states: List[int] = None,
+              fields: Tuple[str, ...] = JOB_LIST_FIELDS) -> Tuple[List[dict], Union[None, int]]:
+    """ Keyset paginated job listing, newest first. Pass before=job_id to page through older jobs or
+        after=job_id to receive jobs created since. Returns the jobs and the cursor of the next page.
+    """
+    limit = max(1, min(limit, JOB_LIST_MAX_LIMIT))
+    columns = [ConversionJob.job_id, ConversionJob.state, ConversionJob.progress, ConversionJob.completed,
+               ConversionJob.errors, ConversionJob.scene_name, ConversionJob.folder_id,
+               ConversionJob.lane, ConversionJob.priority, ConversionJob.estimated_seconds,
+               ConversionJob.download_url, ConversionJob.preview_url]
+
+    if 'messages_length' in fields:
+        columns.append(db.func.coalesce(db.func.length(ConversionJob.process_messages), 0
+                                        ).label('messages_length'))
+
+    query = db.session.query(*columns)
+
+    if states:
+        query = query.filter(ConversionJob.state.in_(states))
+    if before is not None:
+        query = query.filter(ConversionJob.job_id < before)
+
+    if after is not None:
+        # Oldest jobs after the cursor first, returned newest first like every other page
+        rows = query.filter(ConversionJob.job_id > after).order_by(ConversionJob.job_id).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
+        next_cursor = rows[0].job_id if has_more and rows else None
+    else:
+        rows = query.order_by(ConversionJob.job_id.desc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = rows[-1].job_id if has_more and rows else None
+
+    eta = dict()
+    if 'eta_seconds' in fields and any(not row.completed for row in rows):
+        eta = JobScheduler.estimate_completion(_workers())
+
+    return [_summary(row, fields, eta) for row in rows], next_cursor
+
+
+def _workers() -> int:
+    return max(1, int(App.config.get('CONVERSION_WORKERS') or 1))
+
+
+def job_detail(job_id: int) -> Union[None, dict]:
+    """ Full job including process messages, files and arguments """
+    job = JobManager.get_job_by_id(job_id)
+    if job is None:
+        return
+
+    row = {c: getattr(job, c) for c in ('job_id', 'state', 'progress', 'completed', 'errors', 'scene_name',
+                                        'folder_id', 'lane', 'priority', 'estimated_seconds', 'download_url',
+                                        'preview_url')}
+    row['messages_length'] = len(job.process_messages or '')
+
+    live = JobStateRegistry.get(job_id) or dict()
+    eta = JobScheduler.estimate_completion(_workers()) if not job.completed else None
+    detail = _summary(SimpleNamespace(**row), JOB_LIST_FIELDS, eta)
+    detail.update({'messages': job.process_messages or '', 'additional_args': job.additional_args or '',
+                   'option_args': list(job.option_args or list()),
+                   'resource_usage': job.resource_usage or list(), 'duration_seconds': job.duration_seconds,
+                   'input_bytes': job.input_bytes, 'texture_count': job.texture_count,
+                   'stage': live.get('stage'), 'last_output': live.get('last_output'),
+                   'log_tail': JobManager.job_log_tail(job_id),
+                   'log_url': f'{Urls.api_jobs}/{job_id}/log' if JobManager.job_log_file(job_id).exists() else None,
+                   'files': [dict(zip(('id', 'file', 'channel', 'material', 'uv_set', 'map_type', 'color'), f))
+                             for f in job.list_files()]})
+    return detail
+
+
+def job_status(job_id: int) -> Union[None, dict]:
+    """ State and progress of a job. Running jobs are served without a database query. """
+    live = JobStateRegistry.get(job_id)
+    if live is not None:
+        live.update({'state_name': ConversionJob.state_names.get(live['state'], 'No job state set'),
+                     'completed': False})
+        return live
+
+    row = db.session.query(ConversionJob.state, ConversionJob.progress, ConversionJob.completed
+                           ).filter(ConversionJob.job_id == job_id).first()
+    if row is None:
+        return
+
+    return {'job_id': job_id, 'state': row.state, 'progress': row.progress or 0,
+            'state_name': ConversionJob.state_names.get(row.state, 'No job state set'),
+            'completed': bool(row.completed), 'stage': None, 'last_output': None, 'updated': None}
+
+
+def export_resource_usage() -> Iterator[str]:
+    """ CSV with one line per recorded job stage """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(('job_id', 'scene_name', 'state') + USAGE_EXPORT_FIELDS)
+
+    query = db.session.query(ConversionJob.job_id, ConversionJob.scene_name, ConversionJob.state,
+                             ConversionJob.resource_usage).order_by(ConversionJob.job_id)
+
+    for job_id, scene_name, state, resource_usage in query.yield_per(500):
+        for usage in resource_usage or list():
+            writer.writerow((job_id, scene_name, ConversionJob.state_names.get(state, ''))
+                            + tuple(usage.get(f) for f in USAGE_EXPORT_FIELDS))
+
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue()
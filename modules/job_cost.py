@@ -0,0 +1,128 @@
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, Tuple, Union
+
+from modules.log import setup_logger
+
+_logger = setup_logger(__name__)
+
+# Estimate used for scene types without enough finished jobs: seconds base, per MB input, per texture
+DEFAULT_COST = (10.0, 2.0, 1.0)
+# Alembic input runs the additional post process
+DEFAULT_COST_FACTOR = {'.abc': 3.0}
+# Finished jobs required before the fitted model of a scene type is used
+MIN_SAMPLES = 5
+# Regularisation keeps the fit stable when sizes or texture counts barely vary
+RIDGE = 1e-3
+
+Sample = Tuple[float, int, float]
+
+
+def _solve(matrix: List[List[float]], vector: List[float]) -> Union[None, List[float]]:
+    """ Solve a small linear system by gaussian elimination, None if it is singular """
+    n = len(vector)
+    m = [row[:] + [v] for row, v in zip(matrix, vector)]
+
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+
+        for row in range(col + 1, n):
+            factor = m[row][col] / m[col][col]
+            for k in range(col, n + 1):
+                m[row][k] -= factor * m[col][k]
+
+    result = [0.0] * n
+    for row in reversed(range(n)):
+        result[row] = (m[row][n] - sum(m[row][k] * result[k] for k in range(row + 1, n))) / m[row][row]
+    return result
+
+
+class JobCostModel:
+    """ Estimates the conversion seconds of a job from scene type, input size and texture count.
+        Fits seconds = base + per_mb * MB + per_texture * textures per scene suffix on recent finished jobs.
+    """
+    history = 200
+
+    _samples: Dict[str, deque] = dict()
+    _coefficients: Dict[str, Tuple[float, float, float]] = dict()
+    _loaded = False
+    _lock = threading.Lock()
+
+    @classmethod
+    def is_loaded(cls) -> bool:
+        return cls._loaded
+
+    @classmethod
+    def load(cls, samples: Iterable[Tuple[str, int, int, float]], history: int = 200):
+        """ Load finished jobs as (suffix, input_bytes, texture_count, seconds), oldest first """
+        with cls._lock:
+            cls.history = history
+            cls._samples, cls._coefficients = dict(), dict()
+            for suffix, input_bytes, texture_count, seconds in samples:
+                cls._add(suffix, input_bytes, texture_count, seconds)
+            cls._loaded = True
+
+    @classmethod
+    def add(cls, suffix: str, input_bytes: int, texture_count: int, seconds: float):
+        with cls._lock:
+            cls._add(suffix, input_bytes, texture_count, seconds)
+
+    @classmethod
+    def _add(cls, suffix: str, input_bytes: int, texture_count: int, seconds: float):
+        if seconds is None or seconds < 0:
+            return
+
+        suffix = (suffix or '').lower()
+        samples = cls._samples.setdefault(suffix, deque(maxlen=cls.history))
+        samples.append(((input_bytes or 0) / 1048576, texture_count or 0, seconds))
+        cls._coefficients.pop(suffix, None)
+
+    @classmethod
+    def estimate(cls, suffix: str, input_bytes: int, texture_count: int) -> float:
+        suffix = (suffix or '').lower()
+        with cls._lock:
+            base, per_mb, per_texture = cls._get_coefficients(suffix)
+
+        seconds = base + per_mb * (input_bytes or 0) / 1048576 + per_texture * (texture_count or 0)
+        return round(max(1.0, seconds), 1)
+
+    @classmethod
+    def _get_coefficients(cls, suffix: str) -> Tuple[float, float, float]:
+        if suffix in cls._coefficients:
+            return cls._coefficients[suffix]
+
+        samples = cls._samples.get(suffix, list())
+        coefficients = cls._fit(samples) if len(samples) >= MIN_SAMPLES else None
+        if coefficients is None:
+            factor = DEFAULT_COST_FACTOR.get(suffix, 1.0)
+            coefficients = tuple(c * factor for c in DEFAULT_COST)
+
+        cls._coefficients[suffix] = coefficients
+        return coefficients
+
+    @staticmethod
+    def _fit(samples: Iterable[Sample]) -> Union[None, Tuple[float, float, float]]:
+        """ Least squares fit of seconds on [1, MB, textures] """
+        xtx = [[0.0] * 3 for _ in range(3)]
+        xty = [0.0] * 3
+
+        for mb, textures, seconds in samples:
+            x = (1.0, mb, float(textures))
+            for i in range(3):
+                xty[i] += x[i] * seconds
+                for j in range(3):
+                    xtx[i][j] += x[i] * x[j]
+
+        for i in (1, 2):
+            xtx[i][i] += RIDGE
+
+        result = _solve(xtx, xty)
+        if result is None:
+            return None
+
+        # Larger inputs never convert faster
+        base, per_mb, per_texture = result
+        return max(0.0, base), max(0.0, per_mb), max(0.0, per_texture)
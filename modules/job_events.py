@@ -0,0 +1,21 @@
+import threading
+
+
+class JobEvents:
+    """ Revision counter that lets job status streams sleep until any job changed """
+    revision = 0
+    _condition = threading.Condition()
+
+    @classmethod
+    def notify(cls):
+        with cls._condition:
+            cls.revision += 1
+            cls._condition.notify_all()
+
+    @classmethod
+    def wait(cls, revision: int, timeout: float) -> int:
+        """ Block until the revision differs from the provided revision or timeout. Returns current revision. """
+        with cls._condition:
+            if cls.revision == revision:
+                cls._condition.wait(timeout)
+            return cls.revision
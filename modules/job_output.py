@@ -0,0 +1,128 @@
+import re
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Callable, Dict, Union
+
+from modules.log import setup_logger
+
+_logger = setup_logger(__name__)
+
+# Only output lines with one of these markers are forwarded as job messages
+MARKER_PATTERN = re.compile(rb'error|warning|fail|exception|traceback|input file|output file|\d\s?%', re.IGNORECASE)
+# Incomplete lines are forwarded once they grow beyond this size
+MAX_PARTIAL_LINE = 64 * 1024
+
+
+def _decode(data: bytes) -> str:
+    return data.decode('utf-8', errors='replace')
+
+
+class JobOutput:
+    """ Receives raw process output in large chunks. Output is appended to the per-job log file and
+        a bounded tail buffer, lines are only split and decoded if a chunk contains a marker.
+    """
+    tail_bytes = 64 * 1024
+
+    _outputs: Dict[int, 'JobOutput'] = dict()
+    _lock = threading.Lock()
+
+    def __init__(self, job_id: int, log_file: Union[None, Path], message_callback: Callable[[str], None] = None):
+        self.job_id = job_id
+        self.log_file = log_file
+        self.message_callback = message_callback
+
+        self._tail = deque()
+        self._tail_size = 0
+        self._tail_lock = threading.Lock()
+        self._partial = b''
+        self._file = None
+
+        if log_file is not None:
+            try:
+                log_file.parent.mkdir(parents=True, exist_ok=True)
+                self._file = open(log_file.as_posix(), 'ab')
+            except OSError as e:
+                _logger.error('Could not open job log file %s: %s', log_file, e)
+
+    @classmethod
+    def open(cls, job_id: int, log_file: Union[None, Path],
+             message_callback: Callable[[str], None] = None) -> 'JobOutput':
+        output = cls(job_id, log_file, message_callback)
+        with cls._lock:
+            cls._outputs[job_id] = output
+        return output
+
+    @classmethod
+    def get(cls, job_id: int) -> Union[None, 'JobOutput']:
+        with cls._lock:
+            return cls._outputs.get(job_id)
+
+    def write(self, data: bytes):
+        if not data:
+            return
+
+        if self._file is not None:
+            self._file.write(data)
+
+        with self._tail_lock:
+            self._tail.append(data)
+            self._tail_size += len(data)
+            while self._tail_size - len(self._tail[0]) >= self.tail_bytes:
+                self._tail_size -= len(self._tail.popleft())
+
+        # Only complete lines are parsed, the remainder waits for the next chunk
+        end = data.rfind(b'\n')
+        if end < 0:
+            self._partial += data
+            if len(self._partial) > MAX_PARTIAL_LINE:
+                self._forward(self._partial)
+                self._partial = b''
+            return
+
+        lines, self._partial = self._partial + data[:end], data[end + 1:]
+        self._forward(lines)
+
+    def _forward(self, lines: bytes):
+        if self.message_callback is None or not MARKER_PATTERN.search(lines):
+            return
+
+        for line in lines.splitlines():
+            if MARKER_PATTERN.search(line):
+                self.message_callback(_decode(line).rstrip())
+
+    def message(self, text: str):
+        """ Add a message of the supervisor eg. a timeout to the log and the job messages """
+        if self._file is not None:
+            self._file.write(f'{text}\n'.encode('utf-8'))
+        if self.message_callback is not None:
+            self.message_callback(text)
+
+    def tail(self, limit: int = None) -> str:
+        with self._tail_lock:
+            data = b''.join(self._tail)
+        return _decode(data[-limit:] if limit else data)
+
+    def close(self):
+        if self._partial:
+            self._forward(self._partial)
+            self._partial = b''
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        with self._lock:
+            if self._outputs.get(self.job_id) is self:
+                self._outputs.pop(self.job_id)
+
+    @staticmethod
+    def read_tail(log_file: Path, limit: int) -> str:
+        """ Read the end of a job log file """
+        try:
+            with open(log_file.as_posix(), 'rb') as f:
+                f.seek(0, 2)
+                f.seek(max(0, f.tell() - limit))
+                return _decode(f.read())
+        except OSError:
+            return ''
@@ -0,0 +1,96 @@
+import re
+import threading
+import time
+from typing import Dict, Tuple, Union
+
+# Progress reported by converter output eg. "Converting textures 40%"
+PERCENT_PATTERN = re.compile(r'(\d{1,3})\s?%')
+
+
+class LiveJobState:
+    __slots__ = ('job_id', 'state', 'stage', 'progress', 'progress_range', 'last_output', 'updated', 'dirty')
+
+    def __init__(self, job_id: int, state: int, stage: str, progress: int, progress_range: Tuple[int, int]):
+        self.job_id = job_id
+        self.state = state
+        self.stage = stage
+        self.progress = progress
+        # Stage percentages are mapped into this range of the job progress
+        self.progress_range = progress_range
+        self.last_output = ''
+        self.updated = time.time()
+        self.dirty = False
+
+    def as_dict(self) -> dict:
+        return {'job_id': self.job_id, 'state': self.state, 'stage': self.stage, 'progress': self.progress,
+                'last_output': self.last_output, 'updated': self.updated}
+
+
+class JobStateRegistry:
+    """ Live state of the jobs running in this server process, updated by the JobManager callbacks.
+        Status reads of running jobs are served from here. Stage transitions are committed by the JobManager,
+        progress parsed from the process output is written behind to the database by the message sink.
+    """
+    _jobs: Dict[int, LiveJobState] = dict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def start(cls, job_id: int, state: int, stage: str, progress: int, progress_range: Tuple[int, int]):
+        with cls._lock:
+            cls._jobs[job_id] = LiveJobState(job_id, state, stage, progress, progress_range)
+
+    @classmethod
+    def transition(cls, job_id: int, state: int, stage: str, progress: int, progress_range: Tuple[int, int]):
+        """ Stage change that the caller commits to the database """
+        with cls._lock:
+            live = cls._jobs.get(job_id)
+            if live is None:
+                return
+            live.state, live.stage, live.progress_range = state, stage, progress_range
+            live.progress = max(live.progress, progress)
+            live.updated, live.dirty = time.time(), False
+
+    @classmethod
+    def output(cls, job_id: int, line: str):
+        """ Record the last marked output line and the stage progress it reports """
+        match = PERCENT_PATTERN.search(line)
+
+        with cls._lock:
+            live = cls._jobs.get(job_id)
+            if live is None:
+                return
+
+            live.last_output, live.updated = line, time.time()
+            if match is None:
+                return
+
+            start, end = live.progress_range
+            progress = start + (end - start) * min(100, int(match.group(1))) // 100
+            if progress > live.progress:
+                live.progress, live.dirty = progress, True
+
+    @classmethod
+    def get(cls, job_id: int) -> Union[None, dict]:
+        with cls._lock:
+            live = cls._jobs.get(job_id)
+            return live.as_dict() if live is not None else None
+
+    @classmethod
+    def is_active(cls, job_id: int) -> bool:
+        with cls._lock:
+            return job_id in cls._jobs
+
+    @classmethod
+    def finish(cls, job_id: int):
+        """ The final state was committed, reads go to the database again """
+        with cls._lock:
+            cls._jobs.pop(job_id, None)
+
+    @classmethod
+    def take_dirty(cls) -> Dict[int, int]:
+        """ Progress changed since the last write behind """
+        with cls._lock:
+            dirty = {job_id: live.progress for job_id, live in cls._jobs.items() if live.dirty}
+            for job_id in dirty:
+                cls._jobs[job_id].dirty = False
+            return dirty
@@ -0,0 +1,154 @@
+import json
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+
+from modules.app import App, db
+from modules.job import ConversionJob
+from modules.job_events import JobEvents
+from modules.job_state import JobStateRegistry
+from modules.log import setup_logger
+from modules.metrics import Gauge, Metrics
+
+_logger = setup_logger(__name__)
+
+# Comment line sent to keep proxies from closing an idle stream
+KEEP_ALIVE_SECONDS = 15.0
+# Job changes are collected at most once per this interval, bursts of commits wake a stream only once
+MIN_UPDATE_SECONDS = 1.0
+
+
+class JobStreams:
+    """ Counts the open job status streams, every stream occupies a server thread while connected """
+    _open = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def acquire(cls, max_streams: int) -> bool:
+        """ Reserve a stream, returns False if max_streams are open. 0 does not limit streams. """
+        with cls._lock:
+            if max_streams and cls._open >= max_streams:
+                return False
+            cls._open += 1
+            return True
+
+    @classmethod
+    def release(cls):
+        with cls._lock:
+            cls._open = max(0, cls._open - 1)
+
+    @classmethod
+    def open_streams(cls) -> int:
+        with cls._lock:
+            return cls._open
+
+
+def parse_stream_offsets(jobs_arg: str) -> Dict[int, int]:
+    """ Parse 'job_id:message_offset,job_id:message_offset' query argument """
+    offsets = dict()
+
+    for entry in jobs_arg.split(','):
+        job_id, _, offset = entry.partition(':')
+        if job_id.isdigit():
+            offsets[int(job_id)] = int(offset) if offset.isdigit() else 0
+
+    return offsets
+
+
+def _collect_updates(offsets: Dict[int, int], known: Dict[int, tuple], last_job_id: int) -> Tuple[List[dict], bool]:
+    """ Query state, progress and new messages of the watched jobs. Reports if the job list changed. """
+    updates, reload = list(), False
+
+    if not offsets:
+        rows = list()
+    else:
+        rows = db.session.query(ConversionJob.job_id, ConversionJob.state, ConversionJob.progress,
+                                ConversionJob.completed, db.func.length(ConversionJob.process_messages)
+                                ).filter(ConversionJob.job_id.in_(offsets.keys())).all()
+
+    for job_id, state, progress, completed, messages_length in rows:
+        live = JobStateRegistry.get(job_id) if not completed else None
+        if live is not None:
+            state, progress = live['state'], max(progress or 0, live['progress'])
+
+        messages = str()
+        if (messages_length or 0) > offsets[job_id]:
+            messages = db.session.query(db.func.substr(ConversionJob.process_messages, offsets[job_id] + 1)
+                                        ).filter(ConversionJob.job_id == job_id).scalar() or str()
+            offsets[job_id] += len(messages)
+
+        if not messages and known.get(job_id) == (state, progress):
+            continue
+
+        known[job_id] = (state, progress)
+        updates.append({'job_id': job_id, 'state': state, 'state_name': ConversionJob.state_names.get(state, ''),
+                        'progress': progress or 0, 'completed': bool(completed), 'messages': messages,
+                        'offset': offsets[job_id]})
+
+        # Finished jobs need to render their download actions
+        reload = reload or bool(completed)
+
+    newest_job_id = db.session.query(db.func.max(ConversionJob.job_id)).scalar() or 0
+    db.session.commit()
+
+    return updates, reload or newest_job_id > last_job_id
+
+
+def job_status_snapshot(offsets: Dict[int, int], last_job_id: int) -> dict:
+    """ Current state of the watched jobs for clients polling instead of streaming """
+    with App.app_context():
+        updates, reload = _collect_updates(offsets, dict(), last_job_id)
+    return {'jobs': updates, 'reload': reload}
+
+
+def _events(updates: List[dict], reload: bool) -> Iterator[str]:
+    for update in updates:
+        yield f'event: job\ndata: {json.dumps(update)}\n\n'
+
+    if reload:
+        yield 'event: reload\ndata: {}\n\n'
+
+
+def job_status_stream(offsets: Dict[int, int], last_job_id: int, max_seconds: float) -> Iterator[str]:
+    """ Server-Sent Events of unfinished jobs. The current state of the watched jobs is sent on connect.
+        The stream ends with an end event after max_seconds to free the server thread, clients reconnect
+        with their current message offsets.
+    """
+    known: Dict[int, tuple] = dict()
+    deadline = time.monotonic() + max_seconds
+
+    revision = JobEvents.revision
+    with App.app_context():
+        updates, reload = _collect_updates(offsets, known, last_job_id)
+
+    # Sent before anything else so the response starts without waiting for the first change
+    yield f'event: ready\ndata: {json.dumps({"jobs": len(offsets)})}\n\n'
+    yield from _events(updates, reload)
+    if reload:
+        return
+
+    collected = time.monotonic()
+    while time.monotonic() < deadline:
+        current_revision = JobEvents.wait(revision, max(0.0, min(KEEP_ALIVE_SECONDS, deadline - time.monotonic())))
+        if current_revision == revision:
+            yield ': keep-alive\n\n'
+            continue
+
+        # Let further commits of a burst arrive before querying the database
+        time.sleep(max(0.0, min(collected + MIN_UPDATE_SECONDS, deadline) - time.monotonic()))
+
+        revision = JobEvents.revision
+        with App.app_context():
+            updates, reload = _collect_updates(offsets, known, last_job_id)
+        collected = time.monotonic()
+
+        yield from _events(updates, reload)
+        if reload:
+            return
+
+    # Clients reconnect right away instead of treating the closed connection as an error
+    yield 'event: end\ndata: {}\n\n'
+
+
+Metrics.register(Gauge('usdz_job_streams_open', 'Connected job status streams.',
+                       collect=lambda: {tuple(): JobStreams.open_streams()}))
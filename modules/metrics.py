@@ -0,0 +1,167 @@
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from modules.log import setup_logger
+
+_logger = setup_logger(__name__)
+
+# Stage durations range from a static file move to hour long conversions of huge scenes
+STAGE_DURATION_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+# Database waits are fractions of a millisecond unless writers queue on the SQLite lock
+DB_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = '') -> str:
+    labels = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class _Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = tuple()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    def _samples(self) -> Iterable[Tuple[str, str, float]]:
+        return list()
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.metric_type}']
+        for suffix, labels, value in self._samples():
+            lines.append(f'{self.name}{suffix}{labels} {value}')
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = tuple()):
+        super(Counter, self).__init__(name, description, label_names)
+        self._values: Dict[LabelValues, float] = dict()
+
+    def inc(self, amount: float = 1.0, *label_values: str):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def _samples(self):
+        with self._lock:
+            return [('', _format_labels(self.label_names, k), v) for k, v in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    """ Gauge with values set or read from a callback at render time """
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = tuple(),
+                 collect: Callable[[], Dict[LabelValues, float]] = None):
+        super(Gauge, self).__init__(name, description, label_names)
+        self._values: Dict[LabelValues, float] = dict()
+        self._collect = collect
+
+    def set(self, value: float, *label_values: str):
+        with self._lock:
+            self._values[label_values] = value
+
+    def _samples(self):
+        if self._collect is not None:
+            values = self._collect()
+        else:
+            with self._lock:
+                values = dict(self._values)
+
+        return [('', _format_labels(self.label_names, k), v) for k, v in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = tuple(),
+                 buckets: Tuple[float, ...] = STAGE_DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, description, label_names)
+        self.buckets = buckets
+        # label values: [bucket counts..., count, sum]
+        self._values: Dict[LabelValues, List[float]] = dict()
+
+    def observe(self, value: float, *label_values: str):
+        with self._lock:
+            entry = self._values.setdefault(label_values, [0] * (len(self.buckets) + 1) + [0.0])
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[idx] += 1
+            entry[-2] += 1
+            entry[-1] += value
+
+    def _samples(self):
+        samples = list()
+        with self._lock:
+            for label_values, entry in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, entry):
+                    le = _format_labels(self.label_names, label_values, f'le="{bound}"')
+                    samples.append(('_bucket', le, count))
+                labels = _format_labels(self.label_names, label_values)
+                samples.append(('_bucket', _format_labels(self.label_names, label_values, 'le="+Inf"'), entry[-2]))
+                samples.append(('_count', labels, entry[-2]))
+                samples.append(('_sum', labels, round(entry[-1], 6)))
+        return samples
+
+
+class Metrics:
+    """ Process wide metrics exported in Prometheus text format. Everything is kept in memory,
+        a scrape never queries the database.
+    """
+    _metrics: List[_Metric] = list()
+    started = time.time()
+
+    @classmethod
+    def register(cls, metric: _Metric) -> _Metric:
+        cls._metrics.append(metric)
+        return metric
+
+    @classmethod
+    def render(cls) -> str:
+        lines = list()
+        for metric in cls._metrics:
+            try:
+                lines += metric.render()
+            except Exception as e:
+                _logger.error('Could not render metric %s: %s', metric.name, e)
+        return '\n'.join(lines) + '\n'
+
+
+uptime = Metrics.register(Gauge('usdz_uptime_seconds', 'Seconds since the server process started.',
+                                collect=lambda: {tuple(): round(time.time() - Metrics.started, 1)}))
+stage_duration = Metrics.register(Histogram('usdz_stage_duration_seconds',
+                                            'Duration of conversion, post process, preview and static move stages.',
+                                            ('stage',)))
+job_failures = Metrics.register(Counter('usdz_job_failures_total', 'Failed jobs by failure reason.', ('reason',)))
+upload_bytes = Metrics.register(Counter('usdz_upload_bytes_total', 'Bytes received by uploads.', ('method',)))
+upload_seconds = Metrics.register(Counter('usdz_upload_seconds_total', 'Seconds spent receiving uploads. '
+                                          'rate(bytes) / rate(seconds) is the upload throughput.', ('method',)))
+share_bytes = Metrics.register(Counter('usdz_share_transfer_bytes_total', 'Bytes transferred to remote share hosts.',
+                                       ('protocol',)))
+share_seconds = Metrics.register(Counter('usdz_share_transfer_seconds_total',
+                                         'Seconds spent transferring files to remote share hosts.', ('protocol',)))
+share_failures = Metrics.register(Counter('usdz_share_failures_total', 'Failed remote shares by failure reason.',
+                                          ('reason',)))
+db_pool_wait = Metrics.register(Histogram('usdz_db_pool_wait_seconds',
+                                           'Time sessions waited for a pooled database connection.',
+                                           buckets=DB_LATENCY_BUCKETS))
+db_commit = Metrics.register(Histogram('usdz_db_commit_seconds',
+                                        'Duration of session commits including flush and the wait for the SQLite lock.',
+                                        buckets=DB_LATENCY_BUCKETS))
+db_locked = Metrics.register(Counter('usdz_db_locked_errors_total',
+                                     'Statements that failed because the database stayed locked.'))
+admission_rejected = Metrics.register(Counter('usdz_admission_rejected_total',
+                                              'Uploads rejected by admission control by reason.', ('reason',)))
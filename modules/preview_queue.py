@@ -0,0 +1,86 @@
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Set, Union
+
+from modules.log import setup_logger
+
+_logger = setup_logger(__name__)
+
+
+class PreviewRequest:
+    def __init__(self, folder_id: str, scene_file: Path, job_id: Union[None, int] = None):
+        self.folder_id = folder_id
+        self.scene_file = scene_file
+        # Backfilled previews of older downloads do not belong to a job
+        self.job_id = job_id
+
+    def __repr__(self):
+        return f'PreviewRequest({self.folder_id}, job {self.job_id})'
+
+
+class PreviewQueue:
+    """ Preview images are rendered separately from the conversion worker slots by at most max_running
+        usdrecord processes. Previews of finished jobs wait while the conversion backlog is deep and are
+        skipped once max_pending previews are waiting, skipped previews are backfilled when the server is idle.
+    """
+    max_running = 1
+    max_pending = 50
+
+    _pending: deque = deque()
+    _running: Set[str] = set()
+    # Download folders that were rendered or failed to render since the server started
+    _attempted: Set[str] = set()
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, max_running: int, max_pending: int):
+        cls.max_running, cls.max_pending = max(0, max_running), max(0, max_pending)
+
+    @classmethod
+    def add(cls, request: PreviewRequest) -> bool:
+        with cls._lock:
+            if request.folder_id in cls._running or any(r.folder_id == request.folder_id for r in cls._pending):
+                return True
+
+            if len(cls._pending) >= cls.max_pending:
+                _logger.info('Preview queue is full, skipping preview of %s', request.folder_id)
+                return False
+
+            cls._pending.append(request)
+            return True
+
+    @classmethod
+    def pending(cls) -> int:
+        with cls._lock:
+            return len(cls._pending)
+
+    @classmethod
+    def running(cls) -> int:
+        with cls._lock:
+            return len(cls._running)
+
+    @classmethod
+    def is_attempted(cls, folder_id: str) -> bool:
+        with cls._lock:
+            return folder_id in cls._attempted
+
+    @classmethod
+    def claim(cls, backfill: Union[None, PreviewRequest] = None) -> Union[None, PreviewRequest]:
+        """ Next preview to render if a render slot is free. Job previews are served before the backfill. """
+        with cls._lock:
+            if len(cls._running) >= cls.max_running:
+                return
+
+            request = cls._pending.popleft() if cls._pending else backfill
+            if request is None or request.folder_id in cls._running:
+                return
+
+            cls._running.add(request.folder_id)
+            cls._attempted.add(request.folder_id)
+            return request
+
+    @classmethod
+    def done(cls, folder_id: str):
+        with cls._lock:
+            cls._running.discard(folder_id)
@@ -0,0 +1,163 @@
+import ctypes
+import functools
+import os
+import platform
+import sys
+from pathlib import Path
+from typing import Callable, Iterable, List, Set, Union
+
+from modules.log import setup_logger
+
+_logger = setup_logger(__name__)
+
+# ioprio_set is not wrapped by the os module, syscall numbers per architecture
+_IOPRIO_SET_SYSCALL = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+_libc = None
+
+
+def _ioprio_set(pid: int, io_class: int, level: int):
+    global _libc
+    number = _IOPRIO_SET_SYSCALL.get(platform.machine())
+    if number is None:
+        raise OSError(f'ioprio_set is not known on {platform.machine()}')
+
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+
+    ioprio = io_class << _IOPRIO_CLASS_SHIFT | (level if io_class != IONICE_CLASSES['idle'] else 0)
+    if _libc.syscall(number, _IOPRIO_WHO_PROCESS, pid, ioprio) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def available_cpus() -> List[int]:
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def slot_cpus(slot_id: int, slot_count: int, affinity: Union[None, str, list], reserved: int = 1) -> Set[int]:
+    """ CPUs a worker slot is pinned to. affinity 'auto' splits the CPUs not reserved for the web server
+        evenly across the slots, a list provides the CPUs per slot. Empty for no pinning.
+    """
+    if not affinity:
+        return set()
+
+    if isinstance(affinity, str):
+        if affinity != 'auto':
+            _logger.error('Unknown CPU affinity setting %s', affinity)
+            return set()
+
+        cpus = available_cpus()
+        # Never reserve every core for the web server
+        cpus = cpus[min(max(0, reserved), len(cpus) - 1):]
+        share = max(1, len(cpus) // max(1, slot_count))
+        start = (slot_id * share) % len(cpus)
+        return set(cpus[start:start + share])
+
+    if slot_id < len(affinity):
+        return set(affinity[slot_id] or list())
+    return set()
+
+
+class ProcessLimits:
+    """ Linux scheduling and memory controls of a converter process. New processes apply them in the child
+        before exec, children eg. usdzip inherit them. Warm workers receive the limits of every command they
+        run while they wait for the request.
+    """
+    def __init__(self, nice: int = 0, ionice: Union[None, str] = None, ionice_level: int = 7,
+                 cpus: Iterable[int] = None, memory_mb: int = 0, cgroup: Union[None, Path] = None):
+        self.nice = nice
+        self.ionice = ionice
+        self.ionice_level = ionice_level
+        self.cpus = set(cpus or set())
+        self.memory_mb = memory_mb
+        # With a cgroup the memory limit is enforced for the whole process tree instead of RLIMIT_AS
+        self.cgroup = cgroup
+
+    def apply(self, pid: int):
+        for name, error in self._apply(pid):
+            # eg. unprivileged users can not lower the nice level of a warm worker again
+            _logger.debug('Could not set %s of process %s: %s', name, pid, error)
+
+    def preexec(self) -> Union[None, Callable[[], None]]:
+        """ Popen preexec_fn applying the limits to the child before exec, None if there is nothing to apply """
+        if sys.platform != 'linux' or not (self.nice or self.ionice or self.cpus or self.memory_mb or self.cgroup):
+            return None
+
+        if self.cgroup is not None:
+            try:
+                self._prepare_cgroup()
+            except OSError as e:
+                _logger.error('Could not prepare cgroup %s: %s', self.cgroup, e)
+
+        # The child must not log, a logging lock held by another thread of the server would never be released
+        return functools.partial(self._apply, 0)
+
+    def _apply(self, pid: int) -> List[tuple]:
+        """ Apply every limit to pid, 0 for the calling process. Returns the limits that could not be set. """
+        if sys.platform != 'linux':
+            return list()
+
+        errors = list()
+        for name, method in (('nice', self._set_nice), ('ionice', self._set_ionice),
+                             ('cpu affinity', self._set_affinity), ('memory limit', self._set_memory)):
+            try:
+                method(pid)
+            except (OSError, ValueError) as e:
+                errors.append((name, e))
+        return errors
+
+    def _set_nice(self, pid: int):
+        if not self.nice:
+            return
+        current = os.getpriority(os.PRIO_PROCESS, pid)
+        if current != self.nice:
+            os.setpriority(os.PRIO_PROCESS, pid, self.nice)
+
+    def _set_ionice(self, pid: int):
+        if not self.ionice:
+            return
+        if self.ionice not in IONICE_CLASSES:
+            raise ValueError(f'Unknown ionice class {self.ionice}')
+        _ioprio_set(pid, IONICE_CLASSES[self.ionice], max(0, min(7, self.ionice_level)))
+
+    def _set_affinity(self, pid: int):
+        if self.cpus and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(pid, self.cpus)
+
+    def _set_memory(self, pid: int):
+        if self.cgroup is not None:
+            self._join_cgroup(pid)
+            return
+
+        import resource
+        _, hard = resource.prlimit(pid, resource.RLIMIT_AS)
+        # Only the soft limit is set so a warm worker can be given a higher limit for it's next command
+        soft = self.memory_mb * 1048576 if self.memory_mb else hard
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.prlimit(pid, resource.RLIMIT_AS, (soft, hard))
+
+    def _join_cgroup(self, pid: int):
+        """ Move the process into the cgroup v2 of it's worker slot. The parent cgroup has to be delegated
+            to the server user. The kernel kills the whole group if it exceeds memory.max.
+        """
+        if pid:
+            self._prepare_cgroup()
+        (self.cgroup / 'cgroup.procs').write_text(str(pid))
+
+    def _prepare_cgroup(self):
+        if not self.cgroup.exists():
+            self.cgroup.mkdir(parents=True)
+            try:
+                (self.cgroup.parent / 'cgroup.subtree_control').write_text('+memory')
+            except OSError as e:
+                _logger.debug('Could not enable the memory controller of %s: %s', self.cgroup.parent, e)
+
+        (self.cgroup / 'memory.max').write_text(str(self.memory_mb * 1048576) if self.memory_mb else 'max')
+        (self.cgroup / 'memory.oom.group').write_text('1')
@@ -0,0 +1,209 @@
+import asyncio
+import atexit
+import os
+import signal
+import subprocess as sp
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Dict, Union
+
+from modules.log import setup_logger
+from modules.process_usage import ProcessUsage, wait_process
+
+_logger = setup_logger(__name__)
+
+# Buffer limit of stream readers
+LINE_LIMIT = 2 ** 20
+# Process output is read in chunks of up to this size
+READ_SIZE = 64 * 1024
+
+
+def kill_process_tree(process: sp.Popen):
+    """ Kill a process started in it's own process group and all of it's children """
+    if process is None or process.returncode is not None:
+        return
+
+    try:
+        if sys.platform == 'win32':
+            sp.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+            # Popen.kill would reap the child before the supervisor collects it's resource usage
+            return
+    except (OSError, sp.SubprocessError) as e:
+        _logger.debug('Could not kill process group of %s: %s', process.pid, e)
+
+    # Make sure the process itself is gone even if the process group could not be signaled
+    try:
+        process.kill()
+    except OSError:
+        pass
+
+
+class ProcessSupervisor:
+    """ A single asyncio event loop thread supervising all subprocesses. Process output of every running
+        conversion is multiplexed on the loop. Finished and failed callbacks may block on the database or
+        start new processes, they are dispatched to a thread pool sized to the worker slots instead of the loop.
+
+        Subprocesses run in their own process group, detached from the server. Every group is tracked
+        and killed on shutdown, including busy warm workers and running conversions.
+    """
+    callback_threads = 2
+
+    _loop: Union[None, asyncio.AbstractEventLoop] = None
+    _thread: Union[None, threading.Thread] = None
+    _executor: Union[None, ThreadPoolExecutor] = None
+    _lock = threading.Lock()
+
+    _groups: Dict[int, sp.Popen] = dict()
+    _groups_lock = threading.Lock()
+
+    @classmethod
+    def track(cls, process: sp.Popen):
+        """ Register the process group of a started process, groups of exited processes are dropped """
+        with cls._groups_lock:
+            for pid in [pid for pid, p in cls._groups.items() if p.returncode is not None]:
+                cls._groups.pop(pid)
+            cls._groups[process.pid] = process
+
+    @classmethod
+    def live_groups(cls) -> int:
+        with cls._groups_lock:
+            return len([p for p in cls._groups.values() if p.returncode is None])
+
+    @classmethod
+    def shutdown(cls):
+        """ Kill the process group of every process that has not exited """
+        with cls._groups_lock:
+            groups, cls._groups = list(cls._groups.values()), dict()
+
+        for process in groups:
+            if process.returncode is None:
+                _logger.info('Killing process group %s on shutdown', process.pid)
+                kill_process_tree(process)
+
+    @classmethod
+    def configure(cls, callback_threads: int):
+        """ Size the callback pool, every worker slot may finish a stage and block on the database at once """
+        with cls._lock:
+            threads, cls.callback_threads = cls.callback_threads, max(1, callback_threads)
+            if cls._executor is not None and threads != cls.callback_threads:
+                # Callbacks already submitted still run on the previous pool
+                cls._executor.shutdown(wait=False)
+                cls._executor = ThreadPoolExecutor(cls.callback_threads, thread_name_prefix='process_callback')
+
+    @classmethod
+    def loop(cls) -> asyncio.AbstractEventLoop:
+        with cls._lock:
+            if cls._loop is None:
+                cls._loop = asyncio.new_event_loop()
+                cls._executor = ThreadPoolExecutor(cls.callback_threads, thread_name_prefix='process_callback')
+                cls._thread = threading.Thread(target=cls._run_loop, args=(cls._loop,), daemon=True,
+                                               name='process_supervisor')
+                cls._thread.start()
+            return cls._loop
+
+    @staticmethod
+    def _run_loop(loop: asyncio.AbstractEventLoop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    @classmethod
+    def in_loop(cls) -> bool:
+        return threading.current_thread() is cls._thread
+
+    @classmethod
+    def submit(cls, coroutine):
+        """ Schedule a coroutine on the supervisor loop from any thread """
+        return asyncio.run_coroutine_threadsafe(coroutine, cls.loop())
+
+    @classmethod
+    def call(cls, coroutine, timeout: float = None):
+        """ Run a coroutine on the supervisor loop and wait for its result. Must not be used inside the loop. """
+        if cls.in_loop():
+            coroutine.close()
+            raise RuntimeError('ProcessSupervisor.call would block the supervisor loop.')
+        return cls.submit(coroutine).result(timeout)
+
+    @classmethod
+    def call_soon(cls, callback: Callable, *args):
+        cls.loop().call_soon_threadsafe(callback, *args)
+
+    @classmethod
+    def dispatch(cls, callback: Callable, *args):
+        """ Run a callback in the callback thread pool """
+        cls.loop()
+        with cls._lock:
+            future = cls._executor.submit(callback, *args)
+        future.add_done_callback(cls._log_callback_error)
+
+    @classmethod
+    async def run_blocking(cls, callback: Callable, *args):
+        """ Await a blocking call from inside the loop """
+        return await asyncio.get_running_loop().run_in_executor(None, callback, *args)
+
+    @staticmethod
+    def _log_callback_error(future):
+        error = future.exception()
+        if error is not None:
+            _logger.error('Process callback failed: %s', error, exc_info=error)
+
+
+# Registered before the converter pool stops it's idle workers, atexit runs this last
+atexit.register(ProcessSupervisor.shutdown)
+
+
+async def connect_reader(pipe) -> Union[None, asyncio.StreamReader]:
+    """ Attach a stream reader to a pipe of a Popen process. The transport closes the pipe on EOF. """
+    if sys.platform == 'win32':
+        # Anonymous pipes of Popen are not overlapped, the proactor loop can not read them
+        return None
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=LINE_LIMIT, loop=loop)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader, loop=loop), pipe)
+    return reader
+
+
+async def read_chunk(reader: Union[None, asyncio.StreamReader], pipe) -> bytes:
+    """ Read whatever output is available, up to READ_SIZE. Empty on EOF. """
+    if reader is None:
+        return await ProcessSupervisor.run_blocking(pipe.read1, READ_SIZE)
+    return await reader.read(READ_SIZE)
+
+
+async def read_chunks(pipe) -> AsyncIterator[bytes]:
+    """ Yield output chunks of a pipe until EOF """
+    reader = await connect_reader(pipe)
+
+    while True:
+        chunk = await read_chunk(reader, pipe)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def wait_process_async(process, usage: ProcessUsage) -> int:
+    """ Wait for a Popen process without blocking the loop. Linux signals the exit on a pidfd,
+        the exited child is then reaped by wait_process to collect it's resource usage.
+    """
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except OSError:
+            pidfd = None
+
+        if pidfd is not None:
+            loop = asyncio.get_running_loop()
+            exited = loop.create_future()
+            loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(True))
+            try:
+                await exited
+            finally:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+
+            return wait_process(process, usage)
+
+    return await ProcessSupervisor.run_blocking(wait_process, process, usage)
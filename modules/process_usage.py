@@ -0,0 +1,124 @@
+import os
+import time
+from pathlib import Path
+from typing import Dict, Tuple, Union
+
+from modules.log import setup_logger
+
+_logger = setup_logger(__name__)
+
+_clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+# Stage names recorded on jobs
+STAGE_CONVERT = 'convert'
+STAGE_POST_PROCESS = 'post_process'
+STAGE_PREVIEW = 'preview'
+STAGE_STATIC_MOVE = 'static_move'
+
+
+class ProcessUsage:
+    """ Wall clock, cpu, peak memory and disk i/o of a single subprocess stage. Values that the platform
+        can not provide remain None.
+    """
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.started = time.time()
+        self.wall_seconds = 0.0
+        self.cpu_user: Union[None, float] = None
+        self.cpu_system: Union[None, float] = None
+        self.max_rss_kb: Union[None, int] = None
+        self.read_bytes: Union[None, int] = None
+        self.write_bytes: Union[None, int] = None
+        self.exitcode: Union[None, int] = None
+
+        self._start_monotonic = time.monotonic()
+
+    def stop(self, exitcode: int = None):
+        self.wall_seconds = round(time.monotonic() - self._start_monotonic, 3)
+        self.exitcode = exitcode
+
+    def set_rusage(self, rusage):
+        self.cpu_user, self.cpu_system = round(rusage.ru_utime, 3), round(rusage.ru_stime, 3)
+        self.max_rss_kb = int(rusage.ru_maxrss)
+
+    def set_io(self, io_start: Dict[str, int], io_end: Dict[str, int]):
+        if io_end:
+            self.read_bytes = io_end.get('read_bytes', 0) - io_start.get('read_bytes', 0)
+            self.write_bytes = io_end.get('write_bytes', 0) - io_start.get('write_bytes', 0)
+
+    def as_dict(self) -> dict:
+        return {'stage': self.stage, 'started': self.started, 'wall_seconds': self.wall_seconds,
+                'cpu_user': self.cpu_user, 'cpu_system': self.cpu_system, 'max_rss_kb': self.max_rss_kb,
+                'read_bytes': self.read_bytes, 'write_bytes': self.write_bytes, 'exitcode': self.exitcode}
+
+
+def _proc_file(pid: int, name: str) -> Path:
+    return Path('/proc') / str(pid) / name
+
+
+def read_proc_io(pid: int) -> Dict[str, int]:
+    """ Read /proc/<pid>/io, includes the i/o of reaped children. Empty if not available. """
+    try:
+        with open(_proc_file(pid, 'io').as_posix(), 'r') as f:
+            return {k.strip(): int(v) for k, v in (line.split(':', 1) for line in f if ':' in line)}
+    except (OSError, ValueError):
+        return dict()
+
+
+def read_proc_cpu(pid: int) -> Union[None, Tuple[float, float]]:
+    """ User and system cpu seconds of a running process from /proc/<pid>/stat """
+    try:
+        with open(_proc_file(pid, 'stat').as_posix(), 'r') as f:
+            # Process name may contain spaces, fields start after the closing bracket
+            fields = f.read().rsplit(')', 1)[1].split()
+        return int(fields[11]) / _clock_ticks, int(fields[12]) / _clock_ticks
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_peak_rss(pid: int) -> Union[None, int]:
+    """ Peak resident set size in kB of a running process """
+    try:
+        with open(_proc_file(pid, 'status').as_posix(), 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+
+
+def reset_peak_rss(pid: int):
+    """ Reset the peak RSS of a long lived process so it can be measured per request """
+    try:
+        with open(_proc_file(pid, 'clear_refs').as_posix(), 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def wait_process(process, usage: ProcessUsage) -> int:
+    """ Wait for a Popen process, collect its rusage and return the exit code """
+    if not hasattr(os, 'wait4'):
+        exitcode = process.wait()
+        usage.stop(exitcode)
+        return exitcode
+
+    # Collect i/o while the exited child is a zombie, /proc/<pid> is gone after it was reaped
+    io_end = read_proc_io(process.pid)
+
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # Reaped elsewhere eg. by Popen.kill
+        exitcode = process.wait()
+        usage.stop(exitcode)
+        return exitcode
+
+    exitcode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    # Let Popen know the child is gone
+    process.returncode = exitcode
+
+    usage.stop(exitcode)
+    usage.set_rusage(rusage)
+    usage.set_io(dict(), io_end)
+    return exitcode
@@ -0,0 +1,195 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Union
+
+from modules.app import App, db
+from modules.log import setup_logger
+from modules.metrics import Gauge, Metrics
+
+_logger = setup_logger(__name__)
+
+
+class CachedResult(db.Model):
+    __tablename__ = 'result_cache'
+
+    digest = db.Column(db.String(64), primary_key=True)
+    file_name = db.Column(db.String(255))
+    preview_name = db.Column(db.String(255))
+    size = db.Column(db.Integer)
+    hits = db.Column(db.Integer)
+    last_used = db.Column(db.Float)
+
+    def __init__(self, digest: str, file_name: str, size: int):
+        self.digest = digest
+        self.file_name = file_name
+        self.preview_name = str()
+        self.size = size
+        self.hits = 0
+        self.last_used = time.time()
+
+    def cache_dir(self) -> Path:
+        return ResultCache.cache_folder() / self.digest
+
+    def file(self) -> Path:
+        return self.cache_dir() / self.file_name
+
+    def preview_file(self) -> Union[None, Path]:
+        if self.preview_name:
+            return self.cache_dir() / self.preview_name
+
+
+class ResultCache:
+    """ Content addressed cache of conversion results keyed by input file bytes and converter arguments """
+    hits = 0
+    misses = 0
+    _lock = threading.Lock()
+
+    @staticmethod
+    def cache_folder() -> Path:
+        return Path(App.config.get('RESULT_CACHE_FOLDER'))
+
+    @staticmethod
+    def enabled() -> bool:
+        return bool(App.config.get('RESULT_CACHE_MAX_BYTES'))
+
+    @staticmethod
+    def file_digest(file: Path) -> str:
+        digest = hashlib.sha256()
+        with open(file.as_posix(), 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @classmethod
+    def create_digest(cls, job_dir: Path, arguments: Iterable, file_digests: Dict[str, str] = None) -> str:
+        """ Create a sha256 digest over the digest of every file in the job directory and the normalized
+            arguments. Files hashed while they were uploaded are provided by name and not read again.
+        """
+        digest = hashlib.sha256()
+        file_digests = file_digests or dict()
+
+        for file in sorted(f for f in job_dir.glob('*') if f.is_file()):
+            digest.update(file.name.encode('utf-8'))
+            digest.update(b'\0' + (file_digests.get(file.name) or cls.file_digest(file)).encode('utf-8'))
+
+        # Job directories are unique, only file names relative to the job directory describe the job
+        for arg in arguments:
+            if isinstance(arg, Path):
+                try:
+                    arg = arg.relative_to(job_dir).as_posix()
+                except ValueError:
+                    arg = arg.name
+            digest.update(b'\0' + str(arg).encode('utf-8'))
+
+        return digest.hexdigest()
+
+    @classmethod
+    def get(cls, digest: str) -> Union[None, CachedResult]:
+        if not cls.enabled() or not digest:
+            return
+
+        entry = CachedResult.query.get(digest)
+
+        if entry is not None and not entry.file().exists():
+            _logger.info('Removing cache entry with missing result file: %s', digest)
+            cls._remove(entry)
+            entry = None
+
+        with cls._lock:
+            if entry is None:
+                cls.misses += 1
+                return
+
+            cls.hits += 1
+
+        entry.hits += 1
+        entry.last_used = time.time()
+        db.session.commit()
+        return entry
+
+    @staticmethod
+    def link(src: Path, dst: Path) -> bool:
+        """ Hardlink src to dst, copy the file if the filesystem does not support hardlinks """
+        try:
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            if dst.exists():
+                dst.unlink()
+            os.link(src.as_posix(), dst.as_posix())
+        except OSError:
+            try:
+                shutil.copy(src.as_posix(), dst.as_posix())
+            except Exception as e:
+                _logger.error('Could not link cached file %s: %s', src, e)
+                return False
+
+        return True
+
+    @classmethod
+    def store(cls, digest: str, result_file: Path):
+        """ Store a finished job result file """
+        if not cls.enabled() or not digest or not result_file.exists():
+            return
+
+        if CachedResult.query.get(digest) is not None:
+            return
+
+        entry = CachedResult(digest, result_file.name, result_file.stat().st_size)
+        if not cls.link(result_file, entry.file()):
+            return
+
+        db.session.add(entry)
+        db.session.commit()
+        _logger.info('Stored result %s in conversion cache: %s', result_file.name, digest)
+
+        cls.evict()
+
+    @classmethod
+    def store_preview(cls, digest: str, preview_file: Path):
+        entry = CachedResult.query.get(digest) if digest else None
+        if entry is None or not preview_file.exists():
+            return
+
+        if cls.link(preview_file, entry.cache_dir() / preview_file.name):
+            entry.preview_name = preview_file.name
+            entry.size += preview_file.stat().st_size
+            db.session.commit()
+
+    @classmethod
+    def evict(cls):
+        """ Remove least recently used results until the cache fits RESULT_CACHE_MAX_BYTES """
+        max_bytes = App.config.get('RESULT_CACHE_MAX_BYTES') or 0
+        total_size = db.session.query(db.func.sum(CachedResult.size)).scalar() or 0
+
+        for entry in CachedResult.query.order_by(CachedResult.last_used).all():
+            if total_size <= max_bytes:
+                break
+
+            _logger.info('Evicting %s from conversion cache.', entry.digest)
+            total_size -= entry.size or 0
+            cls._remove(entry)
+
+    @staticmethod
+    def _remove(entry: CachedResult):
+        shutil.rmtree(entry.cache_dir(), ignore_errors=True)
+        db.session.delete(entry)
+        db.session.commit()
+
+    @classmethod
+    def lookups(cls) -> dict:
+        with cls._lock:
+            return {('hit',): cls.hits, ('miss',): cls.misses}
+
+    @classmethod
+    def stats(cls) -> dict:
+        size, entries = db.session.query(db.func.sum(CachedResult.size), db.func.count(CachedResult.digest)).one()
+        with cls._lock:
+            return {'hits': cls.hits, 'misses': cls.misses, 'entries': entries or 0, 'size': size or 0,
+                    'max_size': App.config.get('RESULT_CACHE_MAX_BYTES') or 0}
+
+
+Metrics.register(Gauge('usdz_result_cache_lookups', 'Result cache lookups since the server started by result.',
+                       ('result',), collect=ResultCache.lookups))
@@ -109,12 +109,21 @@ class JobFormFields:
     additional_args = 'additional_args'
     additional_args_text = 'usdzconvert additional arguments'
 
+    # Scheduling fields of scripted uploads, see JobScheduler
+    priority = 'priority'
+    lane = 'lane'
+
 
 class Urls:
     root = '/'
     job_page = '/jobs'
+    job_stream = '/jobs/stream'
+    api_jobs = '/api/jobs'
+    api_jobs_usage = '/api/jobs/usage.csv'
+    upload = '/upload'
     job_download = '/job_download'
     job_delete = '/job_delete'
+    job_cancel = '/job_cancel'
     usd_man = '/usd_manual'
     downloads = '/downloads'
     download_delete = '/downloads/delete'
@@ -123,6 +132,7 @@ class Urls:
     share = '/share'
     share_template = 'share/template'
     log = '/log'
+    metrics = '/metrics'
 
     static_images = 'static/img'
 
@@ -0,0 +1,70 @@
+import hashlib
+import time
+from pathlib import Path
+from typing import Union
+
+from flask import Request
+from werkzeug.utils import secure_filename
+
+from modules.file_mgr import FileManager
+from modules.log import setup_logger
+
+_logger = setup_logger(__name__)
+
+
+class HashingFile:
+    """ Multipart file part written directly to its final path, sha256 and size are computed while writing """
+    def __init__(self, path: Path):
+        self.path = path
+        self.size = 0
+        self._sha = hashlib.sha256()
+        self._file = open(path.as_posix(), 'xb+')
+
+    @property
+    def sha256(self) -> str:
+        return self._sha.hexdigest()
+
+    def write(self, data: bytes):
+        self._file.write(data)
+        self._sha.update(data)
+        self.size += len(data)
+
+    def __getattr__(self, name):
+        # read, seek, flush and close of the underlying file
+        return getattr(self._file, name)
+
+
+class StreamedUploadRequest(Request):
+    """ Request that streams the files of a job upload into a new job directory instead of spooling them to
+        temporary files first. Other requests and parts that can not be stored, eg. not allowed extensions or
+        duplicate file names, use the default temporary files.
+    """
+    stream_endpoints = ('upload_files',)
+
+    upload_job_dir: Union[None, Path] = None
+    # Seconds spent reading and storing the multipart body
+    upload_seconds = 0.0
+
+    def _load_form_data(self):
+        if 'form' in self.__dict__:
+            return
+
+        started = time.monotonic()
+        try:
+            super(StreamedUploadRequest, self)._load_form_data()
+        finally:
+            self.upload_seconds = time.monotonic() - started
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint in self.stream_endpoints and filename and FileManager._allowed_file(filename):
+            if self.upload_job_dir is None:
+                self.upload_job_dir = FileManager.create_job_dir()
+
+            if self.upload_job_dir is not None:
+                try:
+                    return HashingFile(self.upload_job_dir / secure_filename(filename))
+                except OSError as e:
+                    _logger.debug('Could not stream upload %s to the job directory: %s', filename, e)
+
+        return super(StreamedUploadRequest, self)._get_file_stream(total_content_length, content_type, filename,
+                                                                   content_length)
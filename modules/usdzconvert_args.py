@@ -146,3 +146,18 @@ def create_usdzconvert_arguments(args: list) -> list:
         arguments.append(arg)
 
     return arguments
+
+
+def create_converter_worker_arguments() -> list:
+    """ Create arguments to start a warm converter worker with the configured python 2.7 interpreter """
+    worker_script_path = Path(current_app.config.get('CONVERTER_WORKER_SCRIPT_PATH'))
+    if not worker_script_path.is_absolute():
+        worker_script_path = Path(get_current_modules_dir()) / current_app.config.get('CONVERTER_WORKER_SCRIPT_PATH')
+
+    usdz_converter_path = current_app.config.get('USDZ_CONVERTER_PATH') / \
+                          current_app.config.get('USDZ_CONVERTER_SCRIPT_PATH')
+    abc_post_process_path = create_abc_post_process_arguments()[-1]
+
+    # -u unbuffered output, the worker reports job results through it's stdout
+    return [_get_converter_interpreter_arg(), '-u', worker_script_path.as_posix(),
+            usdz_converter_path.resolve().as_posix(), Path(abc_post_process_path).as_posix()]
@@ -1,22 +1,70 @@
 from pathlib import Path
 
-from flask import flash, redirect, render_template, request, jsonify, make_response, send_from_directory
+from flask import flash, g, redirect, render_template, request, jsonify, make_response, send_from_directory, Response, \
+    stream_with_context
 
+from modules.admission import AdmissionControl
 from modules.app import App, db
+from modules.chunked_upload import ChunkedUpload
+from modules.download_index import DownloadIndex
 from modules.file_mgr import FileManager
 from modules.ftp import FtpRemote
 from modules.globals import LOG_FILE_PATH, get_current_modules_dir
-from modules.job import ConversionJob, JobManager
+from modules.job import ConversionJob, JobLeases, JobManager, JobScheduler, JobStateCounts
+from modules.job_api import export_resource_usage, job_detail, job_status, list_jobs, parse_job_fields, \
+    parse_job_states
+from modules.job_state import JobStateRegistry
+from modules.job_stream import JobStreams, job_status_snapshot, job_status_stream, parse_stream_offsets
+from modules.metrics import Metrics, upload_bytes, upload_seconds
+from modules.result_cache import ResultCache
 from modules.settings import JsonConfig
 from modules.site import Site, Urls
+from modules.upload_stream import StreamedUploadRequest
+
+# Job uploads are streamed into their job directory while the multipart body is parsed
+App.request_class = StreamedUploadRequest
+
+
+# Upload endpoints checked by admission control and if they create a job and count against the queue limits
+ADMISSION_ENDPOINTS = {'upload_files': True, 'upload_create': True, 'upload_chunk': False}
 
 
 def log_request(r: request):
     App.logger.info('Endpoint %s requested by %s with method %s', r.endpoint, r.remote_addr, r.method)
 
 
+def _submitter() -> str:
+    return JobScheduler.submitter_key(request.remote_addr, request.headers.get('X-Api-Token'))
+
+
+@App.before_request
+def _admit_upload():
+    """ Reject uploads from their headers before the request body is parsed """
+    if request.method not in ('POST', 'PATCH') or request.endpoint not in ADMISSION_ENDPOINTS:
+        return
+
+    content_length = request.content_length or 0
+    rejection = (ADMISSION_ENDPOINTS[request.endpoint] and AdmissionControl.check_queue(_submitter())) \
+        or AdmissionControl.check_disk(content_length) or AdmissionControl.reserve(content_length)
+
+    if rejection is not None:
+        response = make_response(jsonify({'message': rejection.message}), rejection.status)
+        response.headers['Retry-After'] = str(rejection.retry_after)
+        return response
+
+    g.admission_bytes = content_length
+
+
+@App.teardown_request
+def _release_upload(exception=None):
+    AdmissionControl.release(g.pop('admission_bytes', 0))
+
+
 @App.before_first_request
 def _clean_uploads():
+    # Re-queue jobs interrupted by a server restart before their upload dirs get cleaned
+    JobManager.recover_jobs(startup=True)
+
     with App.app_context():
         jobs = JobManager.get_jobs()
         if FileManager.clear_upload_folders(jobs):
@@ -24,6 +72,14 @@ def _clean_uploads():
         else:
             App.logger.info('Could not create clean upload folder @ %s', App.config.get('UPLOAD_FOLDER'))
 
+        JobManager.update_job_summaries()
+        JobManager.load_cost_model()
+        JobStateCounts.sync()
+        DownloadIndex.reconcile()
+
+    JobLeases.start()
+    JobManager.run_job_queue()
+
 
 @App.route(Urls.root)
 def index():
@@ -34,11 +90,60 @@ def index():
                            )
 
 
-@App.route("/upload", methods=["POST"])
-def upload_async():
-    """ Not used for now """
-    App.logger.info('Fetch request: %s %s %s', request.files, request.get_json(), request.data)
-    return make_response(jsonify({"message": "OK"}), 200)
+def _upload_response(upload: ChunkedUpload, status: int, body=None):
+    response = make_response(jsonify(body) if body is not None else '', status)
+    response.headers['Upload-Offset'] = str(upload.offset())
+    response.headers['Upload-Length'] = str(upload.size)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@App.route(Urls.upload, methods=['POST'])
+def upload_create():
+    """ Create or resume a chunked upload. Expects JSON {filename, size, field, batch, batch_key}, batch is the
+        job directory of previous uploads belonging to the same job or empty to create a new one. The
+        batch_key of a new batch is returned once and required by every further request of the batch.
+    """
+    log_request(request)
+    data = request.get_json(silent=True) or dict()
+    upload, message = ChunkedUpload.create(data.get('batch'), data.get('batch_key', ''), data.get('filename', ''),
+                                           data.get('field', ''), data.get('size'))
+
+    if upload is None:
+        App.logger.info('Could not create chunked upload: %s', message)
+        return make_response(jsonify({'message': message}), 400)
+
+    response = _upload_response(upload, 201, upload.as_dict())
+    response.headers['Location'] = upload.url
+    return response
+
+
+@App.route(f'{Urls.upload}/<batch>/<upload_id>', methods=['HEAD', 'GET'])
+def upload_status(batch, upload_id):
+    """ Report the current offset of a chunked upload """
+    upload = ChunkedUpload.load(batch, request.headers.get('Upload-Batch-Key', ''), upload_id)
+    if upload is None:
+        return make_response(jsonify({'message': 'Upload not found.'}), 404)
+
+    return _upload_response(upload, 200, upload.as_dict())
+
+
+@App.route(f'{Urls.upload}/<batch>/<upload_id>', methods=['PATCH'])
+def upload_chunk(batch, upload_id):
+    """ Append the request body to a chunked upload at the Upload-Offset header """
+    upload = ChunkedUpload.load(batch, request.headers.get('Upload-Batch-Key', ''), upload_id)
+    if upload is None:
+        return make_response(jsonify({'message': 'Upload not found.'}), 404)
+
+    offset = request.headers.get('Upload-Offset', '')
+    if not offset.isdigit():
+        return _upload_response(upload, 400, {'message': 'Upload-Offset header missing.'})
+
+    result, _ = upload.write(request.stream, int(offset))
+    if not result:
+        return _upload_response(upload, 409, {'message': 'Upload-Offset does not match.'})
+
+    return _upload_response(upload, 204)
 
 
 @App.route(Urls.root, methods=['POST'])
@@ -47,10 +152,25 @@ def upload_files():
         return
 
     log_request(request)
-    App.logger.debug('Submitted form data:\nFiles:\n%s\nForm:\n%s\nData\n%s', request.files, request.form, request.data)
+
+    # Parsing the multipart body is timed by the request, files already transferred by chunked uploads
+    files = request.files
+    job_dir = request.upload_job_dir
+    if files:
+        upload_bytes.inc(request.content_length or 0, 'form')
+        upload_seconds.inc(request.upload_seconds, 'form')
+    App.logger.debug('Submitted form data:\nFiles:\n%s\nForm:\n%s', request.files, request.form)
+    batch = request.form.get('upload_batch')
+    if batch:
+        job_dir, files = ChunkedUpload.completed_files(batch, request.form.get('upload_batch_key', ''))
+        if job_dir is None:
+            flash('Upload is incomplete or has expired. Please submit your files again.')
+            return redirect(request.url)
 
     file_mgr = FileManager()
-    result, message = file_mgr.handle_post_request(request.files, request.form)
+    if batch:
+        file_mgr.digests.update(ChunkedUpload.completed_digests(job_dir))
+    result, message = file_mgr.handle_post_request(files, request.form, job_dir)
 
     if not result:
         # --- Return to root and display errors ---
@@ -62,11 +182,14 @@ def upload_files():
         # --- Forward to current job page ---
         flash(message)
 
-        job = ConversionJob(file_mgr.job_dir, file_mgr.files, request.form)
-        job.state = ConversionJob.States.queued
+        job = ConversionJob(file_mgr.job_dir, file_mgr.files, request.form, file_mgr.digests)
+        job.set_state(ConversionJob.States.queued)
+        JobScheduler.assign(job, _submitter(), request.form)
 
         db.session.add(job)
         db.session.commit()
+        if job_dir:
+            ChunkedUpload.finish(job_dir)
         App.logger.info('Upload succeeded for: %s\nCreated job with id: %s', str(file_mgr.files), job.job_id)
 
         JobManager.run_job_queue()
@@ -76,18 +199,112 @@ def upload_files():
 
 @App.route(Urls.job_page)
 def job_page():
+    """ Jobs are rendered by the page from the job api """
     log_request(request)
-    return render_template(Urls.templates[Urls.job_page], content=Site(), jobs=JobManager.get_jobs())
+    return render_template(Urls.templates[Urls.job_page], content=Site(), per_page=App.config.get('JOBS_PER_PAGE', 20),
+                           workers=JobManager.worker_utilisation(), cache=ResultCache.stats())
+
+
+def _int_arg(name: str):
+    value = request.args.get(name, '')
+    return int(value) if value.isdigit() else None
+
+
+@App.route(Urls.api_jobs)
+def api_jobs():
+    """ Job listing, newest first. Query arguments:
+        limit=20 before=job_id after=job_id state=queued,failed fields=job_id,state,progress
+    """
+    limit = _int_arg('limit') or App.config.get('JOBS_PER_PAGE', 20)
+    jobs, next_cursor = list_jobs(limit, _int_arg('before'), _int_arg('after'),
+                                  parse_job_states(request.args.get('state', '')),
+                                  parse_job_fields(request.args.get('fields', '')))
+    return jsonify({'jobs': jobs, 'next': next_cursor})
+
+
+@App.route(Urls.api_jobs_usage)
+def api_jobs_usage():
+    """ Export the resource usage of every job stage """
+    log_request(request)
+    return Response(stream_with_context(export_resource_usage()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=job_resource_usage.csv'})
+
+
+@App.route(f'{Urls.api_jobs}/<int:job_id>')
+def api_job(job_id):
+    detail = job_detail(job_id)
+    if detail is None:
+        return make_response(jsonify({'message': f'Job {job_id} not found.'}), 404)
+
+    return jsonify(detail)
+
+
+@App.route(f'{Urls.api_jobs}/<int:job_id>/status')
+def api_job_status(job_id):
+    """ Lightweight state and progress for polling clients """
+    status = job_status(job_id)
+    if status is None:
+        return make_response(jsonify({'message': f'Job {job_id} not found.'}), 404)
+
+    return jsonify(status)
+
+
+@App.route(f'{Urls.api_jobs}/<int:job_id>/log')
+def api_job_log(job_id):
+    """ Complete process output of a job """
+    log_file = JobManager.job_log_file(job_id)
+    if not log_file.exists():
+        return make_response(jsonify({'message': f'No log available for job {job_id}.'}), 404)
+
+    return send_from_directory(log_file.parent.as_posix(), log_file.name, mimetype='text/plain')
+
+
+@App.route(f'{Urls.api_jobs}/<int:job_id>/cancel', methods=['POST'])
+def api_job_cancel(job_id):
+    App.logger.info('Received api cancel request for job_id: %s', job_id)
+    if JobManager.get_job_by_id(job_id) is None:
+        return make_response(jsonify({'message': f'Job {job_id} not found.'}), 404)
+
+    result, msg = JobManager.cancel_job(job_id)
+    return make_response(jsonify({'cancelled': result, 'message': msg}), 200 if result else 409)
+
+
+@App.route(Urls.job_stream)
+def job_stream():
+    """ Server-Sent Events of job state, progress and new process messages.
+        Expects ?jobs=job_id:message_offset,... of the unfinished jobs and &last=newest_job_id displayed.
+        With &poll=1 the current state is returned as JSON, clients poll while all streams are taken.
+    """
+    offsets = parse_stream_offsets(request.args.get('jobs', ''))
+    last_job_id = request.args.get('last', '0')
+    last_job_id = int(last_job_id) if last_job_id.isdigit() else 0
+
+    if request.args.get('poll'):
+        return jsonify(job_status_snapshot(offsets, last_job_id))
+
+    if not JobStreams.acquire(int(App.config.get('JOB_STREAM_MAX_CLIENTS') or 0)):
+        response = make_response(jsonify({'message': 'Too many open job status streams. Poll for updates.'}), 503)
+        response.headers['Retry-After'] = str(App.config.get('JOB_STREAM_RETRY_AFTER', 10))
+        return response
+
+    stream = job_status_stream(offsets, last_job_id, App.config.get('JOB_STREAM_SECONDS', 30))
+    response = Response(stream, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    response.call_on_close(JobStreams.release)
+    return response
 
 
 @App.route(f'{Urls.job_download}/<job_id>')
 def job_download(job_id):
+    if job_id.isdigit() and JobStateRegistry.is_active(int(job_id)):
+        App.logger.info('Job %s is still in process, nothing to download yet.', job_id)
+        return redirect(Urls.job_page)
+
     job = JobManager.get_job_by_id(job_id)
     App.logger.info('Received Download request for job_id: %s', job_id)
 
-    if job and job.direct_download_url():
-        App.logger.info('Serving with file: %s', job.download_filename())
-        return redirect(job.direct_download_url())
+    if job and job.state == ConversionJob.States.finished and job.download_url:
+        App.logger.info('Serving with file: %s', job.output_name)
+        return redirect(job.download_url)
     else:
         App.logger.info('Could not find job download file to serve: %s', job_id)
         return redirect(Urls.job_page)
@@ -101,13 +318,26 @@ def job_delete(job_id):
     return redirect(Urls.job_page)
 
 
+@App.route(f'{Urls.job_cancel}/<job_id>')
+def job_cancel(job_id):
+    App.logger.info('Received cancel request for job_id: %s', job_id)
+    result, msg = JobManager.cancel_job(job_id)
+    flash(msg)
+    return redirect(Urls.job_page)
+
+
 @App.route(Urls.downloads)
 def static_downloads():
     log_request(request)
-    dl_dict = FileManager.list_downloads()
-    sorted_dls = sorted(dl_dict.items(), key=lambda x: x[1]['created'], reverse=True)  # Sort by date descending
-    return render_template(Urls.templates[Urls.downloads], content=Site(),
-                           downloads=sorted_dls)
+    DownloadIndex.reconcile_if_due()
+
+    page = request.args.get('page', '1')
+    page = max(1, int(page)) if page.isdigit() else 1
+    per_page = App.config.get('DOWNLOADS_PER_PAGE', 50)
+    downloads, total = DownloadIndex.get_page(page, per_page)
+
+    return render_template(Urls.templates[Urls.downloads], content=Site(), downloads=downloads,
+                           page=page, pages=max(1, -(-total // per_page)), total=total)
 
 
 @App.route(f'{Urls.downloads}/<download_folder_id>/<filename>')
@@ -118,8 +348,7 @@ def download(download_folder_id, filename):
 
 @App.route(f'{Urls.download_delete}/<download_folder_id>')
 def static_download_delete(download_folder_id):
-    dl_dict = FileManager.list_downloads()
-    dl = dl_dict.get(download_folder_id)
+    dl = DownloadIndex.get(download_folder_id) or dict()
     App.logger.info('Received deletion request for download: %s %s', download_folder_id, dl)
     msg = f'Could not delete download {download_folder_id}/{dl.get("name")}'
 
@@ -133,8 +362,7 @@ def static_download_delete(download_folder_id):
 @App.route(f'{Urls.share}/<download_folder_id>')
 def share_settings(download_folder_id):
     log_request(request)
-    dl_dict = FileManager.list_downloads()
-    dl = dl_dict.get(download_folder_id)
+    dl = DownloadIndex.get(download_folder_id)
     config = JsonConfig.get_host_config_without_pswd(App.config.get('SHARE_HOST_CONFIG_PATH'))
 
     if not config:
@@ -151,8 +379,7 @@ def share_settings(download_folder_id):
 def share_file(download_folder_id):
     """ User submitted a download file to share """
     log_request(request)
-    dl_dict = FileManager.list_downloads()
-    dl = dl_dict.get(download_folder_id)
+    dl = DownloadIndex.get(download_folder_id)
     App.logger.info('Download Share: %s %s', request.files, request.form)
 
     share_result = FileManager.remote_share_download(download_folder_id, dl, request.form, request.files)
@@ -223,6 +450,12 @@ def usd_manual():
     return render_template(Urls.templates[Urls.usd_man], content=Site(), usd_manual=usd_man)
 
 
+@App.route(Urls.metrics)
+def metrics():
+    """ Prometheus text exposition of in-memory metrics, does not query the database """
+    return Response(Metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @App.route(Urls.log)
 def log():
     log_request(request)
@@ -0,0 +1,150 @@
+from __future__ import print_function
+import os
+import sys
+import json
+import runpy
+import logging
+import argparse
+import traceback
+
+# -- Long lived converter interpreter --
+# Imports pxr and usdzconvert once and then runs conversion requests read from stdin.
+# Every request is a single json line: {"id": str, "cmd": "convert|post_process|ping", "args": [], "cwd": str}
+# Process output is written to stdout unchanged, the end of every request is signaled by a line
+# starting with WORKER_MARKER followed by a json result dict: {"id": str, "exitcode": int, "error": str}
+# error is "memory" if the request failed with a MemoryError eg. because of the address space limit
+WORKER_MARKER = '@@usdz_webui_worker@@'
+
+try:
+    # Load the USD shared libraries once for the lifetime of this worker
+    from pxr import Usd
+except ImportError:
+    print('Failed to import Usd modules. Add USD_INSTALL/lib/python to PYTHONPATH')
+    sys.exit(3)
+
+# -- Log to Stdout keeping it short
+logging.basicConfig(stream=sys.stdout, format='%(asctime)s %(levelname)s: %(message)s',
+                    datefmt='%H:%M', level=logging.INFO)
+
+
+def load_source(name, path):
+    """ Import a python file that may not carry a .py extension eg. usdzconvert """
+    try:
+        import imp
+        return imp.load_source(name, path)
+    except ImportError:
+        from importlib.machinery import SourceFileLoader
+        return SourceFileLoader(name, path).load_module()
+
+
+def report(result):
+    sys.stdout.flush()
+    print(WORKER_MARKER + ' ' + json.dumps(result))
+    sys.stdout.flush()
+
+
+def exit_code(system_exit):
+    if system_exit.code is None:
+        return 0
+    if isinstance(system_exit.code, int):
+        return system_exit.code
+    print(system_exit.code)
+    return 1
+
+
+class ConverterWorker(object):
+    def __init__(self, usdzconvert_path, post_process_path):
+        self.usdzconvert = load_source('usdzconvert', usdzconvert_path)
+        self.post_process_path = post_process_path
+        self.post_process = None
+
+    def convert(self, args):
+        sys.argv = [self.usdzconvert.__file__] + args
+
+        if hasattr(self.usdzconvert, 'tryProcess'):
+            return self.usdzconvert.tryProcess(args) or 0
+        return self.usdzconvert.process(args) or 0
+
+    @staticmethod
+    def run_usdzip(usdzip_args):
+        """ Run usdzip in this interpreter instead of a sub process """
+        usdzip_script = usdzip_args[1]
+        sys.argv = usdzip_args[1:]
+
+        try:
+            runpy.run_path(usdzip_script, run_name='__main__')
+        except SystemExit as e:
+            return exit_code(e)
+        return 0
+
+    def run_post_process(self, args):
+        if self.post_process is None:
+            self.post_process = load_source('post_process_abc', self.post_process_path)
+
+        sys.argv = [self.post_process_path] + args
+        self.post_process.main(args[0], run_usdzip=self.run_usdzip)
+        return 0
+
+    def handle(self, request):
+        cmd, args = request.get('cmd'), request.get('args') or list()
+
+        if cmd == 'ping':
+            return 0
+        if cmd == 'convert':
+            return self.convert(args)
+        if cmd == 'post_process':
+            return self.run_post_process(args)
+
+        print('Unknown worker command: ' + str(cmd))
+        return 1
+
+    def serve(self):
+        report({'ready': True, 'pid': os.getpid()})
+        argv, cwd = list(sys.argv), os.getcwd()
+
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                # Stdin closed, parent asked us to exit
+                break
+
+            try:
+                request = json.loads(line)
+            except ValueError:
+                print('Could not read worker request: ' + line)
+                continue
+
+            error = None
+            try:
+                os.chdir(request.get('cwd') or cwd)
+                result = self.handle(request)
+            except SystemExit as e:
+                result = exit_code(e)
+            except MemoryError:
+                traceback.print_exc(file=sys.stdout)
+                result, error = 1, 'memory'
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+                result = 1
+            finally:
+                sys.argv = list(argv)
+                os.chdir(cwd)
+
+            report({'id': request.get('id'), 'exitcode': result, 'error': error})
+
+
+if __name__ == '__main__':
+    # Define and parse command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('usdzconvert_path', help='Path to the usdzconvert script')
+    parser.add_argument('post_process_path', help='Path to the Alembic post process script')
+    args = parser.parse_args()
+
+    try:
+        worker = ConverterWorker(args.usdzconvert_path, args.post_process_path)
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        sys.exit(2)
+
+    worker.serve()
+    sys.exit(0)
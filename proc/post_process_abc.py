@@ -105,7 +105,21 @@ def get_usdzip_bin_path():
             return os.path.join(path, 'usdzip')
 
 
-def main(in_file):
+def run_usdzip_process(usdzip_args):
+    """ Run usdzip in a sub process and return it's exit code """
+    p = subprocess.Popen(usdzip_args, env=os.environ)
+
+    out, error = p.communicate()
+
+    if out:
+        logging.debug(out)
+    if error:
+        logging.error(error)
+
+    return p.returncode
+
+
+def main(in_file, run_usdzip=run_usdzip_process):
     # -- Find usdzip
     usdzip_script = get_usdzip_bin_path()
     if not usdzip_script:
@@ -128,21 +142,14 @@ def main(in_file):
     # -- Run usdzip and create a package from processed usdc
     logging.info('Creating usdzip packaging subprocess')
     usdzip_args = [sys.executable, usdzip_script, out_usdz, '--arkitAsset', tmp_usdc]
-    p = subprocess.Popen(usdzip_args, env=os.environ)
-
-    out, error = p.communicate()
-
-    if out:
-        logging.debug(out)
-    if error:
-        logging.error(error)
+    returncode = run_usdzip(usdzip_args)
 
     # -- Check usdzip results
-    if p.returncode and p.returncode != 0:
+    if returncode and returncode != 0:
         logging.error('Error while creating USDZ package with usdzip')
         sys.exit(4)
     else:
-        logging.info('usdzip returned: %s [0=happy]', p.returncode)
+        logging.info('usdzip returned: %s [0=happy]', returncode)
         try:
             os.remove(in_file)
             os.remove(tmp_usdc)
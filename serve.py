@@ -1,4 +1,5 @@
 import sys
+import signal
 import socket
 import logging
 from waitress import serve
@@ -12,8 +13,13 @@ def serve_to_lan():
         host = socket.gethostbyname(socket.gethostname())   
         port = 80
 
+    # Exit through atexit on SIGTERM so converter process groups are killed with the server
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     logging.info('Serving at %s', host)
-    serve(App, host=host, port=port)
+    # Job status streams occupy a thread each while connected
+    serve(App, host=host, port=port, threads=App.config.get('SERVE_THREADS', 8))
 
 
 if __name__ == '__main__':
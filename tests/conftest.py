@@ -0,0 +1,39 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# Tests import the modules package from the repository root
+sys.path.insert(0, Path(__file__).parent.parent.as_posix())
+
+
+@pytest.fixture
+def app_config():
+    """ Config of the app, changed values are restored after the test """
+    from modules.app import App
+    config = dict(App.config)
+    yield App.config
+    App.config.clear()
+    App.config.update(config)
+
+
+@pytest.fixture
+def database(tmp_path, app_config):
+    """ Empty database and upload folder in the test directory instead of the app instance """
+    from modules.app import db
+    app_config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{(tmp_path / "app.sqlite3").as_posix()}'
+    app_config['UPLOAD_FOLDER'] = tmp_path / 'upload'
+    app_config['UPLOAD_FOLDER'].mkdir()
+
+    db.session.remove()
+    db.create_all()
+    yield db
+    db.session.remove()
+
+
+@pytest.fixture
+def client(database, monkeypatch):
+    """ Test client of the app that skips the job queue and upload folder startup of the first request """
+    from modules.app import App
+    monkeypatch.setattr(App, '_got_first_request', True)
+    return App.test_client()
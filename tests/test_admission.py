@@ -0,0 +1,86 @@
+import time
+
+import pytest
+from werkzeug.datastructures import ImmutableMultiDict
+
+from modules.app import App, db
+from modules.admission import AdmissionControl
+from modules.job import ConversionJob, JobScheduler
+from modules.site import Urls
+
+CLIENT = JobScheduler.submitter_key('127.0.0.1')
+
+
+@pytest.fixture
+def client(client, app_config, monkeypatch):
+    app_config.update({'ADMISSION_MAX_QUEUED_JOBS': 0, 'ADMISSION_MAX_QUEUED_JOBS_PER_SUBMITTER': 0,
+                       'ADMISSION_MAX_UPLOAD_BYTES_IN_FLIGHT': 0, 'ADMISSION_MIN_FREE_DISK_MB': 0,
+                       'ADMISSION_RETRY_AFTER': 7})
+    monkeypatch.setattr(AdmissionControl, '_in_flight_bytes', 0)
+    return client
+
+
+def add_queued_job(tmp_path, submitter: str):
+    job = ConversionJob(tmp_path, dict(), ImmutableMultiDict())
+    job.state, job.submitter, job.created = ConversionJob.States.queued, submitter, time.time()
+    db.session.add(job)
+    db.session.commit()
+
+
+def assert_rejected(response, status: int):
+    assert response.status_code == status
+    assert response.headers['Retry-After'] == '7'
+    assert response.get_json()['message']
+
+
+def test_full_queue_is_unavailable(tmp_path, client, app_config):
+    app_config['ADMISSION_MAX_QUEUED_JOBS'] = 2
+    add_queued_job(tmp_path, 'addr:other')
+    add_queued_job(tmp_path, CLIENT)
+
+    assert_rejected(client.post(Urls.root, data=b'', content_type='multipart/form-data; boundary=x'), 503)
+    assert_rejected(client.post(Urls.upload), 503)
+
+
+def test_too_many_queued_jobs_of_a_submitter(tmp_path, client, app_config):
+    app_config['ADMISSION_MAX_QUEUED_JOBS_PER_SUBMITTER'] = 1
+    add_queued_job(tmp_path, CLIENT)
+
+    assert_rejected(client.post(Urls.upload), 429)
+
+    # Other submitters and uploads that do not create a job are not limited
+    with App.test_request_context():
+        assert AdmissionControl.check_queue(JobScheduler.submitter_key('127.0.0.1', 'api-token')) is None
+    assert client.patch(f'{Urls.upload}/batch/upload').status_code != 429
+
+
+def test_upload_bytes_in_flight(client, app_config):
+    app_config['ADMISSION_MAX_UPLOAD_BYTES_IN_FLIGHT'] = 100
+    AdmissionControl._in_flight_bytes = 60
+
+    assert_rejected(client.post(Urls.upload, data=b'x' * 80), 503)
+    assert AdmissionControl.in_flight_bytes() == 60
+
+
+def test_low_disk_space(client, app_config):
+    app_config['ADMISSION_MIN_FREE_DISK_MB'] = 1024 ** 4
+
+    assert_rejected(client.post(Urls.upload, data=b'x' * 10), 503)
+
+
+def test_reserve_and_release(app_config, monkeypatch):
+    monkeypatch.setattr(AdmissionControl, '_in_flight_bytes', 0)
+    app_config['ADMISSION_MAX_UPLOAD_BYTES_IN_FLIGHT'] = 100
+
+    with App.test_request_context():
+        # A single upload is admitted even if it exceeds the limit
+        assert AdmissionControl.reserve(150) is None
+        assert AdmissionControl.reserve(1) is not None
+        AdmissionControl.release(150)
+
+        assert AdmissionControl.reserve(60) is None
+        assert AdmissionControl.reserve(40) is None
+        assert AdmissionControl.reserve(1).retry_after == int(app_config['ADMISSION_RETRY_AFTER'])
+        AdmissionControl.release(100)
+
+    assert AdmissionControl.in_flight_bytes() == 0
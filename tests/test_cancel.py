@@ -0,0 +1,99 @@
+import threading
+
+import pytest
+from werkzeug.datastructures import ImmutableMultiDict
+
+from modules.app import db
+from modules.job import ConversionJob, JobManager
+from modules.site import JobFormFields
+
+States = ConversionJob.States
+
+
+@pytest.fixture
+def manager(database, app_config, monkeypatch):
+    app_config.update(CONVERSION_WORKERS=1, CONVERTER_WARM_WORKERS=False)
+    monkeypatch.setattr(JobManager, '_slots', list())
+    monkeypatch.setattr(JobManager, '_cancelling', set())
+    monkeypatch.setattr(JobManager, '_completing', set())
+    monkeypatch.setattr(JobManager, '_queue_preview', classmethod(lambda cls, job: None))
+    monkeypatch.setattr(JobManager, 'run_preview_queue', classmethod(lambda cls: None))
+    return JobManager
+
+
+def add_running_job(tmp_path, manager) -> int:
+    job_dir = tmp_path / 'job'
+    job_dir.mkdir()
+    scene_file = {JobFormFields.scene_file_field.id: {'file_path': job_dir / 'scene.usdz'}}
+    job = ConversionJob(job_dir, scene_file, ImmutableMultiDict())
+    job.set_state(States.in_progress)
+    db.session.add(job)
+    db.session.commit()
+
+    manager._get_slots()[0].occupy(job.job_id)
+    return job.job_id
+
+
+def complete_job(job: ConversionJob):
+    job.set_state(States.finished)
+    job.completed = True
+
+
+def in_thread(target, *args):
+    result = list()
+    thread = threading.Thread(target=lambda: result.append(target(*args)))
+    thread.start()
+    thread.join(10)
+    return result[0] if result else None
+
+
+def job_state(job_id: int) -> int:
+    db.session.remove()
+    return ConversionJob.query.get(job_id).state
+
+
+def test_finished_callback_after_cancel_keeps_job_cancelled(tmp_path, manager, monkeypatch):
+    job_id = add_running_job(tmp_path, manager)
+    monkeypatch.setattr(ConversionJob, 'set_complete', complete_job)
+
+    assert manager.cancel_job(job_id)[0]
+    # The callback was queued before the process got killed
+    manager._finished_callback(job_id)
+
+    assert job_state(job_id) == States.cancelled
+    assert not (tmp_path / 'job').exists()
+    assert manager.running_jobs() == 0
+
+
+def test_finished_callback_during_cancel_keeps_job_cancelled(tmp_path, manager, monkeypatch):
+    job_id = add_running_job(tmp_path, manager)
+    monkeypatch.setattr(ConversionJob, 'set_complete', complete_job)
+    set_cancelled = ConversionJob.set_cancelled
+
+    def callback_while_cancelling(job):
+        in_thread(manager._finished_callback, job_id)
+        set_cancelled(job)
+
+    monkeypatch.setattr(ConversionJob, 'set_cancelled', callback_while_cancelling)
+
+    assert manager.cancel_job(job_id)[0]
+    assert job_state(job_id) == States.cancelled
+    assert manager.running_jobs() == 0
+
+
+def test_cancel_during_result_write_is_refused(tmp_path, manager, monkeypatch):
+    job_id = add_running_job(tmp_path, manager)
+    cancel_results = list()
+
+    def cancel_while_completing(job):
+        cancel_results.append(in_thread(manager.cancel_job, job_id))
+        complete_job(job)
+
+    monkeypatch.setattr(ConversionJob, 'set_complete', cancel_while_completing)
+    manager._finished_callback(job_id)
+
+    assert cancel_results[0][0] is False
+    assert job_state(job_id) == States.finished
+    assert (tmp_path / 'job').exists()
+    assert manager.running_jobs() == 0
+    assert not manager._completing
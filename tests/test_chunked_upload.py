@@ -0,0 +1,94 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+from modules.app import App
+from modules.chunked_upload import ChunkedUpload
+from modules.file_mgr import FileManager
+from modules.site import Urls
+
+DATA = os.urandom(300 * 1024 + 17)
+
+
+@pytest.fixture
+def uploads(client, monkeypatch):
+    monkeypatch.setattr(ChunkedUpload, '_hashes', dict())
+    monkeypatch.setattr(ChunkedUpload, '_locks', dict())
+    monkeypatch.setattr(ChunkedUpload, '_expired', 0.0)
+    return client
+
+
+def create(client, batch: str = '', batch_key: str = '', filename: str = 'scene.obj', size: int = len(DATA)):
+    return client.post(Urls.upload, json={'filename': filename, 'size': size, 'field': 'scene_file',
+                                          'batch': batch, 'batch_key': batch_key})
+
+
+def test_upload_in_chunks(uploads):
+    upload = create(uploads).get_json()
+    key = {'Upload-Batch-Key': upload['batch_key']}
+
+    response = uploads.patch(upload['url'], data=DATA[:100000], headers={'Upload-Offset': '0', **key})
+    assert response.status_code == 204 and response.headers['Upload-Offset'] == '100000'
+    assert uploads.patch(upload['url'], data=DATA[:10], headers={'Upload-Offset': '0', **key}).status_code == 409
+
+    # A restarted server re-hashes the stored part
+    ChunkedUpload._hashes.clear()
+    assert uploads.head(upload['url'], headers=key).headers['Upload-Offset'] == '100000'
+    response = uploads.patch(upload['url'], data=DATA[100000:] + b'extra', headers={'Upload-Offset': '100000', **key})
+    assert response.headers['Upload-Offset'] == str(len(DATA))
+
+    with App.test_request_context():
+        completed = ChunkedUpload.load(upload['batch'], upload['batch_key'], upload['upload_id'])
+        assert completed.is_complete() and completed.sha256 == hashlib.sha256(DATA).hexdigest()
+        job_dir, files = ChunkedUpload.completed_files(upload['batch'], upload['batch_key'])
+        assert job_dir.name == upload['batch'] and list(files) == ['scene_file']
+    assert not ChunkedUpload._hashes and not ChunkedUpload._locks
+
+
+def test_batch_requires_its_key(uploads):
+    upload = create(uploads).get_json()
+    batch, batch_key = upload['batch'], upload['batch_key']
+
+    for headers in (dict(), {'Upload-Batch-Key': 'guessed'}):
+        assert uploads.patch(upload['url'], data=b'x', headers={'Upload-Offset': '0', **headers}).status_code == 404
+        assert uploads.head(upload['url'], headers=headers).status_code == 404
+    assert create(uploads, batch, 'guessed', 'diffuse.png', 10).status_code == 400
+    with App.test_request_context():
+        assert ChunkedUpload.completed_files(batch, 'guessed')[0] is None
+
+    # The key is only returned when the batch was created
+    added = create(uploads, batch, batch_key, 'diffuse.png', 10)
+    assert added.status_code == 201 and 'batch_key' not in added.get_json()
+
+
+def test_job_directories_without_key_are_refused(uploads, app_config):
+    with App.test_request_context():
+        job_dir = FileManager.create_job_dir()
+    (job_dir / 'scene.obj').write_bytes(b'v 0 0 0\n')
+
+    assert create(uploads, job_dir.name, 'any', 'diffuse.png', 10).status_code == 400
+    assert sorted(p.name for p in job_dir.iterdir()) == ['scene.obj']
+
+
+def test_stale_uploads_expire(uploads, app_config, monkeypatch):
+    upload = create(uploads).get_json()
+    uploads.patch(upload['url'], data=DATA[:1000],
+                  headers={'Upload-Offset': '0', 'Upload-Batch-Key': upload['batch_key']})
+    assert len(ChunkedUpload._hashes) == 1 and len(ChunkedUpload._locks) == 1
+
+    # Hash state of the inactive upload is dropped, the batch is kept until it expires
+    monkeypatch.setattr(ChunkedUpload, 'hash_state_seconds', 0)
+    monkeypatch.setattr(ChunkedUpload, 'expire_interval', 0)
+    assert create(uploads).status_code == 201
+    assert not ChunkedUpload._hashes and not ChunkedUpload._locks
+    job_dir = app_config['UPLOAD_FOLDER'] / upload['batch']
+    assert job_dir.is_dir()
+
+    app_config['CHUNKED_UPLOAD_EXPIRY'] = 3600
+    abandoned = time.time() - 7200
+    for path in (job_dir / 'scene.obj', job_dir / FileManager.upload_sessions_dir):
+        os.utime(path.as_posix(), (abandoned, abandoned))
+    assert create(uploads).status_code == 201
+    assert not job_dir.exists()
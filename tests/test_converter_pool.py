@@ -0,0 +1,69 @@
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from modules.converter_pool import WORKER_MARKER, ConverterWorker, ConverterWorkerPool, WarmRunProcess
+from modules.create_process import RunProcess
+
+# Reports ready unless started with "hang", then never answers a request
+HANGING_WORKER = f'''
+import sys, time
+if sys.argv[1] == 'hang':
+    time.sleep(60)
+print('{WORKER_MARKER} {{"ready": true}}', flush=True)
+for line in sys.stdin:
+    time.sleep(60)
+'''
+
+
+@pytest.fixture
+def worker_script(tmp_path) -> Path:
+    script = tmp_path / 'worker.py'
+    script.write_text(HANGING_WORKER)
+    return script
+
+
+@pytest.fixture
+def pool():
+    yield ConverterWorkerPool
+    ConverterWorkerPool.shutdown()
+    ConverterWorkerPool.configure(list(), Path('.'), dict(), 0, 25)
+
+
+def test_worker_start_timeout(tmp_path, worker_script):
+    worker = ConverterWorker([sys.executable, worker_script.as_posix(), 'hang'], tmp_path)
+
+    started = time.monotonic()
+    assert not worker.start(timeout=0.5)
+    assert time.monotonic() - started < 10
+    assert not worker.is_alive()
+
+
+def test_hanging_health_check_discards_worker(tmp_path, worker_script, pool):
+    pool.configure([sys.executable, worker_script.as_posix(), 'ready'], tmp_path, dict(), 1, 5, ping_timeout=0.5)
+    worker = pool.acquire()
+    assert worker is not None
+    pool.release(worker)
+
+    # The idle worker does not answer the health check and gets replaced by a new one
+    replacement = pool.acquire()
+    assert not worker.is_alive()
+    assert replacement is not None and replacement is not worker
+    pool.release(replacement, healthy=False)
+    assert pool._worker_count == 0
+
+
+def test_worker_start_counts_against_stage_timeout(tmp_path, worker_script, pool):
+    pool.configure([sys.executable, worker_script.as_posix(), 'hang'], tmp_path, dict(), 1, 5, start_timeout=3)
+    messages, event = list(), threading.Event()
+    process = WarmRunProcess('convert', list(), [sys.executable, '-c', 'pass'], tmp_path, identifier=1,
+                             finished_callback=lambda i: (messages.append(None), event.set()),
+                             failed_callback=lambda i, m: (messages.append(m), event.set()), timeout=0.5)
+    process.start()
+
+    assert event.wait(30)
+    assert messages == [RunProcess.timeout_message]
+    assert process.timed_out and pool._worker_count == 0
@@ -0,0 +1,64 @@
+import sqlite3
+
+import pytest
+from sqlalchemy.exc import OperationalError
+from werkzeug.datastructures import ImmutableMultiDict
+
+from modules.app import db
+from modules.db_engine import TimedQueuePool, engine_options
+from modules.job import ConversionJob
+from modules.metrics import Metrics
+
+
+def metric_value(name: str) -> float:
+    for line in Metrics.render().splitlines():
+        if line.startswith(f'{name} '):
+            return float(line.split()[-1])
+    return 0.0
+
+
+@pytest.fixture
+def busy_timeout(app_config):
+    """ Writers give up on a locked database after a tenth of a second """
+    app_config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(dict(app_config, SQLALCHEMY_ENGINE_OPTIONS=None,
+                                                                  SQLITE_BUSY_TIMEOUT=0.1))
+
+
+def test_file_databases_are_pooled():
+    options = engine_options({'SQLALCHEMY_DATABASE_URI': 'sqlite:////tmp/app.sqlite3', 'DB_POOL_SIZE': 4,
+                              'SQLITE_BUSY_TIMEOUT': 5})
+
+    assert options['poolclass'] is TimedQueuePool and options['pool_size'] == 4
+    assert options['connect_args'] == {'check_same_thread': False, 'timeout': 5.0}
+
+
+@pytest.mark.parametrize('uri', ['sqlite://', 'sqlite:///:memory:', 'postgresql://localhost/usdz'])
+def test_other_databases_keep_their_engine_options(uri):
+    assert engine_options({'SQLALCHEMY_DATABASE_URI': uri, 'SQLALCHEMY_ENGINE_OPTIONS': {'echo': True}}) == \
+        {'echo': True}
+
+
+def test_connections_use_write_ahead_logging(database):
+    assert db.session.execute('PRAGMA journal_mode').scalar().lower() == 'wal'
+    assert isinstance(db.engine.pool, TimedQueuePool)
+    assert metric_value('usdz_db_connections_in_use') == 1
+
+
+def test_locked_writes_are_counted(busy_timeout, database, tmp_path):
+    locked_errors = metric_value('usdz_db_locked_errors_total')
+    commits = metric_value('usdz_db_commit_seconds_count')
+
+    writer = sqlite3.connect((tmp_path / 'app.sqlite3').as_posix())
+    writer.execute('BEGIN IMMEDIATE')
+    try:
+        db.session.add(ConversionJob(tmp_path / 'job', dict(), ImmutableMultiDict()))
+        with pytest.raises(OperationalError):
+            db.session.commit()
+        db.session.rollback()
+    finally:
+        writer.rollback()
+        writer.close()
+
+    assert metric_value('usdz_db_locked_errors_total') == locked_errors + 1
+    # The failed commit is observed including the wait for the lock
+    assert metric_value('usdz_db_commit_seconds_count') == commits + 1
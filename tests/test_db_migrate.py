@@ -0,0 +1,79 @@
+import json
+import pickle
+import sqlite3
+from pathlib import PosixPath
+
+import pytest
+from sqlalchemy import inspect
+
+from modules.app import db
+from modules.db_migrate import migrate_pickled_jobs, upgrade_schema
+from modules.job import ConversionJob
+
+# Jobs table of app versions that pickled the job files and options
+BASELINE_SCHEMA = '''CREATE TABLE jobs (
+    job_id INTEGER NOT NULL, files BLOB, option_args BLOB, additional_args VARCHAR(120), state INTEGER,
+    progress INTEGER, completed BOOLEAN, process_messages VARCHAR(1000), errors VARCHAR(200), PRIMARY KEY (job_id))'''
+
+
+class Evil:
+    pass
+
+
+@pytest.fixture
+def baseline_database(tmp_path, app_config):
+    """ Database created by an earlier app version with one readable and one refused pickled job """
+    job_dir = tmp_path / 'job'
+    job_dir.mkdir()
+    (job_dir / 'scene.gltf').write_bytes(b'gltf' * 8)
+    files = {'scene_file': {'file_path': PosixPath(job_dir / 'scene.gltf')},
+             'diffuseColor': {'file_path': PosixPath(job_dir / 'diffuse.png'), 'channel': 'rgb', 'material': 'm'},
+             'job_dir': {'file_path': PosixPath(job_dir)}}
+
+    path = tmp_path / 'app.sqlite3'
+    connection = sqlite3.connect(path.as_posix())
+    connection.execute(BASELINE_SCHEMA)
+    connection.execute('INSERT INTO jobs VALUES (1, ?, ?, ?, 3, 100, 1, ?, ?)',
+                       (pickle.dumps(files), pickle.dumps(['-metersPerUnit', '1']), '', 'done', ''))
+    connection.execute('INSERT INTO jobs VALUES (2, ?, ?, ?, 4, 0, 1, ?, ?)',
+                       (pickle.dumps({'scene_file': {'file_path': Evil()}}), pickle.dumps([]), '', '', ''))
+    connection.commit()
+    connection.close()
+
+    app_config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path.as_posix()}'
+    db.session.remove()
+    yield job_dir
+    db.session.remove()
+
+
+def test_upgrade_and_migrate_baseline_database(baseline_database):
+    db.create_all()
+    assert upgrade_schema(db)
+
+    inspector = inspect(db.engine)
+    columns = {c['name'] for c in inspector.get_columns('jobs')}
+    assert {'submitter', 'lane', 'priority', 'estimated_seconds', 'lease_owner', 'folder_id'} <= columns
+    assert {i['name'] for i in inspector.get_indexes('jobs')} >= {i.name for i in ConversionJob.__table__.indexes}
+
+    # The job with a refused pickle is migrated without files
+    assert not migrate_pickled_jobs(db)
+    db.session.remove()
+
+    job = ConversionJob.query.get(1)
+    files = job.files
+    assert files['scene_file']['file_path'] == baseline_database / 'scene.gltf'
+    assert files['diffuseColor'] == {'file_path': baseline_database / 'diffuse.png', 'channel': 'rgb',
+                                     'material': 'm'}
+    assert {f.role: f.size for f in job.file_entries}['scene_file'] == 32
+    assert job.option_args == ['-metersPerUnit', '1']
+    assert job.state == ConversionJob.States.finished and job.process_messages == 'done'
+
+    assert ConversionJob.query.get(2).files == dict()
+    stored = db.engine.execute('SELECT option_args FROM jobs WHERE job_id = 1').scalar()
+    assert json.loads(stored) == ['-metersPerUnit', '1']
+
+
+def test_migration_of_a_current_database_is_a_noop(database):
+    assert upgrade_schema(database)
+    assert migrate_pickled_jobs(database)
+    assert 'files' not in {c['name'] for c in inspect(database.engine).get_columns('jobs')}
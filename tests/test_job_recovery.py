@@ -0,0 +1,65 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+from werkzeug.datastructures import ImmutableMultiDict
+
+from modules.app import db
+from modules.job import ConversionJob, JobLeases, JobManager
+
+States = ConversionJob.States
+HOST = socket.gethostname()
+
+
+@pytest.fixture
+def manager(database, monkeypatch):
+    monkeypatch.setattr(JobManager, '_slots', list())
+    return JobManager
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def add_leased_job(tmp_path, owner: str, expires: float) -> int:
+    job = ConversionJob(tmp_path / owner.replace(':', '_'), dict(), ImmutableMultiDict())
+    job.set_state(States.in_progress)
+    job.lease_owner, job.lease_expires = owner, expires
+    db.session.add(job)
+    db.session.commit()
+    return job.job_id
+
+
+def job_states(job_ids: dict) -> dict:
+    db.session.remove()
+    return {name: ConversionJob.query.get(job_id).state for name, job_id in job_ids.items()}
+
+
+def test_startup_recovers_expired_leases_and_dead_owners_of_this_host(tmp_path, manager):
+    future, past = time.time() + 600, time.time() - 1
+    job_ids = {
+        'dead_owner': add_leased_job(tmp_path, f'{HOST}:{dead_pid()}:0000aaaa', future),
+        'restarted_owner': add_leased_job(tmp_path, f'{HOST}:{os.getpid()}:0000bbbb', future),
+        'running_owner': add_leased_job(tmp_path, f'{HOST}:{os.getppid()}:0000cccc', future),
+        'other_host': add_leased_job(tmp_path, f'other-{HOST}:{dead_pid()}:0000dddd', future),
+        'other_host_expired': add_leased_job(tmp_path, f'other-{HOST}:1:0000eeee', past),
+        'own_lease': add_leased_job(tmp_path, JobLeases.owner, future),
+    }
+
+    assert manager.recover_jobs(startup=True) == 3
+    assert job_states(job_ids) == {'dead_owner': States.queued, 'restarted_owner': States.queued,
+                                   'running_owner': States.in_progress, 'other_host': States.in_progress,
+                                   'other_host_expired': States.queued, 'own_lease': States.in_progress}
+
+
+def test_heartbeat_recovers_expired_leases_only(tmp_path, manager):
+    job_ids = {'dead_owner': add_leased_job(tmp_path, f'{HOST}:{dead_pid()}:0000aaaa', time.time() + 600),
+               'expired': add_leased_job(tmp_path, f'other-{HOST}:1:0000bbbb', time.time() - 1)}
+
+    assert manager.recover_jobs() == 1
+    assert job_states(job_ids) == {'dead_owner': States.in_progress, 'expired': States.queued}
@@ -0,0 +1,77 @@
+import pytest
+from sqlalchemy import event
+
+from modules.app import db
+from modules.job import ConversionJob
+from modules.job_api import job_status
+from modules.job_state import JobStateRegistry
+from modules.process_usage import STAGE_CONVERT, STAGE_POST_PROCESS
+
+IN_PROGRESS, POST_PROCESSED = ConversionJob.States.in_progress, ConversionJob.States.post_processed
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(JobStateRegistry, '_jobs', dict())
+    JobStateRegistry.start(1, IN_PROGRESS, STAGE_CONVERT, 5, (5, 75))
+    return JobStateRegistry
+
+
+def test_output_progress_is_mapped_into_the_stage_range(registry):
+    registry.output(1, 'Converting textures 40%')
+    assert registry.get(1)['progress'] == 33
+    assert registry.get(1)['last_output'] == 'Converting textures 40%'
+
+    registry.output(1, 'Writing 250%')
+    assert registry.get(1)['progress'] == 75
+
+
+def test_progress_never_moves_backwards(registry):
+    registry.output(1, 'Converting textures 40%')
+    assert registry.take_dirty() == {1: 33}
+
+    registry.output(1, 'Converting meshes 10%')
+    registry.output(1, 'Done without percentage')
+    assert registry.get(1)['progress'] == 33
+    assert registry.get(1)['last_output'] == 'Done without percentage'
+    # Only progress changed since the last write behind is taken
+    assert registry.take_dirty() == dict()
+
+
+def test_transition_moves_to_the_next_stage_range(registry):
+    registry.output(1, 'Converting 50%')
+    registry.transition(1, POST_PROCESSED, STAGE_POST_PROCESS, 75, (75, 95))
+
+    live = registry.get(1)
+    assert (live['state'], live['stage'], live['progress']) == (POST_PROCESSED, STAGE_POST_PROCESS, 75)
+    # The caller commits the transition, nothing is left to write behind
+    assert registry.take_dirty() == dict()
+
+    registry.output(1, 'Assigning materials 50%')
+    assert registry.take_dirty() == {1: 85}
+
+
+def test_finished_jobs_are_read_from_the_database_again(registry):
+    registry.finish(1)
+
+    registry.output(1, 'Converting 50%')
+    registry.transition(1, POST_PROCESSED, STAGE_POST_PROCESS, 75, (75, 95))
+    assert registry.get(1) is None and not registry.is_active(1)
+    assert registry.take_dirty() == dict()
+
+
+def test_status_of_running_jobs_is_served_without_queries(registry, database):
+    registry.output(1, 'Converting 40%')
+    statements = list()
+
+    def count_statement(*args):
+        statements.append(args[2])
+
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        status = job_status(1)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+    assert statements == list()
+    assert status['progress'] == 33 and status['stage'] == STAGE_CONVERT and not status['completed']
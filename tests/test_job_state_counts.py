@@ -0,0 +1,69 @@
+import pytest
+from sqlalchemy import event
+from werkzeug.datastructures import ImmutableMultiDict
+
+from modules.app import db
+from modules.job import ConversionJob, JobStateCounts
+
+States = ConversionJob.States
+
+
+@pytest.fixture
+def counts(database, monkeypatch):
+    monkeypatch.setattr(JobStateCounts, '_counts', dict())
+    monkeypatch.setattr(JobStateCounts, '_synced', 0.0)
+    return JobStateCounts
+
+
+def add_job(tmp_path, state: int) -> int:
+    job = ConversionJob(tmp_path, dict(), ImmutableMultiDict())
+    job.set_state(state)
+    db.session.add(job)
+    db.session.commit()
+    return job.job_id
+
+
+def collect_without_queries(counts) -> dict:
+    statements = list()
+
+    def count_statement(*args):
+        statements.append(args[2])
+
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        collected = counts.collect()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+    assert statements == list()
+    return {state: collected[(name.lower().replace(' ', '_'),)] for state, name in ConversionJob.state_names.items()}
+
+
+def test_transitions_of_expired_jobs_are_counted(tmp_path, counts):
+    add_job(tmp_path, States.finished)
+    counts.sync()
+    assert not counts.resync_due()
+
+    job_id = add_job(tmp_path, States.queued)
+    # Committed jobs are expired, the previous state is not loaded before set_state
+    job = ConversionJob.query.get(job_id)
+    db.session.expire(job)
+    job.set_in_progress()
+    db.session.commit()
+
+    job.set_state(States.post_processed)
+    db.session.commit()
+    job.set_failed('Process returned with error code.')
+    db.session.commit()
+
+    collected = collect_without_queries(counts)
+    assert collected[States.failed] == 1 and collected[States.finished] == 1
+    assert collected[States.queued] == collected[States.in_progress] == collected[States.post_processed] == 0
+
+
+def test_deleted_jobs_are_counted(tmp_path, counts):
+    job_id = add_job(tmp_path, States.queued)
+    db.session.delete(ConversionJob.query.get(job_id))
+    db.session.commit()
+
+    assert collect_without_queries(counts)[States.queued] == 0
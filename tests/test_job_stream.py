@@ -0,0 +1,65 @@
+import json
+import time
+
+import pytest
+from werkzeug.datastructures import ImmutableMultiDict
+
+from modules.app import db
+from modules.job import ConversionJob
+from modules.job_stream import JobStreams, job_status_stream
+from modules.site import Urls
+
+
+@pytest.fixture
+def client(client, app_config, monkeypatch):
+    app_config.update({'JOB_STREAM_MAX_CLIENTS': 1, 'JOB_STREAM_RETRY_AFTER': 7, 'JOB_STREAM_SECONDS': 1})
+    monkeypatch.setattr(JobStreams, '_open', 0)
+    return client
+
+
+def add_job(tmp_path, state: int = ConversionJob.States.in_progress) -> int:
+    job = ConversionJob(tmp_path, dict(), ImmutableMultiDict())
+    job.state, job.progress, job.created = state, 40, time.time()
+    db.session.add(job)
+    db.session.commit()
+    return job.job_id
+
+
+def events(stream) -> list:
+    return [(chunk.split('\n')[0], json.loads(chunk.split('data: ')[1])) for chunk in stream
+            if chunk.startswith('event:')]
+
+
+def test_initial_state_and_end_of_stream(tmp_path, database):
+    job_id = add_job(tmp_path)
+
+    started = time.monotonic()
+    received = events(job_status_stream({job_id: 0}, job_id, max_seconds=0.5))
+
+    assert received[0] == ('event: ready', {'jobs': 1})
+    assert received[1][0] == 'event: job' and received[1][1]['job_id'] == job_id
+    assert received[1][1]['progress'] == 40 and received[1][1]['state'] == ConversionJob.States.in_progress
+    assert received[-1] == ('event: end', {})
+    assert time.monotonic() - started < 5
+
+
+def test_streams_are_limited(tmp_path, client):
+    job_id = add_job(tmp_path)
+    url = f'{Urls.job_stream}?jobs={job_id}:0&last={job_id}'
+
+    stream = client.get(url)
+    assert stream.status_code == 200 and JobStreams.open_streams() == 1
+
+    refused = client.get(url)
+    assert refused.status_code == 503
+    assert refused.headers['Retry-After'] == '7'
+
+    # Clients poll the same state without holding a stream open
+    poll = client.get(url + '&poll=1')
+    assert poll.status_code == 200
+    assert [job['job_id'] for job in poll.get_json()['jobs']] == [job_id]
+    assert not poll.get_json()['reload']
+
+    stream.close()
+    assert JobStreams.open_streams() == 0
+    assert client.get(url).status_code == 200
@@ -0,0 +1,116 @@
+import os
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+from modules.converter_pool import ConverterWorkerPool, WarmRunProcess
+from modules.create_process import RunProcess
+from modules.process_limits import ProcessLimits
+
+pytestmark = pytest.mark.skipif(sys.platform != 'linux', reason='RLIMIT_AS memory limits are applied on Linux')
+
+WORKER_SCRIPT = Path(__file__).parent.parent / 'proc' / 'converter_worker.py'
+
+
+class Result:
+    def __init__(self):
+        self.messages = list()
+        self.event = threading.Event()
+
+    def finished(self, identifier):
+        self.messages.append(None)
+        self.event.set()
+
+    def failed(self, identifier, message):
+        self.messages.append(message)
+        self.event.set()
+
+    def wait(self) -> str:
+        assert self.event.wait(30), 'Process did not report a result'
+        return self.messages[0]
+
+
+def test_limits_are_set_before_exec(tmp_path):
+    script = ('import os, resource; '
+              'print(os.getpriority(os.PRIO_PROCESS, 0), sorted(os.sched_getaffinity(0)), '
+              'resource.getrlimit(resource.RLIMIT_AS)[0])')
+    cpu = min(os.sched_getaffinity(0))
+    limits = ProcessLimits(nice=min(19, os.getpriority(os.PRIO_PROCESS, 0) + 5), cpus={cpu}, memory_mb=1024)
+
+    output = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE, check=True,
+                            preexec_fn=limits.preexec()).stdout.decode().split()
+    assert output == [str(limits.nice), f'[{cpu}]', str(1024 * 1048576)]
+
+
+def test_rlimit_memory_error_of_a_process(tmp_path):
+    # Allocates beyond the limit right after the start
+    script = 'data = bytearray(512 * 1024 * 1024)'
+    result = Result()
+    process = RunProcess([sys.executable, '-c', script], tmp_path, identifier=1,
+                         finished_callback=result.finished, failed_callback=result.failed,
+                         limits=ProcessLimits(memory_mb=256))
+    process.start()
+
+    assert result.wait() == RunProcess.memory_message
+    assert process.process_exitcode == 1
+
+
+def test_process_error_without_memory_limit(tmp_path):
+    result = Result()
+    process = RunProcess([sys.executable, '-c', 'raise SystemExit(3)'], tmp_path, identifier=2,
+                         finished_callback=result.finished, failed_callback=result.failed,
+                         limits=ProcessLimits(memory_mb=256))
+    process.start()
+
+    assert result.wait() == 'Process returned with error code.'
+
+
+ALLOCATE = ('def tryProcess(args):\n'
+            '    data = bytearray(1024 ** 4)\n'
+            '    return 0\n')
+# Dies like a worker killed by the kernel at the cgroup memory limit
+KILLED = ('import os, signal\n'
+          'def tryProcess(args):\n'
+          '    os.kill(os.getpid(), signal.SIGKILL)\n')
+
+
+@pytest.fixture
+def warm_pool(tmp_path, request):
+    (tmp_path / 'pxr').mkdir()
+    (tmp_path / 'pxr' / '__init__.py').write_text('Usd = object()\n')
+    usdzconvert = tmp_path / 'usdzconvert'
+    usdzconvert.write_text(getattr(request, 'param', ALLOCATE))
+
+    arguments = [sys.executable, '-u', WORKER_SCRIPT.as_posix(), usdzconvert.as_posix(), usdzconvert.as_posix()]
+    ConverterWorkerPool.configure(arguments, tmp_path, {'PYTHONPATH': tmp_path.as_posix()}, 1, 5)
+    yield tmp_path
+    ConverterWorkerPool.shutdown()
+    ConverterWorkerPool.configure(list(), Path('.'), dict(), 0, 25)
+
+
+def test_memory_error_reported_by_warm_worker(warm_pool):
+    result = Result()
+    process = WarmRunProcess('convert', ['in.obj', 'out.usdz'], list(), warm_pool, identifier=3,
+                             finished_callback=result.finished, failed_callback=result.failed,
+                             limits=ProcessLimits(memory_mb=4096))
+    process.start()
+
+    assert result.wait() == RunProcess.memory_message
+    assert process.worker is not None and process.worker.last_error == 'memory'
+
+
+@pytest.mark.parametrize('warm_pool', [KILLED], indirect=True, ids=['killed'])
+@pytest.mark.parametrize('memory_mb, message', [(4096, RunProcess.memory_message),
+                                                (0, 'Process returned with error code.')])
+def test_killed_warm_worker(warm_pool, memory_mb, message):
+    result = Result()
+    process = WarmRunProcess('convert', ['in.obj', 'out.usdz'], list(), warm_pool, identifier=4,
+                             finished_callback=result.finished, failed_callback=result.failed,
+                             limits=ProcessLimits(memory_mb=memory_mb))
+    process.start()
+
+    assert result.wait() == message
+    assert process.process_exitcode == -9
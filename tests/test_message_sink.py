@@ -0,0 +1,60 @@
+import pytest
+from werkzeug.datastructures import ImmutableMultiDict
+
+from modules.app import db
+from modules.job import ConversionJob, JobMessageSink
+from modules.job_events import JobEvents
+
+
+def add_job(tmp_path, state: int, progress: int = 0, completed: bool = False) -> int:
+    job = ConversionJob(tmp_path, dict(), ImmutableMultiDict())
+    job.state, job.progress, job.completed, job.process_messages = state, progress, completed, 'started\n'
+    db.session.add(job)
+    db.session.commit()
+    return job.job_id
+
+
+def messages(job_id: int) -> str:
+    db.session.remove()
+    return ConversionJob.query.get(job_id).process_messages
+
+
+@pytest.fixture
+def sink(database, monkeypatch):
+    monkeypatch.setattr(JobMessageSink, '_buffers', dict())
+    return JobMessageSink
+
+
+def test_messages_are_written_in_batches(tmp_path, sink):
+    job_id = add_job(tmp_path, ConversionJob.States.in_progress)
+    other_id = add_job(tmp_path, ConversionJob.States.in_progress)
+
+    for n in range(3):
+        sink.append(job_id, f'line {n}')
+    sink.append(other_id, 'other')
+    assert messages(job_id) == 'started\n'
+
+    revision = JobEvents.revision
+    sink.flush(job_id)
+    assert messages(job_id) == 'started\nline 0\nline 1\nline 2\n'
+    assert messages(other_id) == 'started\n'
+    assert JobEvents.revision > revision
+
+    sink.append(job_id, 'line 3')
+    sink.flush()
+    assert messages(job_id).endswith('line 2\nline 3\n')
+    assert messages(other_id) == 'started\nother\n'
+
+
+def test_progress_write_behind_never_moves_jobs_backwards(tmp_path, sink):
+    states = ConversionJob.States
+    running = add_job(tmp_path, states.in_progress, progress=20)
+    ahead = add_job(tmp_path, states.post_processed, progress=90)
+    finished = add_job(tmp_path, states.finished, progress=100, completed=True)
+    queued = add_job(tmp_path, states.queued)
+
+    sink._write_progress({running: 50, ahead: 60, finished: 40, queued: 30})
+    db.session.remove()
+
+    assert [ConversionJob.query.get(job_id).progress for job_id in (running, ahead, finished, queued)] == \
+        [50, 90, 100, 0]
@@ -0,0 +1,56 @@
+import asyncio
+import concurrent.futures
+import threading
+
+import pytest
+
+from modules.app import App
+from modules.job import JobManager
+from modules.process_supervisor import ProcessSupervisor
+
+
+@pytest.fixture
+def supervisor():
+    callback_threads = ProcessSupervisor.callback_threads
+    yield ProcessSupervisor
+    ProcessSupervisor.configure(callback_threads)
+
+
+def test_callbacks_of_every_slot_run_at_once(supervisor):
+    supervisor.configure(4)
+    # Callbacks blocking on the database must not wait for each other
+    barrier, done = threading.Barrier(4, timeout=10), threading.Semaphore(0)
+
+    def blocking_callback():
+        barrier.wait()
+        done.release()
+
+    for _ in range(4):
+        supervisor.dispatch(blocking_callback)
+
+    assert all(done.acquire(timeout=15) for _ in range(4))
+    assert not barrier.broken
+
+
+def test_slots_size_the_callback_pool(supervisor, database, app_config, monkeypatch):
+    App.config.update(CONVERSION_WORKERS=3, PREVIEW_WORKERS=2, CONVERTER_WARM_WORKERS=False)
+    monkeypatch.setattr(JobManager, '_slots', list())
+
+    JobManager._get_slots()
+    assert supervisor.callback_threads == 5
+
+
+def test_call_timeout_does_not_block_the_loop(supervisor):
+    with pytest.raises(concurrent.futures.TimeoutError):
+        supervisor.call(asyncio.sleep(5), timeout=0.2)
+
+    assert supervisor.call(asyncio.sleep(0, 'answered'), timeout=5) == 'answered'
+
+
+def test_call_inside_the_loop_is_refused(supervisor):
+    async def nested_call():
+        coroutine = asyncio.sleep(0)
+        supervisor.call(coroutine)
+
+    with pytest.raises(RuntimeError):
+        supervisor.call(nested_call(), timeout=5)
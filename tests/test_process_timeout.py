@@ -0,0 +1,76 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from modules.create_process import RunProcess, create_piped_process
+from modules.process_supervisor import ProcessSupervisor
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='Process groups are killed with signals')
+
+# Starts a grandchild that writes it's pid and keeps running after it's parent
+SPAWN_GRANDCHILD = '''
+import subprocess, sys, time
+child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+print('grandchild', child.pid, flush=True)
+time.sleep(60)
+'''
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # Killed children of other processes are zombies until reaped
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except OSError:
+        return False
+
+
+def wait_until_gone(pid: int, seconds: float = 5) -> bool:
+    deadline = time.monotonic() + seconds
+    while is_running(pid):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_stage_timeout_kills_process_tree(tmp_path):
+    messages, event = list(), threading.Event()
+    process = RunProcess([sys.executable, '-u', '-c', SPAWN_GRANDCHILD], tmp_path, identifier=1,
+                         finished_callback=lambda i: (messages.append(None), event.set()),
+                         failed_callback=lambda i, m: (messages.append(m), event.set()),
+                         stage='convert', timeout=2, log_file=tmp_path / 'job.log')
+    started = time.monotonic()
+    process.start()
+
+    assert event.wait(30)
+    assert messages == [RunProcess.timeout_message]
+    assert time.monotonic() - started < 15
+    assert process.timed_out
+
+    log = (tmp_path / 'job.log').read_text()
+    grandchild = int(log.split('grandchild ')[1].split()[0])
+    assert wait_until_gone(grandchild)
+    assert 'exceeded the time limit of 2s' in log
+
+
+def test_shutdown_kills_live_process_groups(tmp_path, monkeypatch):
+    monkeypatch.setattr(ProcessSupervisor, '_groups', dict())
+    process = create_piped_process([sys.executable, '-u', '-c', SPAWN_GRANDCHILD], tmp_path)
+    grandchild = int(process.stdout.readline().split()[1])
+    assert ProcessSupervisor.live_groups() == 1
+
+    ProcessSupervisor.shutdown()
+    process.wait(10)
+    process.stdout.close()
+
+    assert process.returncode == -9
+    assert wait_until_gone(grandchild)
+    assert ProcessSupervisor.live_groups() == 0
@@ -0,0 +1,87 @@
+import pytest
+
+from modules.app import db
+from modules.metrics import Metrics
+from modules.result_cache import CachedResult, ResultCache
+
+
+@pytest.fixture
+def cache(tmp_path, database, app_config):
+    app_config['RESULT_CACHE_FOLDER'] = tmp_path / 'result_cache'
+    app_config['RESULT_CACHE_MAX_BYTES'] = 1024
+    return ResultCache
+
+
+def write_result(directory, name: str, size: int):
+    directory.mkdir(parents=True, exist_ok=True)
+    result_file = directory / name
+    result_file.write_bytes(b'u' * size)
+    return result_file
+
+
+def test_digest_of_job_files_and_arguments(tmp_path):
+    job_dir = tmp_path / 'job'
+    scene_file = write_result(job_dir, 'scene.gltf', 16)
+    digest = ResultCache.create_digest(job_dir, [scene_file, '-metersPerUnit', '1'])
+
+    # Only file names relative to the job directory are part of the digest
+    other_dir = tmp_path / 'other_job'
+    other_scene = write_result(other_dir, 'scene.gltf', 16)
+    assert ResultCache.create_digest(other_dir, [other_scene, '-metersPerUnit', '1']) == digest
+
+    assert ResultCache.create_digest(job_dir, [scene_file, '-metersPerUnit', '2']) != digest
+    assert ResultCache.create_digest(job_dir, [scene_file, '-metersPerUnit', '1'],
+                                     {'scene.gltf': ResultCache.file_digest(scene_file)}) == digest
+
+    scene_file.write_bytes(b'v' * 16)
+    assert ResultCache.create_digest(job_dir, [scene_file, '-metersPerUnit', '1']) != digest
+
+
+def test_miss_store_and_hit(tmp_path, cache):
+    hits, misses = cache.hits, cache.misses
+    assert cache.get('a' * 64) is None
+    assert cache.misses == misses + 1
+
+    cache.store('a' * 64, write_result(tmp_path / 'job', 'scene.usdz', 100))
+    entry = cache.get('a' * 64)
+
+    assert entry is not None and entry.hits == 1
+    assert entry.file().read_bytes() == b'u' * 100
+    assert cache.hits == hits + 1
+    assert cache.stats()['entries'] == 1 and cache.stats()['size'] == 100
+
+
+def test_lookups_are_exported_as_metrics(cache):
+    cache.get('0' * 64)
+    metrics = Metrics.render()
+
+    assert f'usdz_result_cache_lookups{{result="miss"}} {cache.misses}' in metrics
+    assert f'usdz_result_cache_lookups{{result="hit"}} {cache.hits}' in metrics
+
+
+def test_missing_result_file_is_a_miss(tmp_path, cache):
+    cache.store('b' * 64, write_result(tmp_path / 'job', 'scene.usdz', 100))
+    CachedResult.query.get('b' * 64).file().unlink()
+
+    assert cache.get('b' * 64) is None
+    assert CachedResult.query.get('b' * 64) is None
+
+
+def test_least_recently_used_results_are_evicted(tmp_path, cache):
+    for digest, last_used in (('c' * 64, 1.0), ('d' * 64, 2.0), ('e' * 64, 3.0)):
+        cache.store(digest, write_result(tmp_path / digest, 'scene.usdz', 400))
+        entry = CachedResult.query.get(digest)
+        if entry is not None:
+            entry.last_used = last_used
+            db.session.commit()
+
+    # Storing the third result exceeds 1024 bytes and removes the least recently used one
+    assert CachedResult.query.get('c' * 64) is None
+    assert not (cache.cache_folder() / ('c' * 64)).exists()
+
+    # A hit marks the result as recently used
+    assert cache.get('d' * 64) is not None
+    cache.store('f' * 64, write_result(tmp_path / 'f', 'scene.usdz', 400))
+    assert CachedResult.query.get('e' * 64) is None
+    assert {e.digest[0] for e in CachedResult.query.all()} == {'d', 'f'}
+    assert cache.stats()['size'] <= 1024
@@ -0,0 +1,126 @@
+import time
+
+import pytest
+from werkzeug.datastructures import ImmutableMultiDict
+
+from modules.app import db
+from modules.job import ConversionJob, JobScheduler
+
+ANONYMOUS = JobScheduler.submitter_key('10.0.0.1')
+TOKEN = JobScheduler.submitter_key('10.0.0.2', 'api-token')
+
+
+@pytest.fixture
+def scheduler(database, app_config, monkeypatch):
+    app_config['JOB_AGING_FACTOR'] = 1.0
+    monkeypatch.setattr(JobScheduler, '_served', dict())
+    monkeypatch.setattr(JobScheduler, '_claims_since_bulk', 0)
+    return JobScheduler
+
+
+def add_job(tmp_path, submitter: str, state: int = ConversionJob.States.queued, priority: int = 0,
+            estimated_seconds: float = 10.0, waited: float = 0.0, lane: str = JobScheduler.lane_interactive) -> int:
+    job = ConversionJob(tmp_path, dict(), ImmutableMultiDict())
+    job.state, job.submitter, job.lane, job.priority = state, submitter, lane, priority
+    job.estimated_seconds, job.created = estimated_seconds, time.time() - waited
+    db.session.add(job)
+    db.session.commit()
+    return job.job_id
+
+
+def claim(scheduler) -> int:
+    job = scheduler.next_job()
+    job.state = ConversionJob.States.in_progress
+    db.session.commit()
+    scheduler.claimed(job)
+    return job.job_id
+
+
+def test_submitters_without_running_jobs_go_first(tmp_path, scheduler):
+    add_job(tmp_path, 'addr:busy', state=ConversionJob.States.in_progress)
+    busy = add_job(tmp_path, 'addr:busy', priority=5, estimated_seconds=1.0)
+    idle = add_job(tmp_path, 'addr:idle', estimated_seconds=100.0)
+
+    assert claim(scheduler) == idle
+    assert claim(scheduler) == busy
+
+
+def test_higher_priority_first_within_a_fair_share(tmp_path, scheduler):
+    low = add_job(tmp_path, 'token:a', priority=-1, estimated_seconds=1.0)
+    high = add_job(tmp_path, 'token:b', priority=2, estimated_seconds=100.0)
+
+    assert scheduler.next_job().job_id == high
+    assert claim(scheduler) == high
+    assert claim(scheduler) == low
+
+
+def test_round_robin_between_submitters(tmp_path, scheduler):
+    first = [add_job(tmp_path, 'addr:a') for _ in range(2)]
+    second = [add_job(tmp_path, 'addr:b') for _ in range(2)]
+
+    # Equal running jobs and costs alternate between the submitters
+    claimed = [claim(scheduler) for _ in range(2)]
+    db.session.query(ConversionJob).filter(ConversionJob.job_id.in_(claimed)).update(
+        {ConversionJob.state: ConversionJob.States.finished, ConversionJob.completed: True},
+        synchronize_session=False)
+    db.session.commit()
+    claimed += [claim(scheduler) for _ in range(2)]
+
+    assert claimed == [first[0], second[0], first[1], second[1]]
+
+
+def test_bulk_lane_share(tmp_path, scheduler, app_config):
+    app_config['BULK_LANE_SHARE'] = 2
+    bulk = add_job(tmp_path, 'addr:batch', lane=JobScheduler.lane_bulk)
+    interactive = [add_job(tmp_path, f'addr:{n}') for n in range(2)]
+
+    assert [claim(scheduler) for _ in range(3)] == [interactive[0], bulk, interactive[1]]
+
+
+def test_only_token_submitters_choose_priority_and_lane(tmp_path, scheduler):
+    form = ImmutableMultiDict({'priority': '99', 'lane': 'bulk'})
+
+    job = ConversionJob(tmp_path, dict(), ImmutableMultiDict())
+    scheduler.assign(job, ANONYMOUS, form)
+    assert (job.priority, job.lane) == (0, JobScheduler.lane_interactive)
+
+    job = ConversionJob(tmp_path, dict(), ImmutableMultiDict())
+    scheduler.assign(job, TOKEN, form)
+    assert (job.priority, job.lane) == (5, JobScheduler.lane_bulk)
+
+
+def test_shortest_expected_job_first(tmp_path, scheduler):
+    long = add_job(tmp_path, 'addr:a', estimated_seconds=120.0)
+    short = add_job(tmp_path, 'addr:b', estimated_seconds=5.0)
+
+    assert claim(scheduler) == short
+    assert claim(scheduler) == long
+
+
+def test_waiting_jobs_age_ahead_of_shorter_jobs(tmp_path, scheduler, app_config):
+    # 120s expected cost minus 200s waited ranks before a new 5s job
+    aged = add_job(tmp_path, 'addr:a', estimated_seconds=120.0, waited=200.0)
+    add_job(tmp_path, 'addr:b', estimated_seconds=5.0)
+    assert scheduler.next_job().job_id == aged
+
+    app_config['JOB_AGING_FACTOR'] = 0.0
+    assert scheduler.next_job().job_id != aged
+
+
+def test_effective_cost():
+    class Row:
+        estimated_seconds, created = 60.0, 100.0
+
+    assert JobScheduler.effective_cost(Row, now=130.0, aging=1.0) == 30.0
+    assert JobScheduler.effective_cost(Row, now=130.0, aging=0.5) == 45.0
+    Row.created = None
+    assert JobScheduler.effective_cost(Row, now=130.0, aging=1.0) == 60.0
+
+
+def test_completion_estimate_of_queued_jobs(tmp_path, scheduler):
+    first = add_job(tmp_path, 'addr:a', estimated_seconds=10.0)
+    second = add_job(tmp_path, 'addr:b', estimated_seconds=20.0)
+    third = add_job(tmp_path, 'addr:c', estimated_seconds=30.0)
+
+    eta = scheduler.estimate_completion(workers=2)
+    assert (eta[first], eta[second], eta[third]) == (10.0, 20.0, 40.0)
@@ -0,0 +1,60 @@
+import hashlib
+import io
+
+import pytest
+
+from modules.app import App
+from modules.site import Urls
+from modules.upload_stream import HashingFile, StreamedUploadRequest
+
+
+def test_hashing_file_digest_of_written_chunks(tmp_path):
+    chunks = [b'glTF', b'\0' * 65536, bytes(range(256))]
+    file = HashingFile(tmp_path / 'scene.glb')
+    for chunk in chunks:
+        file.write(chunk)
+    file.seek(0)
+
+    assert file.read() == b''.join(chunks)
+    assert file.size == sum(len(chunk) for chunk in chunks)
+    assert file.sha256 == hashlib.sha256(b''.join(chunks)).hexdigest()
+    file.close()
+
+    # Existing files are never overwritten
+    with pytest.raises(FileExistsError):
+        HashingFile(tmp_path / 'scene.glb')
+
+
+def test_streamed_upload_digests(database, app_config):
+    scene, texture = b'{"asset": {}}' * 4096, b'\x89PNG' + b'\1' * 1000
+    data = {'scene_file': (io.BytesIO(scene), 'scene.gltf'), 'diffuseColor': (io.BytesIO(texture), 'diffuse.png'),
+            'notes': (io.BytesIO(b'text'), 'notes.txt')}
+
+    with App.test_request_context(Urls.root, method='POST', data=data, content_type='multipart/form-data') as ctx:
+        request = ctx.request
+        assert isinstance(request, StreamedUploadRequest)
+        files = request.files
+
+        # Allowed files are written to a new job directory while the body is parsed
+        assert request.upload_job_dir.parent == app_config['UPLOAD_FOLDER']
+        for field, content in (('scene_file', scene), ('diffuseColor', texture)):
+            stream = files[field].stream
+            assert isinstance(stream, HashingFile)
+            assert (stream.size, stream.sha256) == (len(content), hashlib.sha256(content).hexdigest())
+            stream.flush()
+            assert stream.path.parent == request.upload_job_dir
+            assert stream.path.read_bytes() == content
+
+        # Files of other types are spooled as usual
+        assert not isinstance(files['notes'].stream, HashingFile)
+        assert files['notes'].read() == b'text'
+        assert request.upload_seconds > 0.0
+
+
+def test_other_endpoints_are_not_streamed(database):
+    data = {'file': (io.BytesIO(b'chunk'), 'scene.gltf')}
+
+    with App.test_request_context(f'{Urls.upload}/batch/upload', method='PATCH', data=data,
+                                  content_type='multipart/form-data') as ctx:
+        assert not isinstance(ctx.request.files['file'].stream, HashingFile)
+        assert ctx.request.upload_job_dir is None
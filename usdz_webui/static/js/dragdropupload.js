@@ -153,24 +153,139 @@ function dragDropUpload (uploadAllowedMapExt, uploadAllowedSceneExt, textureMapD
     p.innerHTML = msg.slice(0, msg.length - 3)
   }
 
-  const uploadAsFormData = (files) => {
-    const newFormData = new window.FormData()
+  /* Chunked resumable uploads, interrupted transfers continue at the offset reported by the server */
+  const uploadUrl = '/upload'
+  const chunkSize = 8 * 1024 * 1024
+  const maxRetries = 8
 
-    for (const file of files) {
-      newFormData.append('files', file, file.name)
+  function sleep (ms) {
+    return new Promise(resolve => setTimeout(resolve, ms))
+  }
+
+  function fileKey (file) {
+    return 'upload:' + [file.name, file.size, file.lastModified].join(':')
+  }
+
+  function batchKey (files) {
+    return 'upload_batch:' + files.map(entry => fileKey(entry.file)).join('|')
+  }
+
+  async function uploadRequest (url, options) {
+    for (let retry = 0; ; retry++) {
+      try {
+        const response = await window.fetch(url, options)
+        /* Server is busy, wait as long as it asks for */
+        const retryAfter = parseInt(response.headers.get('Retry-After'))
+        if ((response.status === 429 || response.status === 503) && retryAfter > 0 && retry < maxRetries) {
+          await sleep(retryAfter * 1000)
+          continue
+        }
+        if (response.status < 500) { return response }
+      } catch (e) {
+        console.log('Upload request failed', e)
+      }
+      if (retry >= maxRetries) { throw new Error('Upload failed after ' + maxRetries + ' retries.') }
+      /* Exponential back off up to 30s */
+      await sleep(Math.min(30000, 500 * Math.pow(2, retry)))
     }
-    console.log('Form Data to send: ' + newFormData.files)
+  }
 
-    window.fetch('/upload', {
+  async function uploadFile (entry, batch, onProgress) {
+    /* batch is the job directory and the key returned when the batch was created */
+    const file = entry.file
+    let response = await uploadRequest(uploadUrl, {
       method: 'POST',
-      body: newFormData
-    }).then(
-      response => response.json()
-    ).then(
-      success => console.log(success)
-    ).catch(
-      error => console.log(error)
-    )
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ filename: file.name, size: file.size, field: entry.field, batch: batch.name, batch_key: batch.key })
+    })
+    const upload = await response.json()
+    if (response.status !== 201) { throw new Error(upload.message) }
+    const batchKey = upload.batch_key || batch.key
+
+    let offset = upload.offset
+    while (offset < file.size) {
+      onProgress(file, offset)
+      response = await uploadRequest(upload.url, {
+        method: 'PATCH',
+        headers: { 'Upload-Offset': String(offset), 'Upload-Batch-Key': batchKey, 'Content-Type': 'application/offset+octet-stream' },
+        body: file.slice(offset, offset + chunkSize)
+      })
+      if (response.status !== 204 && response.status !== 409) {
+        throw new Error('Upload of ' + file.name + ' rejected with status ' + response.status)
+      }
+      /* Server reports its offset on success and on conflicts */
+      offset = parseInt(response.headers.get('Upload-Offset'))
+    }
+    onProgress(file, offset)
+    return { name: upload.batch, key: batchKey }
+  }
+
+  async function uploadFormFiles (form, statusElement) {
+    const files = []
+    for (const input of form.querySelectorAll('input[type=file]')) {
+      for (const file of input.files) { files.push({ field: input.name, file: file }) }
+    }
+    if (files.length === 0) { return null }
+
+    const key = batchKey(files)
+    const totalSize = files.reduce((size, entry) => size + entry.file.size, 0)
+    const progress = {}
+    const storedBatch = window.localStorage.getItem(key)
+    let batch = storedBatch ? JSON.parse(storedBatch) : { name: '', key: '' }
+
+    const onProgress = (file, offset) => {
+      progress[fileKey(file)] = offset
+      const done = Object.values(progress).reduce((a, b) => a + b, 0)
+      statusElement.innerHTML = 'Uploading ' + shortenFilename(file.name) + ' ' +
+        Math.floor(done / Math.max(1, totalSize) * 100) + '%'
+    }
+
+    const uploadAll = async () => {
+      for (const entry of files) {
+        batch = await uploadFile(entry, batch, onProgress)
+        window.localStorage.setItem(key, JSON.stringify(batch))
+      }
+    }
+
+    try {
+      await uploadAll()
+    } catch (e) {
+      if (!storedBatch) { throw e }
+      /* Stored batch expired on the server, start over */
+      window.localStorage.removeItem(key)
+      batch = { name: '', key: '' }
+      await uploadAll()
+    }
+    window.localStorage.removeItem(key)
+    return batch
+  }
+
+  function submitChunkedUpload (form) {
+    const submitDiv = form.getElementsByClassName('submit')[0]
+    const statusElement = document.createElement('p')
+    statusElement.className = 'description'
+    submitDiv.appendChild(statusElement)
+    submitDiv.getElementsByTagName('button')[0].setAttribute('disabled', 'disabled')
+
+    uploadFormFiles(form, statusElement).then(batch => {
+      if (batch !== null) {
+        /* Files are on the server, only submit the form fields and the upload batch */
+        for (const [name, value] of [['upload_batch', batch.name], ['upload_batch_key', batch.key]]) {
+          const batchInput = document.createElement('input')
+          batchInput.type = 'hidden'
+          batchInput.name = name
+          batchInput.value = value
+          form.appendChild(batchInput)
+        }
+        for (const input of form.querySelectorAll('input[type=file]')) { input.disabled = true }
+      }
+      form.submit()
+    }).catch(error => {
+      console.error(error)
+      statusElement.style.color = 'red'
+      statusElement.innerHTML = 'Upload interrupted: ' + error.message + '. Submit again to resume.'
+      submitDiv.getElementsByTagName('button')[0].removeAttribute('disabled')
+    })
   }
 
   function createTextureMapField (container, event) {
@@ -194,7 +309,6 @@ function dragDropUpload (uploadAllowedMapExt, uploadAllowedSceneExt, textureMapD
 
     /* Store the dropped files in hidden input because files array is immutable */
     const form = document.forms.reused_form
-    const f = 'none'
     if (event !== null) {
       const f = document.createElement('input')
       f.type = 'file'
@@ -211,12 +325,6 @@ function dragDropUpload (uploadAllowedMapExt, uploadAllowedSceneExt, textureMapD
       event.dataTransfer.files = [_file]
     }
 
-    /* Disable async uploads for now */
-    if (f === null) {
-      const uploadFilesAsync = () => uploadAsFormData(f.files)
-      uploadFilesAsync()
-    }
-
     /* Create a Texture Map Field from hidden template for each dropped file */
     for (const file of event.dataTransfer.files) {
       textureMapCounter += 1
@@ -330,6 +438,15 @@ function dragDropUpload (uploadAllowedMapExt, uploadAllowedSceneExt, textureMapD
       addColorButton.onclick = function () {
         createTextureMapField(textureMapContainer, null)
       }
+
+      /* Upload files in resumable chunks, browsers without fetch post the multipart form */
+      const form = document.forms.reused_form
+      if (window.fetch !== undefined && window.Blob !== undefined && window.Blob.prototype.slice !== undefined) {
+        form.onsubmit = function (event) {
+          event.preventDefault()
+          submitChunkedUpload(form)
+        }
+      }
       console.log('Tx Maps Drag n Drop ready.')
     }
   }
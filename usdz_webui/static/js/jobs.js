@@ -21,32 +21,256 @@ function setupHoverPreviewImage (a, img, offset) {
   }
 }
 
-function setupImage (entryId) {
-  /* Move preview image from it's nested position to document body */
-  const img = document.getElementById('dl_img_' + entryId)
-  if (img === null) { return null }
-  document.body.appendChild(img)
-  return document.getElementById('dl_img_' + entryId)
+function JobList (apiUrl, perPage) {
+  /* Render jobs page by page from the job api, details are loaded when opened */
+  let template = null
+  let nextCursor = null
+
+  function setText (card, className, text) {
+    const e = card.getElementsByClassName(className)[0]
+    if (e !== undefined) { e.textContent = text }
+    return e
+  }
+
+  function showAction (card, className, action) {
+    const form = card.getElementsByClassName(className)[0]
+    if (action === null) {
+      form.remove()
+    } else {
+      form.action = action
+    }
+    return form
+  }
+
+  function formatNumber (value, unit) {
+    if (value === null || value === undefined) { return '-' }
+    return value.toFixed(1) + unit
+  }
+
+  function formatEta (seconds) {
+    if (seconds === null || seconds === undefined) { return '' }
+    if (seconds < 60) { return 'ETA < 1 min' }
+    if (seconds < 3600) { return 'ETA ~' + Math.round(seconds / 60) + ' min' }
+    return 'ETA ~' + (seconds / 3600).toFixed(1) + ' h'
+  }
+
+  function loadDetails (card, jobId) {
+    window.fetch(apiUrl + '/' + jobId).then(response => response.json()).then(job => {
+      const messages = card.getElementsByClassName('job-messages')[0]
+      messages.textContent = job.messages || 'No process messages available'
+      messages.dataset.empty = job.messages ? 'false' : 'true'
+      messages.dataset.offset = job.messages_length
+      messages.dataset.loaded = 'true'
+
+      const log = card.getElementsByClassName('job-log')[0]
+      if (job.log_url) { log.href = job.log_url } else { log.remove() }
+
+      if (job.errors) {
+        setText(card, 'error', job.errors)
+      } else {
+        for (const e of card.querySelectorAll('.job-errors')) { e.remove() }
+      }
+
+      const filesTable = card.getElementsByClassName('job-files')[0]
+      for (const file of job.files) {
+        const row = filesTable.insertRow()
+        for (const key of ['id', 'file', 'channel', 'material', 'uv_set', 'map_type', 'color']) {
+          row.insertCell().textContent = file[key]
+        }
+      }
+
+      const usageTable = card.getElementsByClassName('job-usage')[0]
+      if (job.resource_usage.length === 0) { usageTable.remove() }
+      for (const usage of job.resource_usage) {
+        const row = usageTable.insertRow()
+        row.insertCell().textContent = usage.stage
+        row.insertCell().textContent = formatNumber(usage.wall_seconds, 's')
+        row.insertCell().textContent = formatNumber(usage.cpu_user, 's')
+        row.insertCell().textContent = formatNumber(usage.cpu_system, 's')
+        row.insertCell().textContent = formatNumber(usage.max_rss_kb === null ? null : usage.max_rss_kb / 1024, ' MB')
+        row.insertCell().textContent = formatNumber(usage.read_bytes === null ? null : usage.read_bytes / 1048576, ' MB')
+        row.insertCell().textContent = formatNumber(usage.write_bytes === null ? null : usage.write_bytes / 1048576, ' MB')
+      }
+
+      const args = (job.additional_args + ' ' + job.option_args.join(' ')).trim()
+      setText(card, 'job-arguments', args || ' - no additional parameters were provided - ')
+    }).catch(error => console.error('Could not load job details', error))
+  }
+
+  function createCard (job) {
+    const card = template.cloneNode(true)
+    card.removeAttribute('id')
+    card.classList.add('job')
+    card.dataset.jobId = job.job_id
+    card.dataset.completed = job.completed ? 'true' : 'false'
+    card.dataset.offset = job.messages_length
+
+    setText(card, 'job-id', 'Job ID: ' + job.job_id)
+    setText(card, 'job-scene', job.scene_name)
+    const state = setText(card, 'job-state', job.state_name)
+    if (job.state > 3) { state.classList.add('error') }
+    card.getElementsByClassName('job-progress')[0].value = job.progress
+    setText(card, 'job-progress-text', job.progress + '%')
+    setText(card, 'job-eta', formatEta(job.eta_seconds))
+
+    if (!job.completed) {
+      /* Unfinished jobs can only be cancelled */
+      const cancelUrl = template.getElementsByClassName('job-cancel')[0].action + '/' + job.job_id
+      showAction(card, 'job-cancel', cancelUrl)
+      for (const className of ['job-delete', 'job-download', 'job-share', 'dl_preview']) {
+        showAction(card, className, null)
+      }
+    } else {
+      const deleteUrl = template.getElementsByClassName('job-delete')[0].action + '/' + job.job_id
+      const shareUrl = template.getElementsByClassName('job-share')[0].action + '/' + job.share_id
+      showAction(card, 'job-cancel', null)
+      showAction(card, 'job-delete', deleteUrl)
+      showAction(card, 'job-download', job.download_url)
+      showAction(card, 'job-share', job.share_id !== null ? shareUrl : null)
+      const preview = showAction(card, 'dl_preview', job.preview_url)
+      if (job.preview_url !== null) {
+        const img = preview.getElementsByTagName('img')[0]
+        img.src = job.preview_url
+        document.body.appendChild(img)
+        setupHoverPreviewImage(preview.getElementsByTagName('button')[0], img, true)
+      }
+    }
+
+    if (job.preview_url !== null) {
+      card.getElementsByClassName('preview_image')[0].src = job.preview_url
+    } else {
+      card.getElementsByClassName('job-preview')[0].remove()
+    }
+
+    const details = card.getElementsByClassName('job-details')[0]
+    details.addEventListener('toggle', function () {
+      if (details.open && details.dataset.loaded !== 'true') {
+        details.dataset.loaded = 'true'
+        loadDetails(card, job.job_id)
+      }
+    })
+    return card
+  }
+
+  function loadPage (list, more) {
+    let url = apiUrl + '?limit=' + perPage
+    if (nextCursor !== null) { url += '&before=' + nextCursor }
+
+    return window.fetch(url).then(response => response.json()).then(page => {
+      for (const job of page.jobs) { list.appendChild(createCard(job)) }
+      nextCursor = page.next
+      more.style.display = nextCursor === null ? 'none' : 'block'
+      const empty = list.getElementsByClassName('job').length === 0
+      document.getElementById('job-list-empty').style.display = empty ? 'block' : 'none'
+    })
+  }
+
+  window.addEventListener('load', function () {
+    template = document.getElementById('job-template')
+    const list = document.getElementById('job-list')
+    const more = document.getElementById('job-list-more')
+    more.getElementsByTagName('button')[0].onclick = function () { loadPage(list, more) }
+
+    loadPage(list, more).then(() => {
+      document.dispatchEvent(new window.Event('jobsloaded'))
+    }).catch(error => console.error('Could not load jobs', error))
+  })
 }
 
-function JobPreviewImgs () {
-  document.onreadystatechange = function () {
-    if (document.readyState === 'complete') {
-      const elements = document.getElementsByClassName('dl_preview')
-      for (let i = 0; i < elements.length; i++) {
-        const entryId = elements[i].id
-        console.log('Setting up: ' + entryId)
-        /* Preview Button */
-        const b = document.getElementById('dl_pre_' + entryId)
-        const img = setupImage(entryId)
-        setupHoverPreviewImage(b, img, true)
+function JobStatusStream (streamUrl, pollSeconds) {
+  /* Update state, progress and messages of unfinished jobs in place */
+  let reloading = false
+  if (!pollSeconds) { pollSeconds = 10 }
+
+  function streamQuery () {
+    const jobs = []
+    let lastJobId = 0
+    const elements = document.getElementsByClassName('job')
+    for (let i = 0; i < elements.length; i++) {
+      const jobId = parseInt(elements[i].dataset.jobId)
+      if (jobId > lastJobId) { lastJobId = jobId }
+      if (elements[i].dataset.completed === 'false') {
+        jobs.push(jobId + ':' + elements[i].dataset.offset)
       }
     }
+    return '?jobs=' + jobs.join(',') + '&last=' + lastJobId
+  }
+
+  function updateJob (status) {
+    const job = document.querySelector('.job[data-job-id="' + status.job_id + '"]')
+    if (job === null) { return }
+    job.dataset.offset = status.offset
+
+    job.getElementsByClassName('job-state')[0].textContent = status.state_name
+    job.getElementsByClassName('job-progress')[0].value = status.progress
+    job.getElementsByClassName('job-progress-text')[0].textContent = status.progress + '%'
+
+    /* Messages are only appended once the job details were loaded */
+    const messages = job.getElementsByClassName('job-messages')[0]
+    if (messages.dataset.loaded !== 'true' || !status.messages) { return }
+
+    /* Skip output already contained in the loaded details */
+    const start = status.offset - status.messages.length
+    const text = status.messages.slice(Math.max(0, parseInt(messages.dataset.offset) - start))
+    messages.dataset.offset = status.offset
+    if (!text) { return }
+
+    if (messages.dataset.empty === 'true') {
+      messages.textContent = ''
+      messages.dataset.empty = 'false'
+    }
+    messages.appendChild(document.createTextNode(text))
   }
+
+  function reload () {
+    /* Job list changed or a job finished and needs to render it's download actions */
+    reloading = true
+    window.location.reload()
+  }
+
+  function poll () {
+    /* All streams of the server are taken, fetch the current state and try to stream again later */
+    window.fetch(streamUrl + streamQuery() + '&poll=1').then(response => response.json()).then(status => {
+      for (const job of status.jobs) { updateJob(job) }
+      if (status.reload) { reload() }
+    }).catch(error => console.error('Could not poll job status', error)).finally(() => {
+      if (!reloading) { window.setTimeout(connect, pollSeconds * 1000) }
+    })
+  }
+
+  function connect () {
+    const source = new window.EventSource(streamUrl + streamQuery())
+    let ready = false
+
+    source.addEventListener('ready', function () { ready = true })
+    source.addEventListener('job', function (event) {
+      updateJob(JSON.parse(event.data))
+    })
+    source.addEventListener('reload', function () {
+      source.close()
+      reload()
+    })
+    source.addEventListener('end', function () {
+      /* Server closes streams periodically, re-connect with the current message offsets */
+      source.close()
+      connect()
+    })
+    source.onerror = function () {
+      source.close()
+      if (reloading) { return }
+      /* A stream that was never ready was refused or could not connect */
+      if (ready) { window.setTimeout(connect, 2000) } else { poll() }
+    }
+  }
+
+  if (window.EventSource === undefined) { return }
+  /* Connect once the job list rendered the first page */
+  document.addEventListener('jobsloaded', connect)
 }
 
 const fake = 'PassJStandardParse'
 if (fake === null) {
   /* Will never be called, Jinja Template will call with necessary constants */
-  JobPreviewImgs(null)
+  JobList(null, null)
+  JobStatusStream(null)
 }